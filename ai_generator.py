@@ -10,18 +10,3500 @@ import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, scrolledtext
 import json
 import os
+import array
+import asyncio
 import base64
+import contextlib
+import cProfile
+import functools
+import hashlib
+import hmac
 import time
 import threading
 import requests
 import logging
+import math
+import mimetypes
+import mmap
+import pstats
+import queue
+import re
+import shutil
+import signal
+import sqlite3
+import struct
+import unicodedata
+import argparse
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from http import HTTPStatus
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from openai import OpenAI
 from PIL import Image, ImageTk
 import io
 
+try:
+    import httpx
+except ImportError:  # httpx đi kèm openai, chỉ cần khi ghi/phát lại chat
+    httpx = None
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # watchdog là tùy chọn, không có thì hot folder dùng polling
+    Observer = None
+
+# Ngưỡng hedging mặc định (giây) khi chưa đủ số liệu để tính p95
+DEFAULT_HEDGE_THRESHOLD = 3.0
+
+
+class LatencyTracker:
+    """Lưu cửa sổ trượt các độ trễ gần nhất để ước lượng p95"""
+
+    def __init__(self, window=100, min_samples=5):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        """Ghi nhận một độ trễ (giây)"""
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct, default=None):
+        """Trả về percentile pct (0-100), hoặc default nếu chưa đủ mẫu"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return default
+            ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+def fold_text(text):
+    """Chuẩn hóa văn bản để tìm kiếm không phân biệt dấu tiếng Việt (đ -> d, bỏ dấu thanh)"""
+    text = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def open_path(path):
+    """Mở file bằng ứng dụng mặc định của hệ điều hành"""
+    if sys.platform.startswith("win"):
+        os.startfile(path)
+    elif sys.platform == "darwin":
+        subprocess.Popen(["open", path])
+    else:
+        subprocess.Popen(["xdg-open", path])
+
+
+class SearchIndex:
+    """Chỉ mục full-text (SQLite FTS5) cho chat, prompt và log của mọi session trong data/.
+
+    Truy vấn chỉ đọc chỉ mục có sẵn; việc cập nhật chạy khi ghi (GUI) hoặc khi được yêu cầu (--refresh).
+    chat_history.jsonl và session.log chỉ append nên được index tiếp từ offset đã index, không đọc lại cả file."""
+
+    APPEND_ONLY_FILES = ("chat_history.jsonl", "session.log")
+
+    def __init__(self, data_dir="data", db_path=None):
+        self.data_dir = data_dir
+        self.db_path = db_path or os.path.join(data_dir, "search_index.db")
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL,
+                session TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS docs_path ON docs(path);
+            CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+                body, tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+        # Chỉ mục tạo bởi bản cũ chưa có cột tiến độ cho file append-only
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        with self.conn:
+            for column in ("indexed_bytes", "indexed_lines"):
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.conn.close()
+
+    def _extract_appended(self, path, offset=0, items=0):
+        """Index phần mới của file append-only từ offset (chỉ các dòng đã ghi trọn).
+        items là số dòng đã xử lý trước đó. Trả về (documents, offset mới, items mới)"""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        data = data[:data.rfind(b"\n") + 1]
+        documents = []
+        is_chat = os.path.basename(path) == "chat_history.jsonl"
+        for line in data.decode("utf-8").split("\n")[:-1]:
+            if is_chat:
+                msg = json.loads(line) if line.strip() else {}
+                if msg and msg.get("role") != "system":
+                    documents.append(("chat_" + msg.get("role", ""), f"message={items}", msg.get("content") or ""))
+            elif line.strip():
+                documents.append(("log", f"line={items + 1}", line))
+            items += 1
+        return documents, offset + len(data), items
+
+    def _extract_documents(self, path):
+        """Trả về danh sách (kind, ref, content) cần index cho một file"""
+        name = os.path.basename(path)
+        if name in self.APPEND_ONLY_FILES:
+            return self._extract_appended(path)[0]
+        if name == "chat_history.json":
+            with open(path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            return [
+                ("chat_" + msg.get("role", ""), f"message={i}", msg.get("content") or "")
+                for i, msg in enumerate(history)
+                if msg.get("role") != "system"
+            ]
+        if name.endswith(".json") and name != "session_info.json":
+            with open(path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            if not isinstance(metadata, dict):
+                return []
+            text = metadata.get("prompt") or metadata.get("text") or ""
+            if not text:
+                return []
+            kind = metadata.get("type") or os.path.basename(os.path.dirname(path)).rstrip("s")
+            return [(kind, metadata.get("filename", ""), text)]
+        return []
+
+    def _iter_indexable_files(self, session_folder=None):
+        """Duyệt các file có thể index trong data/session_* (hoặc chỉ một session)"""
+        if session_folder:
+            sessions = [session_folder] if os.path.isdir(session_folder) else []
+        elif os.path.isdir(self.data_dir):
+            sessions = [entry.path for entry in os.scandir(self.data_dir)
+                        if entry.is_dir() and entry.name.startswith("session_")]
+        else:
+            sessions = []
+        for session_path in sessions:
+            session_name = os.path.basename(os.path.normpath(session_path))
+            has_jsonl = os.path.exists(os.path.join(session_path, ChatHistoryStore.FILENAME))
+            for entry in os.scandir(session_path):
+                if entry.is_file() and entry.name in ("chat_history.json", "chat_history.jsonl", "session.log"):
+                    if entry.name == ChatHistoryStore.LEGACY_FILENAME and has_jsonl:
+                        continue  # Bản cũ còn sót lại sau khi đã chuyển sang .jsonl
+                    yield session_name, entry
+                elif entry.is_dir() and entry.name in ("images", "videos", "audio"):
+                    for artifact in os.scandir(entry.path):
+                        if artifact.is_file() and artifact.name.endswith(".json"):
+                            yield session_name, artifact
+
+    def _remove_path(self, path):
+        ids = [row[0] for row in self.conn.execute("SELECT id FROM docs WHERE path = ?", (path,))]
+        self.conn.executemany("DELETE FROM docs_fts WHERE rowid = ?", [(i,) for i in ids])
+        self.conn.execute("DELETE FROM docs WHERE path = ?", (path,))
+        self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def _index_file(self, session, path, stat, known):
+        """Index một file mới/đã đổi; file append-only chỉ index phần ghi thêm. Gọi khi đang giữ lock"""
+        offset = items = 0
+        append = (os.path.basename(path) in self.APPEND_ONLY_FILES and known is not None
+                  and stat.st_size >= known[2] > 0)
+        if append:
+            offset, items = known[2], known[3]
+        if os.path.basename(path) in self.APPEND_ONLY_FILES:
+            documents, offset, items = self._extract_appended(path, offset, items)
+        else:
+            documents = self._extract_documents(path)
+        with self.conn:
+            if append:
+                self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            else:
+                self._remove_path(path)
+            for kind, ref, content in documents:
+                cursor = self.conn.execute(
+                    "INSERT INTO docs (path, session, kind, ref, content) VALUES (?, ?, ?, ?, ?)",
+                    (path, session, kind, ref, content)
+                )
+                self.conn.execute(
+                    "INSERT INTO docs_fts (rowid, body) VALUES (?, ?)",
+                    (cursor.lastrowid, fold_text(content))
+                )
+            self.conn.execute(
+                "INSERT INTO files (path, mtime, size, indexed_bytes, indexed_lines) VALUES (?, ?, ?, ?, ?)",
+                (path, stat.st_mtime, stat.st_size, offset, items)
+            )
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() is None
+
+    def update(self, session_folder=None):
+        """Cập nhật chỉ mục tăng dần: chỉ index lại các file mới hoặc đã thay đổi.
+        Có session_folder thì chỉ quét session đó (dùng khi vừa ghi file). Trả về số file đã index lại.
+        Lock chỉ giữ theo từng file để truy vấn song song không phải chờ cả lượt quét."""
+        with self.lock:
+            if session_folder:
+                prefix = os.path.join(session_folder, "")
+                rows = self.conn.execute("SELECT path, mtime, size, indexed_bytes, indexed_lines FROM files "
+                                         "WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+            else:
+                rows = self.conn.execute("SELECT path, mtime, size, indexed_bytes, indexed_lines FROM files")
+            known = {row[0]: row[1:] for row in rows}
+        seen = set()
+        changed = 0
+        for session, entry in self._iter_indexable_files(session_folder):
+            path = entry.path
+            seen.add(path)
+            try:
+                stat = entry.stat()
+                if known.get(path, (None, None))[:2] == (stat.st_mtime, stat.st_size):
+                    continue
+                with self.lock:
+                    self._index_file(session, path, stat, known.get(path))
+            except (OSError, ValueError) as e:
+                logging.getLogger(__name__).warning(f"Bỏ qua file không đọc được khi index: {path} ({e})")
+                continue
+            changed += 1
+        removed = set(known) - seen
+        if removed:
+            with self.lock, self.conn:
+                for path in removed:
+                    self._remove_path(path)
+        return changed
+
+    def search(self, query, limit=50):
+        """Tìm kiếm và trả về danh sách hit đã xếp hạng theo bm25"""
+        terms = [t for t in re.findall(r"\w+", fold_text(query)) if t]
+        if not terms:
+            return []
+        match = " ".join(f'"{t}"*' for t in terms)
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT d.path, d.session, d.kind, d.ref, d.content, bm25(docs_fts) AS score
+                FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid
+                WHERE docs_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+            """, (match, limit)).fetchall()
+        hits = []
+        for path, session, kind, ref, content, score in rows:
+            artifact = path
+            if path.endswith(".json") and os.path.basename(path) != "chat_history.json":
+                # Link tới file media thay vì file metadata
+                artifact = path[:-len(".json")]
+            hits.append({
+                "path": artifact,
+                "uri": Path(os.path.abspath(artifact)).as_uri() + (f"#{ref}" if "=" in ref else ""),
+                "session": session,
+                "kind": kind,
+                "ref": ref,
+                "content": content,
+                "score": score
+            })
+        return hits
+
+
+def image_dhash(image_path, hash_size=8):
+    """Tính difference hash 64-bit của ảnh để so sánh ảnh gần giống nhau"""
+    with Image.open(image_path) as image:
+        pixels = list(image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:016x}"
+
+
+# Kích thước preview ảnh trên GUI
+PREVIEW_SIZE = (300, 300)
+# Số process xử lý hậu kỳ (decode, hash, thumbnail); chừa một core cho GUI/network
+POSTPROCESS_MAX_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+def process_pool_context():
+    """Context cho các process pool: không fork process chính (đang có thread Tk/network và lock),
+    dùng forkserver nếu hệ điều hành hỗ trợ, không thì spawn"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _read_handoff(source):
+    """Đọc dữ liệu được chuyển sang process con: ("shm", tên, độ dài), ("file", path)
+    hoặc ("bytes", dữ liệu) khi chạy ngay trong process hiện tại"""
+    if source[0] == "bytes":
+        return source[1]
+    if source[0] == "shm":
+        shm = shared_memory.SharedMemory(name=source[1])
+        try:
+            return bytes(shm.buf[:source[2]])
+        finally:
+            shm.close()
+    with open(source[1], "rb") as f:
+        return f.read()
+
+
+def _save_thumbnail(image, thumbnail_path, thumb_size):
+    thumb = image.copy()
+    if thumb.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        thumb = thumb.convert("RGBA")
+    thumb.thumbnail(thumb_size, Image.Resampling.LANCZOS)
+    thumb.save(thumbnail_path, "PNG")
+
+
+def postprocess_image(source, output_path=None, thumbnail_path=None, thumb_size=PREVIEW_SIZE, validate=False):
+    """Chạy trong process pool: decode base64, kiểm tra ảnh, tính sha256/dhash, ghi file và thumbnail.
+    Chỉ trả về metadata nhỏ; ảnh đã decode không quay lại process chính"""
+    raw = base64.b64decode(_read_handoff(source), validate=validate)
+    with Image.open(io.BytesIO(raw)) as image:
+        image.verify()
+    with Image.open(io.BytesIO(raw)) as image:
+        image.load()
+        info = {"format": image.format, "width": image.width, "height": image.height}
+        if thumbnail_path:
+            _save_thumbnail(image, thumbnail_path, thumb_size)
+    info.update(size=len(raw), sha256=hashlib.sha256(raw).hexdigest(), dhash=image_dhash(io.BytesIO(raw)),
+                thumbnail=thumbnail_path)
+    if output_path:
+        with open(output_path, "wb") as f:
+            f.write(raw)
+    return info
+
+
+def inspect_image(image_path):
+    """Chạy trong process pool: kiểm tra ảnh trên đĩa, trả về định dạng, kích thước, sha256 và dhash"""
+    with open(image_path, "rb") as f:
+        raw = f.read()
+    with Image.open(io.BytesIO(raw)) as image:
+        image.verify()
+        info = {"format": image.format, "width": image.width, "height": image.height}
+    info.update(size=len(raw), sha256=hashlib.sha256(raw).hexdigest(), dhash=image_dhash(io.BytesIO(raw)))
+    return info
+
+
+def make_thumbnail(image_path, thumbnail_path, thumb_size=PREVIEW_SIZE):
+    """Chạy trong process pool: tạo thumbnail PNG cho ảnh trên đĩa"""
+    with Image.open(image_path) as image:
+        _save_thumbnail(image, thumbnail_path, thumb_size)
+    return thumbnail_path
+
+
+class PostProcessor:
+    """Pool process cho phần xử lý CPU sau mỗi lần tạo (decode base64, kiểm tra, hash, thumbnail).
+
+    Một ảnh 1024x1024 mất khoảng 150-200 ms CPU (decode, verify, hash, thumbnail). Khi được gọi từ thread
+    nền và không có việc hậu kỳ nào khác thì chạy ngay trong thread đó để khỏi copy dữ liệu sang process
+    con; thread chính (thread Tk) không bao giờ chạy inline. Khi nhiều việc chạy song song (fan-out,
+    batch) thì dùng pool: dữ liệu lớn được chuyển qua shared memory (hoặc file tạm nếu không có /dev/shm),
+    process con ghi kết quả thẳng ra đĩa; chỉ đường dẫn và metadata nhỏ đi qua pickle.
+    Thread Tk không chờ pool: dùng thumbnail_async() rồi kiểm tra future bằng root.after.
+    Nếu pool hỏng thì chạy ngay trong thread hiện tại."""
+
+    def __init__(self, max_workers=None, thumbnail_dir=None, logger=None):
+        self.max_workers = max_workers or POSTPROCESS_MAX_WORKERS
+        self.logger = logger or logging.getLogger(__name__)
+        self.thumbnail_dir = thumbnail_dir
+        self.owns_thumbnail_dir = False
+        self.pool = None
+        self.active = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _claim(self):
+        """Đánh dấu một việc hậu kỳ đang chạy; trả về True nếu được chạy inline
+        (không có việc nào khác và không phải thread chính)"""
+        with self.lock:
+            inline = self.active == 0 and threading.current_thread() is not threading.main_thread()
+            self.active += 1
+        try:
+            yield inline
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                if os.name == "posix":
+                    # Process con phải dùng chung resource tracker với process chính, nếu không
+                    # shared memory đã unlink vẫn bị báo "leaked" khi thoát
+                    resource_tracker.ensure_running()
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=process_pool_context())
+            return self.pool
+
+    def _submit(self, func, *args):
+        """Gửi việc vào pool, trả về future; pool hỏng thì chạy ngay và trả về future đã xong"""
+        try:
+            return self._get_pool().submit(func, *args)
+        except BrokenProcessPool as e:
+            self.logger.warning(f"Process pool hậu kỳ bị lỗi ({str(e)}), xử lý trong thread hiện tại")
+            with self.lock:
+                self.pool = None
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _run(self, func, *args):
+        with self._claim() as inline:
+            if inline:
+                return func(*args)
+            try:
+                return self._submit(func, *args).result()
+            except BrokenProcessPool as e:
+                self.logger.warning(f"Process pool hậu kỳ bị lỗi ({str(e)}), xử lý trong thread hiện tại")
+                with self.lock:
+                    self.pool = None
+                return func(*args)
+
+    def _thumbnail_file(self, key):
+        with self.lock:
+            if self.thumbnail_dir is None:
+                self.thumbnail_dir = tempfile.mkdtemp(prefix="ai_generator_thumbs_")
+                self.owns_thumbnail_dir = True
+        return os.path.join(self.thumbnail_dir, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.png")
+
+    def process_image(self, image_b64, output_path, thumbnail=False, validate=False):
+        """Decode ảnh base64 và ghi ra output_path trong process con, trả về metadata
+        (format, width, height, size, sha256, dhash, thumbnail)"""
+        start_time = time.time()
+        data = image_b64.encode("ascii") if isinstance(image_b64, str) else image_b64
+        thumbnail_path = self._thumbnail_file(os.path.abspath(output_path)) if thumbnail else None
+        with self._claim() as inline:
+            if inline:
+                info = postprocess_image(("bytes", data), output_path, thumbnail_path, PREVIEW_SIZE, validate)
+            else:
+                info = self._process_in_pool(data, output_path, thumbnail_path, validate)
+        self.logger.info(f"Đã xử lý hậu kỳ ảnh {os.path.basename(output_path)} ({info['size']} bytes) "
+                         f"trong {time.time() - start_time:.3f} giây")
+        return info
+
+    def _process_in_pool(self, data, output_path, thumbnail_path, validate):
+        shm = temp_path = None
+        try:
+            try:
+                shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+                shm.buf[:len(data)] = data
+                source = ("shm", shm.name, len(data))
+            except OSError:
+                fd, temp_path = tempfile.mkstemp(suffix=".b64")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                source = ("file", temp_path)
+            del data
+            try:
+                return self._submit(postprocess_image, source, output_path, thumbnail_path,
+                                    PREVIEW_SIZE, validate).result()
+            except BrokenProcessPool as e:
+                self.logger.warning(f"Process pool hậu kỳ bị lỗi ({str(e)}), xử lý trong thread hiện tại")
+                with self.lock:
+                    self.pool = None
+                return postprocess_image(source, output_path, thumbnail_path, PREVIEW_SIZE, validate)
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            if temp_path:
+                os.remove(temp_path)
+
+    def inspect(self, image_path):
+        """Kiểm tra ảnh trên đĩa trong process con"""
+        return self._run(inspect_image, image_path)
+
+    def _thumbnail_path(self, image_path):
+        stat = os.stat(image_path)
+        return self._thumbnail_file(f"{os.path.abspath(image_path)}:{stat.st_mtime_ns}:{stat.st_size}")
+
+    def thumbnail(self, image_path):
+        """Tạo (hoặc dùng lại) thumbnail preview cho ảnh trên đĩa, trả về đường dẫn thumbnail"""
+        thumbnail_path = self._thumbnail_path(image_path)
+        if not os.path.exists(thumbnail_path):
+            self._run(make_thumbnail, image_path, thumbnail_path)
+        return thumbnail_path
+
+    def thumbnail_async(self, image_path):
+        """Như thumbnail() nhưng không chờ: trả về future chứa đường dẫn thumbnail (dùng trên thread Tk)"""
+        thumbnail_path = self._thumbnail_path(image_path)
+        if os.path.exists(thumbnail_path):
+            future = Future()
+            future.set_result(thumbnail_path)
+            return future
+        return self._submit(make_thumbnail, image_path, thumbnail_path)
+
+    def shutdown(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        if self.owns_thumbnail_dir:
+            shutil.rmtree(self.thumbnail_dir, ignore_errors=True)
+
+
+class PromptSimilarityIndex:
+    """Chỉ mục MinHash/LSH (chỉ dùng CPU) để tìm các prompt gần giống đã tạo trước đó.
+
+    Shingle là bộ 3 ký tự liên tiếp của prompt đã chuẩn hóa (có thêm dấu cách ở hai đầu, tạo bằng zip nên
+    không lặp từng ký tự trong Python). Shingle theo từ quá thô với prompt ngắn: "Make this look animated"
+    và "make it look more animated" chỉ đạt Jaccard 0.23 theo từ nhưng 0.48 theo ký tự, trong khi các cặp
+    khác nghĩa ("make it brighter"/"make it darker") vẫn dưới ngưỡng 0.4. Signature dùng
+    one-permutation MinHash: mỗi shingle chỉ hash một lần, chia vào NUM_BANDS * ROWS_PER_BAND ô theo giá trị
+    hash và lấy min mỗi ô (ô trống mượn giá trị ô kế tiếp), nên chi phí gần như chỉ là một lần sort thay vì
+    60 hoán vị cho mỗi shingle. Chỉ mục chỉ nằm trong bộ nhớ nên dùng hash() của Python."""
+
+    NUM_BANDS = 30
+    ROWS_PER_BAND = 2
+
+    def __init__(self, threshold=0.4, max_image_distance=6):
+        self.threshold = threshold
+        self.max_image_distance = max_image_distance
+        self.entries = []
+        self.buckets = {}
+        self.known_paths = set()
+        self.lock = threading.Lock()
+
+    def _shingles(self, text):
+        words = fold_text(text).split()
+        if not words:
+            return {hash("")}
+        padded = " " + " ".join(words) + " "
+        return set(map(hash, zip(padded, padded[1:], padded[2:])))
+
+    def _signature(self, shingles):
+        num_slots = self.NUM_BANDS * self.ROWS_PER_BAND
+        signature = [None] * num_slots
+        filled = 0
+        # Duyệt theo thứ tự tăng dần: giá trị đầu tiên rơi vào ô nào là min của ô đó
+        for value in sorted(shingles):
+            slot = value % num_slots
+            if signature[slot] is None:
+                signature[slot] = value
+                filled += 1
+                if filled == num_slots:
+                    return signature
+        # Prompt ngắn: ô trống mượn ô có giá trị kế tiếp (vòng tròn), kèm khoảng cách để phân biệt
+        original = list(signature)
+        for slot in range(num_slots):
+            if original[slot] is None:
+                distance = 1
+                while original[(slot + distance) % num_slots] is None:
+                    distance += 1
+                signature[slot] = original[(slot + distance) % num_slots] * 128 + distance
+        return signature
+
+    def _band_keys(self, kind, key, signature):
+        rows = self.ROWS_PER_BAND
+        return [
+            (kind, key, band, tuple(signature[band * rows:(band + 1) * rows]))
+            for band in range(self.NUM_BANDS)
+        ]
+
+    def add(self, kind, prompt, artifact_path, key="", image_hash=None, metadata=None):
+        """Thêm một lần tạo vào chỉ mục (tăng dần, không cần build lại)"""
+        if not prompt:
+            return
+        shingles = self._shingles(prompt)
+        signature = self._signature(shingles)
+        entry = {
+            "kind": kind,
+            "key": key,
+            "prompt": prompt,
+            "path": artifact_path,
+            "image_hash": image_hash,
+            "shingles": shingles,
+            "metadata": metadata or {}
+        }
+        with self.lock:
+            if artifact_path in self.known_paths:
+                return
+            self.known_paths.add(artifact_path)
+            index = len(self.entries)
+            self.entries.append(entry)
+            for band_key in self._band_keys(kind, key, signature):
+                self.buckets.setdefault(band_key, []).append(index)
+
+    def find_similar(self, kind, prompt, key="", image_hash=None, limit=3):
+        """Trả về các lần tạo gần giống nhất, mỗi phần tử là (độ tương đồng, entry).
+        Chỉ kiểm tra file còn tồn tại với các kết quả đã lọc và xếp hạng, không stat mọi ứng viên; entry có
+        file đã bị xóa được gỡ khỏi chỉ mục để lần sau không phải stat lại"""
+        if not prompt:
+            return []
+        shingles = self._shingles(prompt)
+        signature = self._signature(shingles)
+        with self.lock:
+            candidates = set()
+            for band_key in self._band_keys(kind, key, signature):
+                candidates.update(self.buckets.get(band_key, ()))
+            entries = [(i, self.entries[i]) for i in candidates if self.entries[i] is not None]
+        matches = []
+        for index, entry in entries:
+            if image_hash or entry["image_hash"]:
+                if not (image_hash and entry["image_hash"]):
+                    continue
+                distance = bin(int(image_hash, 16) ^ int(entry["image_hash"], 16)).count("1")
+                if distance > self.max_image_distance:
+                    continue
+            similarity = len(shingles & entry["shingles"]) / len(shingles | entry["shingles"])
+            if similarity >= self.threshold:
+                matches.append((similarity, index, entry))
+        matches.sort(key=lambda m: m[0], reverse=True)
+        results = []
+        for similarity, index, entry in matches:
+            if os.path.exists(entry["path"]):
+                results.append((similarity, entry))
+                if len(results) == limit:
+                    break
+            else:
+                self._remove(index)
+        return results
+        
+    def _remove(self, index):
+        """Gỡ entry có file đã bị xóa; index cũ trong buckets được bỏ qua khi tra cứu"""
+        with self.lock:
+            entry = self.entries[index]
+            if entry is not None:
+                self.entries[index] = None
+                self.known_paths.discard(entry["path"])
+
+    def load_from_data_dir(self, data_dir="data"):
+        """Nạp các lần tạo ảnh/TTS đã có từ metadata trong data/session_*"""
+        if not os.path.isdir(data_dir):
+            return
+        for session in os.scandir(data_dir):
+            if not (session.is_dir() and session.name.startswith("session_")):
+                continue
+            for folder in ("images", "audio"):
+                folder_path = os.path.join(session.path, folder)
+                if not os.path.isdir(folder_path):
+                    continue
+                for entry in os.scandir(folder_path):
+                    if not entry.name.endswith(".json"):
+                        continue
+                    artifact_path = entry.path[:-len(".json")]
+                    if artifact_path in self.known_paths:
+                        continue
+                    try:
+                        with open(entry.path, "r", encoding="utf-8") as f:
+                            metadata = json.load(f)
+                    except (OSError, ValueError):
+                        continue
+                    if folder == "audio":
+                        self.add("tts", metadata.get("text"), artifact_path,
+                                 key=metadata.get("voice", ""), metadata=metadata)
+                    else:
+                        image_hash = metadata.get("input_image_hash")
+                        input_image = metadata.get("input_image")
+                        if not image_hash and input_image and os.path.exists(input_image):
+                            try:
+                                image_hash = image_dhash(input_image)
+                            except OSError:
+                                image_hash = None
+                        if input_image and not image_hash:
+                            # Không xác định được ảnh đầu vào thì không thể dùng lại an toàn
+                            continue
+                        self.add(metadata.get("type", "text_to_image"), metadata.get("prompt"),
+                                 artifact_path, image_hash=image_hash, metadata=metadata)
+
+
+class SessionArchive:
+    """Archive một session thành một file zip có manifest trung tâm.
+    Media được lưu không nén để đọc trực tiếp qua mmap, JSON/log được nén."""
+
+    MANIFEST_NAME = "manifest.json"
+    COMPRESSED_EXTENSIONS = (".json", ".jsonl", ".log", ".txt")
+    LOCAL_HEADER_SIZE = 30
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.file = open(archive_path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zip = zipfile.ZipFile(self.file)
+        self.manifest = json.loads(self.zip.read(self.MANIFEST_NAME).decode("utf-8"))
+        self.entries = {entry["name"]: entry for entry in self.manifest["entries"]}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+        self.mmap.close()
+        self.file.close()
+
+    @property
+    def session_id(self):
+        return self.manifest["session_id"]
+
+    def names(self, prefix=""):
+        """Danh sách artifact trong archive (không cần giải nén)"""
+        return [name for name in self.entries if name.startswith(prefix)]
+
+    def read(self, name):
+        """Đọc một artifact. Member không nén trả về memoryview trên mmap (không copy)"""
+        info = self.zip.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            return self.zip.read(name)
+        offset = info.header_offset
+        name_length, extra_length = struct.unpack_from("<HH", self.mmap, offset + 26)
+        start = offset + self.LOCAL_HEADER_SIZE + name_length + extra_length
+        return memoryview(self.mmap)[start:start + info.file_size]
+
+    def read_json(self, name):
+        return json.loads(bytes(self.read(name)).decode("utf-8"))
+
+    @classmethod
+    def export(cls, session_folder, archive_path):
+        """Ghi session folder thành archive theo kiểu streaming (từng file một)"""
+        session_id = os.path.basename(os.path.normpath(session_folder))
+        entries = []
+        with zipfile.ZipFile(archive_path, "w") as zf:
+            for root, dirs, files in os.walk(session_folder):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, session_folder).replace(os.sep, "/")
+                    compressed = name.endswith(cls.COMPRESSED_EXTENSIONS)
+                    zf.write(path, arcname,
+                             compress_type=zipfile.ZIP_DEFLATED if compressed else zipfile.ZIP_STORED)
+                    entries.append({
+                        "name": arcname,
+                        "size": os.path.getsize(path),
+                        "compressed": compressed
+                    })
+            manifest = {
+                "format": 1,
+                "session_id": session_id,
+                "exported_at": datetime.now().isoformat(),
+                "entries": entries
+            }
+            zf.writestr(cls.MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2),
+                        compress_type=zipfile.ZIP_DEFLATED)
+        return manifest
+
+    @classmethod
+    def import_archive(cls, archive_path, data_dir="data"):
+        """Giải nén archive thành data/<session_id>, trả về đường dẫn folder"""
+        with cls(archive_path) as archive:
+            session_id = archive.session_id
+            # session_id lấy từ manifest (không tin cậy): chỉ chấp nhận tên folder session_* đơn thuần
+            if (not isinstance(session_id, str) or not session_id.startswith("session_") or ".." in session_id
+                    or "/" in session_id or os.sep in session_id or os.path.basename(session_id) != session_id):
+                raise ValueError(f"session_id không hợp lệ trong archive: {session_id!r}")
+            session_folder = os.path.join(data_dir, session_id)
+            if not os.path.abspath(session_folder).startswith(os.path.abspath(data_dir) + os.sep):
+                raise ValueError(f"session_id không hợp lệ trong archive: {session_id!r}")
+            if os.path.exists(session_folder):
+                raise FileExistsError(f"Session đã tồn tại: {session_folder}")
+                
+            # Kiểm tra mọi đường dẫn trước khi ghi file nào
+            targets = []
+            for name in archive.names():
+                target = os.path.join(session_folder, *name.split("/"))
+                if not os.path.abspath(target).startswith(os.path.abspath(session_folder) + os.sep):
+                    raise ValueError(f"Đường dẫn không hợp lệ trong archive: {name}")
+                targets.append((name, target))
+            for name, target in targets:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as f:
+                    f.write(archive.read(name))
+        return session_folder
+
+
+API_BASE_URL = "https://api.thucchien.ai"
+
+# Giới hạn thời gian mặc định (giây)
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 180
+IMAGE_TOTAL_BUDGET = 300
+TTS_TOTAL_BUDGET = 300
+VIDEO_TOTAL_BUDGET = 30 * 60
+VIDEO_MAX_POLL_DURATION = 20 * 60
+
+
+class GenerationError(Exception):
+    """Lỗi khi gọi API tạo nội dung"""
+
+    def __init__(self, message="", status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OperationCancelled(GenerationError):
+    """Thao tác bị người dùng hủy"""
+
+
+class DeadlineExceeded(GenerationError):
+    """Thao tác vượt quá thời hạn cho phép"""
+
+
+class CancellationToken:
+    """Cờ hủy dùng chung giữa UI/CLI và thao tác đang chạy"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """Hủy thao tác: đánh thức các lần chờ và đóng kết nối đang mở"""
+        self._event.set()
+        with self._lock:
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def add_callback(self, callback):
+        """Đăng ký hàm dọn dẹp, gọi ngay nếu đã bị hủy"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.add(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            self._callbacks.discard(callback)
+
+    def wait(self, seconds):
+        """Chờ tối đa seconds giây, trả về True nếu bị hủy trong lúc chờ"""
+        return self._event.wait(seconds)
+
+
+class Deadline:
+    """Giới hạn thời gian cho một thao tác: timeout connect/read, tổng thời gian và thời gian polling tối đa"""
+
+    def __init__(self, total=None, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_poll_duration=None, token=None):
+        self.total = total
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_poll_duration = max_poll_duration
+        self.token = token or CancellationToken()
+        self.expires_at = time.monotonic() + total if total else None
+
+    def remaining(self):
+        """Số giây còn lại, None nếu không giới hạn tổng"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self, what="thao tác"):
+        """Raise nếu đã bị hủy hoặc hết thời hạn"""
+        if self.token.cancelled:
+            raise OperationCancelled(f"Đã hủy {what}")
+        if self.remaining() == 0:
+            raise DeadlineExceeded(f"Vượt quá thời hạn {self.total} giây cho {what}")
+
+    def timeout(self, what="thao tác"):
+        """Tuple (connect, read) timeout cho requests, không vượt quá thời gian còn lại"""
+        self.check(what)
+        read_timeout = self.read_timeout
+        remaining = self.remaining()
+        if remaining is not None:
+            read_timeout = min(read_timeout, remaining)
+        return (min(self.connect_timeout, read_timeout), read_timeout)
+
+    def sleep(self, seconds, what="thao tác"):
+        """Ngủ có thể bị hủy, không vượt quá thời hạn"""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        if self.token.wait(seconds):
+            raise OperationCancelled(f"Đã hủy {what}")
+        self.check(what)
+
+
+def configure_logging():
+    """Cấu hình logging ra file trong logs/ và console"""
+    # Tạo folder logs nếu chưa có
+    os.makedirs("logs", exist_ok=True)
+    
+    # Cấu hình logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(f'logs/ai_generator_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log', encoding='utf-8'),
+            logging.StreamHandler()
+        ]
+    )
+    return logging.getLogger(__name__)
+
+
+def create_session_folder(data_dir="data"):
+    """Tạo folder session mới với timestamp, trả về (session_id, session_folder)"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    session_id = f"session_{timestamp}"
+    session_folder = os.path.join(data_dir, session_id)
+    
+    # Tạo folder structure
+    os.makedirs(session_folder, exist_ok=True)
+    os.makedirs(os.path.join(session_folder, "images"), exist_ok=True)
+    os.makedirs(os.path.join(session_folder, "videos"), exist_ok=True)
+    os.makedirs(os.path.join(session_folder, "audio"), exist_ok=True)
+    
+    # Tạo session info
+    session_info = {
+        "session_id": session_id,
+        "created_at": datetime.now().isoformat(),
+        "api_calls": 0
+    }
+    
+    with open(os.path.join(session_folder, "session_info.json"), "w", encoding="utf-8") as f:
+        json.dump(session_info, f, ensure_ascii=False, indent=2)
+        
+    return session_id, session_folder
+
+
+CHAT_SYSTEM_PROMPT = "Bạn là một trợ lý ảo thân thiện, chuyên nghiệp, nói tiếng Việt tự nhiên."
+# Số message mỗi trang khi mở lại session / cuộn lên xem lịch sử cũ
+CHAT_HISTORY_PAGE_SIZE = 50
+# Số message tối đa giữ trong khung chat; vượt quá thì bỏ bớt phía xa vị trí đang xem
+CHAT_DISPLAY_MAX_MESSAGES = 200
+SESSION_ARTIFACT_PAGE_SIZE = 100
+
+
+class ChatHistoryStore:
+    """Lịch sử chat của session dạng JSON Lines (mỗi dòng một message, chỉ append).
+
+    Khi mở chỉ quét vị trí xuống dòng để lập bảng offset, không parse JSON, nên đọc một trang bất kỳ
+    chỉ tốn một lần seek. File chat_history.json kiểu cũ được chuyển đổi một lần khi mở (chỉ khi chưa có
+    file .jsonl) rồi đổi tên thành chat_history.json.bak, không xóa."""
+
+    FILENAME = "chat_history.jsonl"
+    LEGACY_FILENAME = "chat_history.json"
+
+    def __init__(self, session_folder):
+        self.path = os.path.join(session_folder, self.FILENAME)
+        self.lock = threading.Lock()
+        legacy_path = os.path.join(session_folder, self.LEGACY_FILENAME)
+        if not os.path.exists(self.path) and os.path.exists(legacy_path):
+            self._migrate_legacy(legacy_path)
+        self.offsets = array.array("Q")
+        self.size = 0
+        self._scan()
+
+    def _migrate_legacy(self, legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            history = json.load(f)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            for message in history:
+                f.write(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+        os.replace(temp_path, self.path)
+        # Giữ bản gốc để có thể quay lại phiên bản cũ; đổi tên để không bị đọc/index trùng với .jsonl
+        os.replace(legacy_path, f"{legacy_path}.bak")
+
+    def _scan(self):
+        """Lập bảng offset đầu mỗi dòng; dòng cuối ghi dở (ví dụ do crash) bị cắt bỏ"""
+        if not os.path.exists(self.path):
+            return
+        line_start = position = 0
+        with open(self.path, "rb") as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk:
+                    break
+                newline = chunk.find(b"\n")
+                while newline != -1:
+                    self.offsets.append(line_start)
+                    line_start = position + newline + 1
+                    newline = chunk.find(b"\n", newline + 1)
+                position += len(chunk)
+        self.size = line_start
+        if position > line_start:
+            with open(self.path, "r+b") as f:
+                f.truncate(line_start)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, messages):
+        """Ghi thêm các message vào cuối file"""
+        with self.lock, open(self.path, "ab") as f:
+            for message in messages:
+                line = json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n"
+                f.write(line)
+                self.offsets.append(self.size)
+                self.size += len(line)
+
+    def read(self, start, end):
+        """Đọc các message có chỉ số trong [start, end)"""
+        with self.lock:
+            start, end = max(0, start), min(end, len(self.offsets))
+            if start >= end:
+                return []
+            begin = self.offsets[start]
+            stop = self.offsets[end] if end < len(self.offsets) else self.size
+            with open(self.path, "rb") as f:
+                f.seek(begin)
+                data = f.read(stop - begin)
+        return [json.loads(line) for line in data.splitlines()]
+
+
+def list_sessions(data_dir="data"):
+    """Danh sách session trong data_dir, mới nhất trước (chỉ đọc session_info.json)"""
+    sessions = []
+    if not os.path.isdir(data_dir):
+        return sessions
+    for entry in os.scandir(data_dir):
+        if not (entry.is_dir() and entry.name.startswith("session_")):
+            continue
+        info = {"session_id": entry.name}
+        try:
+            with open(os.path.join(entry.path, "session_info.json"), "r", encoding="utf-8") as f:
+                info.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        info["path"] = entry.path
+        sessions.append(info)
+    sessions.sort(key=lambda s: s.get("created_at") or s["session_id"], reverse=True)
+    return sessions
+
+
+def list_session_artifacts(session_folder):
+    """Các file ảnh/video/audio của session, mới nhất trước. Chỉ stat, không đọc metadata"""
+    artifacts = []
+    for folder in ("images", "videos", "audio"):
+        path = os.path.join(session_folder, folder)
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            if entry.is_file() and not entry.name.endswith(".json"):
+                stat = entry.stat()
+                artifacts.append({"name": entry.name, "path": entry.path, "folder": folder,
+                                  "size": stat.st_size, "mtime": stat.st_mtime})
+    artifacts.sort(key=lambda a: a["mtime"], reverse=True)
+    return artifacts
+
+
+# Header/query chứa secret, không bao giờ ghi ra file recording
+REDACTED_HEADERS = {"authorization", "x-goog-api-key", "api-key", "x-api-key", "cookie", "set-cookie"}
+REDACTED_QUERY_PARAMS = {"key", "api_key", "access_token"}
+# Header không còn đúng sau khi body đã được giải nén khi ghi
+HOP_BY_HOP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+class HttpCapture:
+    """Ghi lại / phát lại mọi request HTTP của ứng dụng (requests và client OpenAI).
+    Body lớn được lưu thành blob riêng theo sha256, secret được che đi."""
+
+    INLINE_LIMIT = 4096
+
+    def __init__(self, directory, mode="record", time_scale=1.0):
+        self.directory = directory
+        self.mode = mode
+        self.time_scale = time_scale
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.log_path = os.path.join(directory, "exchanges.jsonl")
+        self.lock = threading.Lock()
+        self.exchanges = []
+        
+        if mode == "record":
+            os.makedirs(self.blob_dir, exist_ok=True)
+        else:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                self.exchanges = [json.loads(line) for line in f if line.strip()]
+            self.rewind()
+
+    @staticmethod
+    def _route(method, url):
+        return method.upper(), urlsplit(url).path
+
+    @staticmethod
+    def redact_url(url):
+        parts = urlsplit(url)
+        query = [
+            (key, "REDACTED" if key.lower() in REDACTED_QUERY_PARAMS else value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        ]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    @staticmethod
+    def redact_headers(headers):
+        return {
+            key: "REDACTED" if key.lower() in REDACTED_HEADERS else value
+            for key, value in headers.items()
+        }
+
+    def _store_body(self, body):
+        if body is None:
+            return None
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if len(body) <= self.INLINE_LIMIT:
+            try:
+                return {"text": body.decode("utf-8")}
+            except UnicodeDecodeError:
+                return {"base64": base64.b64encode(body).decode("ascii")}
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = os.path.join(self.blob_dir, digest)
+        if not os.path.exists(blob_path):
+            with open(blob_path, "wb") as f:
+                f.write(body)
+        return {"blob": digest, "size": len(body)}
+
+    def load_body(self, ref):
+        if not ref:
+            return b""
+        if "text" in ref:
+            return ref["text"].encode("utf-8")
+        if "base64" in ref:
+            return base64.b64decode(ref["base64"])
+        with open(os.path.join(self.blob_dir, ref["blob"]), "rb") as f:
+            return f.read()
+
+    def record(self, method, url, request_headers, request_body, status, response_headers, response_body, elapsed):
+        """Ghi một lượt request/response"""
+        exchange = {
+            "method": method.upper(),
+            "url": self.redact_url(url),
+            "request_headers": self.redact_headers(request_headers),
+            "request_body": self._store_body(request_body),
+            "status": status,
+            "response_headers": {
+                key: value for key, value in self.redact_headers(response_headers).items()
+                if key.lower() not in HOP_BY_HOP_HEADERS
+            },
+            "response_body": self._store_body(response_body),
+            "elapsed": round(elapsed, 4),
+            "recorded_at": datetime.now().isoformat()
+        }
+        with self.lock:
+            self.exchanges.append(exchange)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(exchange, ensure_ascii=False) + "\n")
+
+    def rewind(self):
+        """Phát lại từ đầu: mỗi route trả các response theo đúng thứ tự đã ghi"""
+        with self.lock:
+            self.queues = {}
+            for exchange in self.exchanges:
+                route = self._route(exchange["method"], exchange["url"])
+                self.queues.setdefault(route, deque()).append(exchange)
+            self.last = {}
+
+    def lookup(self, method, url):
+        """Lấy response đã ghi cho request; hết hàng đợi thì lặp lại response cuối (vd. polling)"""
+        route = self._route(method, url)
+        with self.lock:
+            pending = self.queues.get(route)
+            if pending:
+                exchange = pending.popleft()
+                self.last[route] = exchange
+                return exchange
+            if route in self.last:
+                return self.last[route]
+        raise GenerationError(f"Không có response đã ghi cho {route[0]} {route[1]}")
+
+    def wait(self, exchange):
+        """Giả lập độ trễ đã ghi (nhân với time_scale)"""
+        if self.time_scale > 0:
+            time.sleep(exchange["elapsed"] * self.time_scale)
+
+    def install(self, session):
+        """Gắn adapter ghi/phát lại vào một requests.Session"""
+        adapter = CaptureAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def httpx_client(self):
+        """httpx.Client cho OpenAI(http_client=...) đi qua recording"""
+        if httpx is None:
+            raise RuntimeError("Cần httpx (đi kèm openai) để ghi/phát lại chat")
+        capture = self
+        
+        class CaptureTransport(httpx.BaseTransport):
+            def __init__(self):
+                self.inner = httpx.HTTPTransport() if capture.mode == "record" else None
+                
+            def handle_request(self, request):
+                if capture.mode == "replay":
+                    exchange = capture.lookup(request.method, str(request.url))
+                    capture.wait(exchange)
+                    return httpx.Response(exchange["status"], headers=exchange["response_headers"],
+                                          content=capture.load_body(exchange["response_body"]), request=request)
+                    
+                start_time = time.monotonic()
+                response = self.inner.handle_request(request)
+                content = response.read()
+                response.close()
+                capture.record(request.method, str(request.url), dict(request.headers), request.read(),
+                               response.status_code, dict(response.headers), content, time.monotonic() - start_time)
+                headers = {k: v for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+                return httpx.Response(response.status_code, headers=headers, content=content, request=request)
+                
+            def close(self):
+                if self.inner is not None:
+                    self.inner.close()
+                    
+        return httpx.Client(transport=CaptureTransport())
+
+
+class CaptureAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter của requests dùng cho HttpCapture"""
+
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.capture.mode == "replay":
+            exchange = self.capture.lookup(request.method, request.url)
+            self.capture.wait(exchange)
+            body = self.capture.load_body(exchange["response_body"])
+            
+            response = requests.Response()
+            response.status_code = exchange["status"]
+            response.headers = requests.structures.CaseInsensitiveDict(exchange["response_headers"])
+            response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            response.raw = io.BytesIO(body)
+            response._content = body
+            response._content_consumed = True
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            return response
+            
+        start_time = time.monotonic()
+        response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        content = response.content  # Đọc hết body để ghi lại
+        self.capture.record(request.method, request.url, dict(request.headers), request.body,
+                            response.status_code, dict(response.headers), content, time.monotonic() - start_time)
+        return response
+
+
+# Ảnh đầu vào từ kích thước này trở lên được upload một lần qua Files API thay vì gửi inline
+FILE_UPLOAD_MIN_BYTES = 256 * 1024
+# File trên Gemini hết hạn sau 48 giờ; bỏ dùng sớm hơn một chút để tránh hết hạn giữa request
+FILE_REFERENCE_TTL = 48 * 3600
+FILE_REFERENCE_MARGIN = 10 * 60
+
+
+class FileReferenceCache:
+    """Cache file đã upload lên Gemini Files API, key theo sha256 nội dung ảnh.
+    Lưu ra file JSON (nếu có path) để dùng lại giữa các lần chạy cho tới khi hết hạn."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    @staticmethod
+    def _key(owner, content_hash):
+        return f"{owner}:{content_hash}"
+
+    def get(self, owner, content_hash):
+        """Trả về entry còn hạn hoặc None"""
+        with self.lock:
+            entry = self.entries.get(self._key(owner, content_hash))
+            if entry and entry["expires_at"] - FILE_REFERENCE_MARGIN > time.time():
+                return entry
+            return None
+
+    def put(self, owner, content_hash, entry):
+        with self.lock:
+            now = time.time()
+            self.entries = {k: v for k, v in self.entries.items() if v["expires_at"] > now}
+            self.entries[self._key(owner, content_hash)] = entry
+            self._save()
+
+    def invalidate(self, owner, content_hash):
+        with self.lock:
+            if self.entries.pop(self._key(owner, content_hash), None) is not None:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def parse_expiration_time(value):
+    """Đổi expirationTime (RFC 3339, có thể tới nano giây) của Files API sang epoch"""
+    try:
+        match = re.match(r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:\d{2})?$", value)
+        base = datetime.fromisoformat(match.group(1) + (match.group(3) or "Z").replace("Z", "+00:00"))
+        return base.timestamp() + float("0." + (match.group(2) or "0"))
+    except (AttributeError, TypeError, ValueError):
+        return time.time() + FILE_REFERENCE_TTL
+
+
+def is_file_reference_error(response):
+    """Lỗi cho thấy file tham chiếu không còn dùng được (hết hạn, bị xóa, không thuộc key này).
+    Lỗi 400 khác (safety, prompt...) không liên quan tới file nên không được coi là lỗi file"""
+    if response.status_code == 404:
+        return True
+    if response.status_code in (400, 403):
+        return "file" in response.text.lower()
+    return False
+
+
+# Registry model theo nhiệm vụ, model đầu tiên là mặc định.
+# quality: điểm chất lượng tương đối; latency_hint: độ trễ ước lượng (giây) khi chưa có số liệu thực
+MODEL_REGISTRY = {
+    "chat": [
+        {"name": "gemini-2.5-flash", "quality": 2, "latency_hint": 4.0},
+        {"name": "gemini-2.5-pro", "quality": 3, "latency_hint": 12.0},
+        {"name": "gemini-2.5-flash-lite", "quality": 1, "latency_hint": 1.5},
+    ],
+    "text_to_image": [
+        {"name": "gemini-2.5-flash-image-preview", "quality": 2, "latency_hint": 12.0},
+        {"name": "imagen-4", "quality": 1, "latency_hint": 10.0},
+    ],
+    "image_edit": [
+        {"name": "gemini-2.5-flash-image-preview", "quality": 2, "latency_hint": 15.0},
+    ],
+    "video": [
+        {"name": "veo-3.0-generate-001", "quality": 2, "latency_hint": 120.0},
+        {"name": "veo-3.0-fast-generate-001", "quality": 1, "latency_hint": 60.0},
+    ],
+    "tts": [
+        {"name": "gemini-2.5-flash-preview-tts", "quality": 2, "latency_hint": 8.0},
+        {"name": "gemini-2.5-pro-preview-tts", "quality": 3, "latency_hint": 20.0},
+    ],
+}
+# Các model chat có thể dùng cho hedging / fan-out
+CHAT_MODEL_CHOICES = [entry["name"] for entry in MODEL_REGISTRY["chat"]]
+# Ngân sách độ trễ (giây) cho request "interactive"; "batch" luôn chọn model chất lượng cao nhất còn khỏe
+INTERACTIVE_LATENCY_BUDGET = {"chat": 8.0, "text_to_image": 30.0, "image_edit": 30.0, "video": 180.0, "tts": 20.0}
+# Mỗi chừng này ký tự prompt ước lượng làm độ trễ tăng thêm một lần
+PROMPT_CHARS_PER_LATENCY_DOUBLING = 20000
+OVERLOAD_STATUS_CODES = (429, 500, 503, 529)
+OVERLOAD_COOLDOWN = 30
+
+
+def default_model(task):
+    """Model mặc định của một nhiệm vụ trong registry"""
+    return MODEL_REGISTRY[task][0]["name"]
+
+
+def is_overload_error(error):
+    """Lỗi quá tải/tạm thời phía server - nên chuyển sang model khác"""
+    status = getattr(error, "status_code", None)
+    if status in OVERLOAD_STATUS_CODES:
+        return True
+    message = str(error)
+    return any(marker in message for marker in ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "overloaded"))
+
+
+class ModelRouter:
+    """Chọn model cho từng request theo độ dài prompt, lớp độ trễ và thống kê độ trễ/lỗi gần đây.
+    Model bị quá tải được tạm bỏ qua và request tự chuyển sang model dự phòng."""
+
+    def __init__(self, registry=None, logger=None):
+        self.registry = registry or MODEL_REGISTRY
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.outcomes = {}
+        self.cooldown_until = {}
+
+    def _stats(self, model):
+        if model not in self.latencies:
+            self.latencies[model] = LatencyTracker(window=50, min_samples=3)
+            self.outcomes[model] = deque(maxlen=10)
+        return self.latencies[model], self.outcomes[model]
+
+    def record(self, model, latency, error=None):
+        """Ghi nhận kết quả một request để cập nhật thống kê của model"""
+        with self.lock:
+            latencies, outcomes = self._stats(model)
+            outcomes.append(error is None)
+            if error is None:
+                latencies.record(latency)
+            elif is_overload_error(error):
+                self.cooldown_until[model] = time.monotonic() + OVERLOAD_COOLDOWN
+
+    def stats(self, model):
+        """Thống kê hiện tại: p50/p95 (None nếu chưa đủ mẫu), tỷ lệ lỗi, còn bị tạm bỏ qua hay không"""
+        with self.lock:
+            latencies, outcomes = self._stats(model)
+            error_rate = (1 - sum(outcomes) / len(outcomes)) if outcomes else 0.0
+            cooling = self.cooldown_until.get(model, 0) > time.monotonic()
+        return {
+            "p50": latencies.percentile(50),
+            "p95": latencies.percentile(95),
+            "error_rate": round(error_rate, 3),
+            "cooling_down": cooling
+        }
+
+    def route(self, task, latency_class="interactive", prompt_chars=0, exclude=()):
+        """Quyết định model cho request; trả về dict mô tả quyết định (dùng để ghi metadata)"""
+        size_factor = 1 + prompt_chars / PROMPT_CHARS_PER_LATENCY_DOUBLING
+        healthy, degraded = [], []
+        for entry in self.registry[task]:
+            if entry["name"] in exclude:
+                continue
+            stats = self.stats(entry["name"])
+            expected = (stats["p50"] if stats["p50"] is not None else entry["latency_hint"]) * size_factor
+            candidate = {"model": entry["name"], "quality": entry["quality"], "expected_latency": round(expected, 2)}
+            if stats["cooling_down"] or stats["error_rate"] > 0.5:
+                degraded.append(candidate)
+            else:
+                healthy.append(candidate)
+        if not healthy and not degraded:
+            raise GenerationError(f"Không còn model nào cho {task}")
+            
+        if latency_class == "batch":
+            ordered = sorted(healthy, key=lambda c: -c["quality"])
+            reason = "batch: chất lượng cao nhất"
+        else:
+            budget = INTERACTIVE_LATENCY_BUDGET.get(task, 10.0)
+            within = sorted((c for c in healthy if c["expected_latency"] <= budget), key=lambda c: -c["quality"])
+            rest = sorted((c for c in healthy if c["expected_latency"] > budget), key=lambda c: c["expected_latency"])
+            ordered = within + rest
+            reason = f"interactive: chất lượng cao nhất trong ngân sách {budget:.0f}s" if within else \
+                     f"interactive: không model nào trong ngân sách {budget:.0f}s, chọn nhanh nhất"
+        if not ordered:
+            reason = "mọi model đang quá tải/lỗi, thử model ước lượng nhanh nhất"
+        ordered += sorted(degraded, key=lambda c: c["expected_latency"])
+        
+        return {
+            "task": task,
+            "latency_class": latency_class,
+            "prompt_chars": prompt_chars,
+            "model": ordered[0]["model"],
+            "expected_latency": ordered[0]["expected_latency"],
+            "reason": reason,
+            "fallbacks": [c["model"] for c in ordered[1:]]
+        }
+
+    def call(self, task, fn, latency_class="interactive", prompt_chars=0):
+        """Gọi fn(model) với model được chọn; nếu model quá tải thì tự chuyển sang model dự phòng.
+        Trả về (kết quả, quyết định định tuyến kèm danh sách các lần thử)"""
+        decision = self.route(task, latency_class, prompt_chars)
+        decision["initial_model"] = decision["model"]
+        decision["attempts"] = []
+        for model in [decision["model"]] + decision["fallbacks"]:
+            start_time = time.monotonic()
+            try:
+                result = fn(model)
+            except Exception as e:
+                elapsed = time.monotonic() - start_time
+                self.record(model, elapsed, e)
+                decision["attempts"].append({"model": model, "latency": round(elapsed, 3), "error": str(e)[:200]})
+                if not is_overload_error(e):
+                    raise
+                self.logger.warning(f"Model {model} quá tải ({str(e)[:80]}), chuyển sang model dự phòng")
+                continue
+            elapsed = time.monotonic() - start_time
+            self.record(model, elapsed)
+            decision["attempts"].append({"model": model, "latency": round(elapsed, 3), "error": None})
+            decision["model"] = model
+            self.logger.info(f"Định tuyến {task}: {model} ({decision['reason']}, {elapsed:.2f}s)")
+            return result, decision
+        raise GenerationError(f"Mọi model cho {task} đều quá tải: " + 
+                              ", ".join(a["model"] for a in decision["attempts"]), status_code=503)
+
+
+class GenerationEngine:
+    """Các lời gọi API Gemini/Veo không phụ thuộc giao diện (dùng chung cho GUI và CLI)"""
+
+    def __init__(self, api_key, logger=None, capture=None, file_refs=None, pool_size=10, postprocessor=None):
+        self.api_key = api_key
+        self.logger = logger or logging.getLogger(__name__)
+        self.http = requests.Session()
+        self.http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        if capture:
+            capture.install(self.http)
+            
+        self.router = ModelRouter(logger=self.logger)
+        
+        # File đã upload lên Files API, dùng lại thay cho base64 inline
+        self.file_refs = file_refs or FileReferenceCache()
+        self.file_owner = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        
+        # Cache ảnh đầu vào đã đọc/encode sẵn, key theo (path, mtime, size)
+        self.prepared_inputs = OrderedDict()
+        self.prepared_lock = threading.Lock()
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=2)
+        self.last_warm_up = 0
+        
+        # Decode/kiểm tra/hash ảnh chạy trong process pool để không giữ GIL của các thread network
+        self.postprocessor = postprocessor or PostProcessor(logger=self.logger)
+
+    def _prepare_image(self, image_path):
+        """Đọc, kiểm tra và encode base64 ảnh đầu vào"""
+        start_time = time.time()
+        info = self.postprocessor.inspect(image_path)
+        with open(image_path, "rb") as f:
+            raw = f.read()
+            
+        # Sử dụng mimetypes như trong notebook, ưu tiên định dạng thật của ảnh
+        mime_type = Image.MIME.get(info["format"]) or mimetypes.guess_type(image_path)[0] or "image/png"
+        prepared = {
+            "b64": base64.b64encode(raw).decode("utf-8"),
+            "mime_type": mime_type,
+            "size": len(raw),
+            "sha256": info["sha256"],
+            "dhash": info["dhash"]
+        }
+        self.logger.info(f"Đã chuẩn bị ảnh {image_path} ({mime_type}, {len(raw)} bytes) trong {time.time() - start_time:.3f} giây")
+        return prepared
+
+    def _prepared_key(self, image_path):
+        stat = os.stat(image_path)
+        return (os.path.abspath(image_path), stat.st_mtime, stat.st_size)
+
+    def prefetch_image(self, image_path):
+        """Bắt đầu chuẩn bị ảnh trong nền ngay khi người dùng chọn file"""
+        try:
+            key = self._prepared_key(image_path)
+        except OSError:
+            return None
+        with self.prepared_lock:
+            future = self.prepared_inputs.get(key)
+            if future is None:
+                future = self.prefetch_pool.submit(self._prepare_image, image_path)
+                self.prepared_inputs[key] = future
+                # Giữ cache nhỏ: bỏ các ảnh cũ nhất
+                while len(self.prepared_inputs) > 8:
+                    self.prepared_inputs.popitem(last=False)
+            else:
+                self.prepared_inputs.move_to_end(key)
+        return future
+
+    def get_prepared_image(self, image_path):
+        """Lấy ảnh đã chuẩn bị (chờ prefetch nếu đang chạy); file đổi mtime thì chuẩn bị lại"""
+        future = self.prefetch_image(image_path)
+        if future is None:
+            raise GenerationError(f"Không đọc được ảnh đầu vào: {image_path}")
+        try:
+            return future.result()
+        except Exception as e:
+            with self.prepared_lock:
+                self.prepared_inputs.pop(self._prepared_key(image_path), None)
+            raise GenerationError(f"Ảnh đầu vào không hợp lệ: {str(e)}")
+
+    def warm_up(self, min_interval=30):
+        """Mở sẵn kết nối tới API trong nền để request thật không phải chờ TCP/TLS handshake"""
+        now = time.monotonic()
+        if now - self.last_warm_up < min_interval:
+            return
+        self.last_warm_up = now
+        
+        def connect():
+            try:
+                self.http.head(API_BASE_URL, timeout=(CONNECT_TIMEOUT, CONNECT_TIMEOUT))
+                self.logger.info("Đã mở sẵn kết nối tới API")
+            except requests.RequestException as e:
+                self.logger.warning(f"Không thể mở sẵn kết nối: {str(e)}")
+                
+        self.prefetch_pool.submit(connect)
+
+    def _request(self, method, url, deadline, what, **kwargs):
+        """Gửi request với timeout theo deadline; hủy giữa chừng sẽ đóng kết nối ngay"""
+        try:
+            response = self.http.request(method, url, timeout=deadline.timeout(what), stream=True, **kwargs)
+        except requests.Timeout as e:
+            raise DeadlineExceeded(f"Hết thời gian chờ phản hồi ({what}): {str(e)}")
+            
+        deadline.token.add_callback(response.close)
+        try:
+            deadline.check(what)
+            response.content  # Đọc body, có thể bị cắt ngang bởi cancel()
+        except GenerationError:
+            response.close()
+            raise
+        except Exception as e:
+            response.close()
+            if deadline.token.cancelled:
+                raise OperationCancelled(f"Đã hủy {what}")
+            if isinstance(e, (requests.Timeout, requests.exceptions.ConnectionError)):
+                raise DeadlineExceeded(f"Hết thời gian đọc phản hồi ({what}): {str(e)}")
+            raise
+        finally:
+            deadline.token.remove_callback(response.close)
+        return response
+
+    def upload_file(self, raw, mime_type, display_name, deadline):
+        """Upload qua Files API (resumable: start rồi upload, finalize), trả về metadata file"""
+        start_response = self._request(
+            "POST",
+            f"{API_BASE_URL}/gemini/upload/v1beta/files",
+            deadline,
+            "upload file",
+            headers={
+                "x-goog-api-key": self.api_key,
+                "X-Goog-Upload-Protocol": "resumable",
+                "X-Goog-Upload-Command": "start",
+                "X-Goog-Upload-Header-Content-Length": str(len(raw)),
+                "X-Goog-Upload-Header-Content-Type": mime_type,
+                "Content-Type": "application/json"
+            },
+            json={"file": {"display_name": display_name}}
+        )
+        upload_url = start_response.headers.get("x-goog-upload-url")
+        if start_response.status_code != 200 or not upload_url:
+            raise GenerationError(f"Không thể bắt đầu upload: {start_response.status_code} - {start_response.text}")
+            
+        response = self._request(
+            "POST",
+            upload_url,
+            deadline,
+            "upload file",
+            headers={
+                "x-goog-api-key": self.api_key,
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize"
+            },
+            data=raw
+        )
+        if response.status_code != 200:
+            raise GenerationError(f"Upload thất bại: {response.status_code} - {response.text}")
+        file_info = response.json().get("file", {})
+        if not file_info.get("uri") or file_info.get("state") == "FAILED":
+            raise GenerationError(f"Files API không trả về file hợp lệ: {response.text}")
+        return file_info
+
+    def get_file_reference(self, prepared, deadline):
+        """URI của ảnh trên Files API (upload lần đầu, dùng lại khi còn hạn).
+        Trả về None nếu ảnh nhỏ hoặc upload lỗi - khi đó gửi inline như cũ."""
+        if prepared["size"] < FILE_UPLOAD_MIN_BYTES:
+            return None
+        entry = self.file_refs.get(self.file_owner, prepared["sha256"])
+        if entry:
+            self.logger.info(f"Dùng lại file đã upload: {entry['name']}")
+            return entry["uri"]
+            
+        try:
+            start_time = time.time()
+            file_info = self.upload_file(base64.b64decode(prepared["b64"]), prepared["mime_type"],
+                                         prepared["sha256"][:16], deadline)
+        except (OperationCancelled, DeadlineExceeded):
+            raise
+        except (GenerationError, requests.RequestException, ValueError) as e:
+            self.logger.warning(f"Upload ảnh thất bại, gửi inline: {str(e)}")
+            return None
+            
+        self.file_refs.put(self.file_owner, prepared["sha256"], {
+            "name": file_info.get("name"),
+            "uri": file_info["uri"],
+            "mime_type": file_info.get("mimeType", prepared["mime_type"]),
+            "expires_at": parse_expiration_time(file_info.get("expirationTime"))
+        })
+        self.logger.info(f"Đã upload ảnh {prepared['size']} bytes thành {file_info.get('name')} "
+                         f"trong {time.time() - start_time:.2f} giây")
+        return file_info["uri"]
+
+    def edit_image(self, prompt, image_path, deadline=None, model=None, output_path=None, thumbnail=False):
+        """Image-to-image: trả về bytes của ảnh mới. Nếu có output_path thì decode và ghi file trong
+        process pool hậu kỳ (kèm thumbnail preview nếu thumbnail=True), trả về metadata của ảnh
+        (xem PostProcessor.process_image)"""
+        deadline = deadline or Deadline(total=IMAGE_TOTAL_BUDGET)
+        model = model or default_model("image_edit")
+        # Read and encode image (thường đã được prefetch khi chọn file)
+        prepared = self.get_prepared_image(image_path)
+        image_b64 = prepared["b64"]
+            
+        self.logger.info(f"Đã encode ảnh, kích thước base64: {len(image_b64)} characters")
+        file_uri = self.get_file_reference(prepared, deadline)
+            
+        # Call Gemini API for image-to-image
+        self.logger.info("Đang gọi Gemini API cho image-to-image...")
+        start_time = time.time()
+        
+        headers = {
+            "x-goog-api-key": self.api_key,
+            "Content-Type": "application/json"
+        }
+        
+        while True:
+            if file_uri:
+                image_part = {"file_data": {"mime_type": prepared["mime_type"], "file_uri": file_uri}}
+            else:
+                image_part = {"inline_data": {"mime_type": prepared["mime_type"], "data": image_b64}}
+                
+            payload = {
+                "contents": [{
+                    "parts": [
+                        {
+                            "text": (
+                                f"Here is an image. Please generate a new version "
+                                f"based on this image with the following modification: {prompt}. "
+                                f"The new image should reflect this change realistically."
+                            )
+                        },
+                        image_part
+                    ]
+                }],
+                "generationConfig": {
+                    "imageConfig": {
+                        "aspectRatio": "1:1"
+                    }
+                }
+            }
+            
+            self.logger.info("Đang gửi request đến Gemini API...")
+            response = self._request(
+                "POST",
+                f"{API_BASE_URL}/gemini/v1beta/models/{model}:generateContent",
+                deadline,
+                "image-to-image",
+                headers=headers,
+                json=payload
+            )
+            if file_uri and is_file_reference_error(response):
+                # File hết hạn/bị xóa hoặc không được chấp nhận: bỏ cache và gửi lại inline
+                self.logger.warning(f"File tham chiếu bị từ chối ({response.status_code}), gửi lại inline")
+                self.file_refs.invalidate(self.file_owner, prepared["sha256"])
+                file_uri = None
+                continue
+            break
+        
+        end_time = time.time()
+        self.logger.info(f"Gemini API hoàn thành trong {end_time - start_time:.2f} giây")
+        
+        if response.status_code != 200:
+            self.logger.error(f"API error: {response.status_code} - {response.text}")
+            raise GenerationError(f"API error: {response.status_code} - {response.text}", status_code=response.status_code)
+            
+        data = response.json()
+        self.logger.info("Đã nhận được phản hồi từ Gemini API")
+        
+        # Extract image data - xử lý như trong notebook
+        try:
+            parts = data["candidates"][0]["content"]["parts"]
+            img_b64 = None
+            for p in parts:
+                if "inline_data" in p:
+                    img_b64 = p["inline_data"]["data"]
+                elif "inlineData" in p:
+                    img_b64 = p["inlineData"]["data"]
+        except Exception as e:
+            self.logger.error(f"Lỗi khi xử lý phản hồi API: {str(e)}")
+            raise GenerationError(f"Lỗi khi xử lý phản hồi API: {str(e)}\n{json.dumps(data, indent=2)}")
+            
+        if not img_b64:
+            self.logger.error("Gemini không trả về dữ liệu ảnh")
+            raise GenerationError(f"Gemini không trả về dữ liệu ảnh. Phản hồi API:\n{json.dumps(data, indent=2)}")
+            
+        self.logger.info(f"Đã trích xuất dữ liệu ảnh, kích thước: {len(img_b64)} characters")
+        
+        if output_path:
+            return self.postprocessor.process_image(img_b64, output_path, thumbnail=thumbnail)
+        img_data = base64.b64decode(img_b64)
+        self.logger.info(f"Đã decode ảnh, kích thước: {len(img_data)} bytes")
+        return img_data
+
+    def create_video(self, prompt, image_path=None, aspect_ratio="16:9", resolution="720p", deadline=None, model=None):
+        """Tạo request video - theo đúng notebook, trả về operation name"""
+        return self.create_video_batch([{"prompt": prompt, "image_path": image_path}],
+                                       aspect_ratio=aspect_ratio, resolution=resolution, deadline=deadline, model=model)
+
+    def create_video_batch(self, items, aspect_ratio="16:9", resolution="720p", sample_count=1, deadline=None, 
+                           model=None):
+        """Gửi nhiều prompt/ảnh trong một request predictLongRunning, trả về operation name.
+        items là danh sách {"prompt", "image_path"}; sample_count là số video cho mỗi instance."""
+        deadline = deadline or Deadline(total=VIDEO_TOTAL_BUDGET)
+        model = model or default_model("video")
+        self.logger.info(f"Đang tạo request video ({len(items)} instance, {sample_count} mẫu/instance, {model})...")
+        url = f"{API_BASE_URL}/gemini/v1beta/models/{model}:predictLongRunning"
+        
+        instances = []
+        has_image = False
+        for item in items:
+            prompt = item["prompt"]
+            image_path = item.get("image_path")
+            
+            # Check if image is provided - theo đúng logic notebook
+            image_obj = None
+            if image_path and os.path.exists(image_path):
+                self.logger.info(f"Sử dụng ảnh đầu vào: {image_path}")
+                prepared = self.get_prepared_image(image_path)
+                img_b64 = prepared["b64"]
+                mime_type = prepared["mime_type"]
+                    
+                image_obj = {
+                    "bytesBase64Encoded": img_b64,
+                    "mimeType": mime_type
+                }
+                # Veo chỉ nhận ảnh bytesBase64Encoded/gcsUri, không nhận uri của Files API nên luôn gửi inline
+                self.logger.info(f"Đã encode ảnh, kích thước: {len(img_b64)} characters, mime_type: {mime_type}")
+            else:
+                self.logger.info("Không có ảnh đầu vào, tạo video từ text")
+                
+            instance = {"prompt": prompt}
+            if image_obj:
+                instance["image"] = image_obj
+                has_image = True
+            instances.append(instance)
+            
+            self.logger.info(f"Tạo video với prompt: {prompt}")
+            print(f"\nTao video voi prompt: {prompt}")
+            if image_obj:
+                self.logger.info(f"Sử dụng ảnh làm đầu vào: {image_path}")
+                print(f"Su dung anh lam dau vao: {image_path}")
+            
+        payload = {
+            "instances": instances,
+            "parameters": {
+                "negativePrompt": "blurry, low quality",
+                "aspectRatio": aspect_ratio,
+                "resolution": resolution,
+                "personGeneration": "allow_all" if not has_image else "allow_adult"
+            }
+        }
+        if sample_count > 1:
+            payload["parameters"]["sampleCount"] = sample_count
+        
+        self.logger.info(f"Payload video: aspect_ratio={aspect_ratio}, resolution={resolution}, sample_count={sample_count}")
+        
+        headers = {
+            "Content-Type": "application/json",
+            "x-goog-api-key": self.api_key
+        }
+        
+        self.logger.info("Đang gửi request tạo video...")
+        start_time = time.time()
+        response = self._request("POST", url, deadline, "tạo video", headers=headers, json=payload)
+        end_time = time.time()
+        
+        self.logger.info(f"Request video hoàn thành trong {end_time - start_time:.2f} giây")
+        
+        if response.status_code != 200:
+            self.logger.error(f"Lỗi tạo video: {response.status_code} - {response.text}")
+            raise GenerationError(f"Lỗi tạo video: {response.status_code}", status_code=response.status_code)
+            
+        data = response.json()
+        operation_name = data.get("name")
+        if not operation_name:
+            self.logger.error("Không tìm thấy operation_name trong phản hồi")
+            self.logger.error(f"Phản hồi API: {json.dumps(data, indent=2)}")
+            raise GenerationError("Không tìm thấy operation_name trong phản hồi")
+            
+        self.logger.info("Đã gửi yêu cầu tạo video thành công")
+        self.logger.info(f"Mã tiến trình (operation): {operation_name}")
+        print(f"Da gui yeu cau tao video thanh cong.")
+        print(f"Ma tien trinh (operation): {operation_name}")
+        return operation_name
+
+    def wait_for_video(self, operation_name, poll_interval=60, on_progress=None, deadline=None, model=None):
+        """Kiểm tra tiến độ video - theo đúng notebook, trả về video ID của mẫu đầu tiên"""
+        samples = self.wait_for_videos(operation_name, poll_interval=poll_interval,
+                                       on_progress=on_progress, deadline=deadline, model=model)
+        return samples[0]["video_id"]
+
+    @staticmethod
+    def _extract_video_samples(data):
+        """Lấy mọi video trong phản hồi operation đã xong"""
+        samples = []
+        try:
+            generated = data["response"]["generateVideoResponse"]["generatedSamples"]
+        except (KeyError, TypeError):
+            generated = []
+        for index, sample in enumerate(generated):
+            uri = sample.get("video", {}).get("uri", "")
+            # Rút ID từ URI
+            if ":download" in uri:
+                samples.append({
+                    "sample_index": index,
+                    "video_id": uri.split("/")[-1].split(":")[0],
+                    "uri": uri
+                })
+                
+        if not samples:
+            # fallback cho cấu trúc cũ
+            try:
+                samples.append({"sample_index": 0, "video_id": data["response"]["video"]["name"], "uri": None})
+            except (KeyError, TypeError):
+                pass
+        return samples
+
+    def wait_for_videos(self, operation_name, poll_interval=60, on_progress=None, deadline=None, model=None):
+        """Kiểm tra tiến độ video, trả về danh sách mọi mẫu đã tạo (generatedSamples)"""
+        deadline = deadline or Deadline(total=VIDEO_TOTAL_BUDGET, max_poll_duration=VIDEO_MAX_POLL_DURATION)
+        self.logger.info(f"Bắt đầu kiểm tra tiến độ video: {operation_name}")
+        
+        # Xử lý URL như trong notebook
+        if operation_name.startswith("models/"):
+            url = f"{API_BASE_URL}/gemini/v1beta/{operation_name}"
+        else:
+            url = f"{API_BASE_URL}/gemini/v1beta/models/{model or default_model('video')}/operations/{operation_name}"
+            
+        headers = {"x-goog-api-key": self.api_key}
+        
+        self.logger.info("Đang kiểm tra tiến độ video...")
+        print("\nDang kiem tra tien do video...")
+        check_count = 0
+        poll_started = time.monotonic()
+        
+        while True:
+            check_count += 1
+            self.logger.info(f"Kiểm tra tiến độ lần {check_count}...")
+            
+            response = self._request("GET", url, deadline, "kiểm tra tiến độ video", headers=headers)
+            if response.status_code != 200:
+                self.logger.error(f"Lỗi khi kiểm tra tiến độ: {response.status_code} - {response.text}")
+                raise GenerationError(f"Lỗi khi kiểm tra tiến độ: {response.status_code}", 
+                                      status_code=response.status_code)
+                
+            data = response.json()
+            done = data.get("done", False)
+            
+            if done:
+                self.logger.info("Video đã hoàn thành!")
+                
+                # Extract video ID - theo đúng logic notebook
+                samples = self._extract_video_samples(data)
+                if not samples:
+                    self.logger.error("Không tìm thấy video_id trong phản hồi")
+                    self.logger.error(f"Phản hồi API: {json.dumps(data, indent=2)}")
+                    raise GenerationError("Không thể trích xuất video ID")
+                    
+                print(f"Video da hoan tat!")
+                for sample in samples:
+                    self.logger.info(f"Video ID [{sample['sample_index']}]: {sample['video_id']}")
+                    print(f"Video ID: {sample['video_id']}")
+                return samples
+            else:
+                progress = data.get("metadata", {}).get("progressPercent", "Đang xử lý")
+                self.logger.info(f"Tiến độ: {progress}% - chờ {poll_interval} giây trước khi kiểm tra lại...")
+                print(f"Tien do: {progress}% - cho {poll_interval} giay truoc khi kiem tra lai...")
+                if on_progress:
+                    on_progress(progress)
+                if deadline.max_poll_duration and time.monotonic() - poll_started + poll_interval > deadline.max_poll_duration:
+                    self.logger.error(f"Video chưa hoàn thành sau {deadline.max_poll_duration} giây, dừng chờ")
+                    raise DeadlineExceeded(f"Video chưa hoàn thành sau {deadline.max_poll_duration} giây")
+                deadline.sleep(poll_interval, "chờ video")  # Chờ 60 giây như trong notebook
+
+    def download_video(self, video_id, filepath, deadline=None):
+        """Tải video - theo đúng notebook, trả về kích thước file"""
+        deadline = deadline or Deadline(total=VIDEO_TOTAL_BUDGET)
+        self.logger.info(f"Bắt đầu tải video: {video_id}")
+        url = f"{API_BASE_URL}/gemini/download/v1beta/files/{video_id}:download?alt=media"
+        headers = {"x-goog-api-key": self.api_key}
+        
+        self.logger.info(f"Đang tải video về: {filepath}")
+        print(f"\nDang tai video ve: {filepath}")
+        start_time = time.time()
+        
+        try:
+            response = self.http.get(url, headers=headers, stream=True, timeout=deadline.timeout("tải video"))
+        except requests.Timeout as e:
+            raise DeadlineExceeded(f"Hết thời gian chờ phản hồi (tải video): {str(e)}")
+        if response.status_code != 200:
+            self.logger.error(f"Lỗi khi tải video: {response.status_code} - {response.text}")
+            response.close()
+            raise GenerationError(f"Lỗi khi tải video: {response.status_code}")
+            
+        total_size = 0
+        deadline.token.add_callback(response.close)
+        try:
+            with open(filepath, "wb") as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    deadline.check("tải video")
+                    if chunk:
+                        f.write(chunk)
+                        total_size += len(chunk)
+        except Exception as e:
+            # Xóa file tải dở
+            response.close()
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            self.logger.warning(f"Đã xóa file tải dở: {filepath}")
+            if deadline.token.cancelled:
+                raise OperationCancelled("Đã hủy tải video")
+            if isinstance(e, (requests.Timeout, requests.exceptions.ConnectionError)):
+                raise DeadlineExceeded(f"Hết thời gian tải video: {str(e)}")
+            raise
+        finally:
+            deadline.token.remove_callback(response.close)
+                    
+        end_time = time.time()
+        self.logger.info(f"Video đã được tải thành công: {filepath}")
+        self.logger.info(f"Đã tải video hoàn thành trong {end_time - start_time:.2f} giây, kích thước: {total_size} bytes")
+        print(f"Video da duoc tai thanh cong: {filepath}")
+        return total_size
+
+    def synthesize_speech(self, text, voice, deadline=None, model=None):
+        """Text-to-speech với Gemini API, trả về (audio bytes, mime type)"""
+        deadline = deadline or Deadline(total=TTS_TOTAL_BUDGET)
+        model = model or default_model("tts")
+        self.logger.info("Đang gọi Gemini API TTS...")
+        start_time = time.time()
+        
+        speech_config = {
+            "voiceConfig": {
+                "prebuiltVoiceConfig": {
+                    "voiceName": voice
+                }
+            }
+        }
+        audio_data, mime_type = self._tts_request(text, speech_config, deadline, model)
+        
+        end_time = time.time()
+        self.logger.info(f"API TTS hoàn thành trong {end_time - start_time:.2f} giây")
+        return audio_data, mime_type
+
+    def _tts_request(self, text, speech_config, deadline, model):
+        """Một request generateContent trả về audio, trả về (audio bytes, mime type)"""
+        # Gọi Gemini API theo đúng tài liệu
+        url = f"{API_BASE_URL}/gemini/v1beta/models/{model}:generateContent"
+        
+        headers = {
+            "x-goog-api-key": self.api_key,
+            "Content-Type": "application/json"
+        }
+        
+        payload = {
+            "contents": [{
+                "parts": [
+                    {"text": text}
+                ]
+            }],
+            "generationConfig": {
+                "responseModalities": ["AUDIO"],
+                "speechConfig": speech_config
+            }
+        }
+        
+        response = self._request("POST", url, deadline, "TTS", headers=headers, json=payload)
+        
+        if response.status_code != 200:
+            self.logger.error(f"API error: {response.status_code} - {response.text}")
+            raise GenerationError(f"API error: {response.status_code}", status_code=response.status_code)
+        
+        # Lấy audio data từ response theo cấu trúc Gemini
+        data = response.json()
+        inline_data = data["candidates"][0]["content"]["parts"][0]["inlineData"]
+        audio_data = base64.b64decode(inline_data["data"])
+        
+        self.logger.info(f"Đã decode audio, kích thước: {len(audio_data)} bytes")
+        return audio_data, inline_data.get("mimeType", "")
+
+    def synthesize_dialogue(self, lines, voices, deadline=None, model=None, 
+                            max_chunk_chars=None, max_workers=4):
+        """Đọc hội thoại nhiều người nói (multiSpeakerVoiceConfig). Script dài hoặc nhiều hơn 2 người nói
+        được chia đoạn và gửi song song, sau đó ghép thành một PCM liền mạch.
+        Trả về dict: pcm, sample_rate, channels, lines (kèm start/end), chunks."""
+        deadline = deadline or Deadline(total=TTS_TOTAL_BUDGET)
+        model = model or default_model("tts")
+        chunks = chunk_dialogue(lines, max_chars=max_chunk_chars or DIALOGUE_MAX_CHUNK_CHARS)
+        self.logger.info(f"TTS hội thoại: {len(lines)} câu, {len(chunks)} request")
+        start_time = time.time()
+        
+        def render(chunk):
+            speakers = chunk["speakers"]
+            if len(speakers) == 1:
+                text = "\n".join(line["text"] for line in chunk["lines"])
+                speech_config = {"voiceConfig": {"prebuiltVoiceConfig": {"voiceName": voices[speakers[0]]}}}
+            else:
+                text = f"TTS the following conversation between {' and '.join(speakers)}:\n" + \
+                       "\n".join(f"{line['speaker']}: {line['text']}" for line in chunk["lines"])
+                speech_config = {
+                    "multiSpeakerVoiceConfig": {
+                        "speakerVoiceConfigs": [
+                            {"speaker": speaker, "voiceConfig": {"prebuiltVoiceConfig": {"voiceName": voices[speaker]}}}
+                            for speaker in speakers
+                        ]
+                    }
+                }
+            return self._tts_request(text, speech_config, deadline, model)
+            
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+            results = list(pool.map(OperationProfiler.wrap(render), chunks))
+            
+        sample_rate = channels = None
+        parts, timeline, chunk_info, offset = [], [], [], 0.0
+        for chunk_index, (chunk, (audio_data, mime_type)) in enumerate(zip(chunks, results)):
+            encoding, rate, chunk_channels = parse_audio_mime(mime_type)
+            if encoding != "pcm16":
+                raise GenerationError(f"Không ghép được audio định dạng {mime_type}")
+            if sample_rate is None:
+                sample_rate, channels = rate, chunk_channels
+            elif (rate, chunk_channels) != (sample_rate, channels):
+                raise GenerationError(f"Các đoạn audio khác sample rate: {rate} != {sample_rate}")
+                
+            if parts:
+                gap = int(sample_rate * DIALOGUE_CHUNK_GAP_SECONDS) * channels * 2
+                parts.append(bytes(gap))
+                offset += DIALOGUE_CHUNK_GAP_SECONDS
+            timings = estimate_line_timings(audio_data, sample_rate, [len(line["text"]) for line in chunk["lines"]],
+                                            channels=channels)
+            for line, (start, end) in zip(chunk["lines"], timings):
+                timeline.append({
+                    "index": line["index"],
+                    "speaker": line["speaker"],
+                    "voice": voices[line["speaker"]],
+                    "text": line["text"],
+                    "start": round(offset + start, 3),
+                    "end": round(offset + end, 3),
+                    "chunk": chunk_index
+                })
+            duration = len(audio_data) / (2 * channels * sample_rate)
+            chunk_info.append({"speakers": chunk["speakers"], "lines": len(chunk["lines"]),
+                               "start": round(offset, 3), "end": round(offset + duration, 3)})
+            parts.append(audio_data)
+            offset += duration
+            
+        self.logger.info(f"TTS hội thoại hoàn thành trong {time.time() - start_time:.2f} giây, {offset:.1f} giây audio")
+        return {"pcm": b"".join(parts), "sample_rate": sample_rate, "channels": channels,
+                "lines": timeline, "chunks": chunk_info}
+
+
+class HotFolderWatcher:
+    """Theo dõi thư mục đầu vào, xử lý ảnh mới (kèm file prompt .txt) qua image-to-image hoặc image-to-video.
+    Dùng watchdog (inotify) nếu có, nếu không thì polling định kỳ.
+
+    Job lỗi được ghi vào ledger cùng số lần thử và thử lại với backoff lũy thừa; sau MAX_ATTEMPTS lần
+    ảnh (và file prompt) được chuyển vào failed/. Muốn thử lại thì xóa mục tương ứng trong ledger."""
+
+    IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+    LEDGER_NAME = ".hotfolder_processed.json"
+    FAILED_DIR = "failed"
+    MAX_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 30
+    RETRY_MAX_DELAY = 3600
+
+    def __init__(self, engine, input_dir, session_folder, mode="image", default_prompt=None,
+                 max_workers=2, poll_interval=2.0, video_options=None, logger=None):
+        self.engine = engine
+        self.input_dir = input_dir
+        self.session_folder = session_folder
+        self.mode = mode
+        self.default_prompt = default_prompt
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.video_options = video_options or {}
+        self.logger = logger or logging.getLogger(__name__)
+        
+        self.ledger_path = os.path.join(input_dir, self.LEDGER_NAME)
+        self.ledger = {}
+        if os.path.exists(self.ledger_path):
+            with open(self.ledger_path, "r", encoding="utf-8") as f:
+                self.ledger = json.load(f)
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.snapshots = {}
+        # sha256 của ảnh theo (mtime_ns, size): chỉ hash lại khi file thay đổi
+        self.digests = {}
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.cancel_token = CancellationToken()
+
+    def _read_prompt(self, image_path):
+        """Đọc prompt từ file sidecar <ảnh>.txt hoặc <tên>.txt"""
+        for candidate in (f"{image_path}.txt", os.path.splitext(image_path)[0] + ".txt"):
+            if os.path.exists(candidate):
+                with open(candidate, "r", encoding="utf-8") as f:
+                    prompt = f.read().strip()
+                if prompt:
+                    return prompt
+        return self.default_prompt
+
+    def _save_ledger(self):
+        tmp_path = f"{self.ledger_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.ledger, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.ledger_path)
+
+    def _content_hash(self, path, snapshot):
+        cached = self.digests.get(path)
+        if cached and cached[0] == snapshot:
+            return cached[1]
+        with open(path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        self.digests[path] = (snapshot, content_hash)
+        return content_hash
+
+    def _scan(self, executor):
+        """Tìm các ảnh mới đã ghi xong (mtime/size không đổi giữa hai lần quét) và đưa vào xử lý"""
+        current = {}
+        try:
+            for entry in os.scandir(self.input_dir):
+                try:
+                    if entry.is_file() and entry.name.lower().endswith(self.IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        current[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError as e:
+                    self.logger.warning(f"[hot-folder] Bỏ qua {entry.path}: {str(e)}")
+        except OSError as e:
+            self.logger.error(f"[hot-folder] Không đọc được thư mục {self.input_dir}: {str(e)}")
+            return
+                
+        now = time.time()
+        for path, snapshot in current.items():
+            if self.snapshots.get(path) != snapshot:
+                continue  # File mới hoặc đang được ghi, chờ lần quét sau
+            try:
+                prompt = self._read_prompt(path)
+                if not prompt:
+                    continue  # Chờ file prompt
+                content_hash = self._content_hash(path, snapshot)
+            except (OSError, UnicodeDecodeError) as e:
+                # Ví dụ file bị xóa giữa lúc quét và lúc đọc
+                self.logger.warning(f"[hot-folder] Bỏ qua {path}: {str(e)}")
+                continue
+            key = f"{self.mode}:{content_hash}:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+            with self.lock:
+                record = self.ledger.get(key)
+                if key in self.in_flight:
+                    continue
+                if record is not None and (record.get("status") != "failed" or now < record["next_attempt_at"]):
+                    continue  # Đã xong, đã bỏ cuộc, hoặc chưa tới lượt thử lại
+                self.in_flight.add(key)
+            executor.submit(self._process, path, prompt, content_hash, key)
+            
+        self.snapshots = current
+        self.digests = {path: value for path, value in self.digests.items() if path in current}
+
+    def _record_failure(self, image_path, key, error):
+        """Ghi lần thử lỗi vào ledger; quá MAX_ATTEMPTS thì chuyển ảnh vào failed/ và dừng thử lại"""
+        with self.lock:
+            record = self.ledger.get(key) or {}
+            attempts = record.get("attempts", 0) + 1
+            record = {
+                "input": os.path.abspath(image_path),
+                "status": "failed",
+                "attempts": attempts,
+                "last_error": error,
+                "failed_at": datetime.now().isoformat()
+            }
+            if attempts < self.MAX_ATTEMPTS:
+                delay = min(self.RETRY_BASE_DELAY * 2 ** (attempts - 1), self.RETRY_MAX_DELAY)
+                record["next_attempt_at"] = time.time() + delay
+                self.logger.warning(f"[hot-folder] {image_path} lỗi lần {attempts}/{self.MAX_ATTEMPTS}, "
+                                    f"thử lại sau {delay} giây")
+            else:
+                record["status"] = "abandoned"
+                failed_dir = os.path.join(self.input_dir, self.FAILED_DIR)
+                try:
+                    os.makedirs(failed_dir, exist_ok=True)
+                    for path in (image_path, f"{image_path}.txt", os.path.splitext(image_path)[0] + ".txt"):
+                        if os.path.exists(path):
+                            shutil.move(path, os.path.join(failed_dir, os.path.basename(path)))
+                    record["moved_to"] = os.path.abspath(os.path.join(failed_dir, os.path.basename(image_path)))
+                except OSError as e:
+                    self.logger.error(f"[hot-folder] Không chuyển được {image_path} vào {failed_dir}: {str(e)}")
+                self.logger.error(f"[hot-folder] Bỏ qua {image_path} sau {attempts} lần lỗi")
+            self.ledger[key] = record
+            self._save_ledger()
+
+    def _process(self, image_path, prompt, content_hash, key):
+        """Xử lý một ảnh đầu vào và lưu kết quả vào session"""
+        self.logger.info(f"[hot-folder] Xử lý {image_path} ({self.mode})")
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            if self.mode == "video":
+                deadline = Deadline(total=VIDEO_TOTAL_BUDGET, max_poll_duration=VIDEO_MAX_POLL_DURATION, 
+                                    token=self.cancel_token)
+                operation_name, routing = self.engine.router.call(
+                    "video",
+                    lambda model: self.engine.create_video(prompt, image_path=image_path, deadline=deadline, 
+                                                           model=model, **self.video_options),
+                    latency_class="batch",
+                    prompt_chars=len(prompt)
+                )
+                video_id = self.engine.wait_for_video(operation_name, deadline=deadline, model=routing["model"])
+                filename = f"video_{timestamp}_{content_hash[:8]}.mp4"
+                filepath = os.path.join(self.session_folder, "videos", filename)
+                file_size = self.engine.download_video(video_id, filepath, deadline=deadline)
+                metadata = {
+                    "type": "image_to_video",
+                    "video_id": video_id,
+                    "prompt": prompt,
+                    "input_image": os.path.abspath(image_path),
+                    "source_sha256": content_hash,
+                    "filename": filename,
+                    "created_at": datetime.now().isoformat(),
+                    "file_size": file_size,
+                    "routing": routing
+                }
+            else:
+                deadline = Deadline(total=IMAGE_TOTAL_BUDGET, token=self.cancel_token)
+                filename = f"image_edited_{timestamp}_{content_hash[:8]}.png"
+                filepath = os.path.join(self.session_folder, "images", filename)
+                _, routing = self.engine.router.call(
+                    "image_edit",
+                    lambda model: self.engine.edit_image(prompt, image_path, deadline=deadline, model=model,
+                                                         output_path=filepath),
+                    latency_class="batch",
+                    prompt_chars=len(prompt)
+                )
+                metadata = {
+                    "type": "image_to_image",
+                    "prompt": prompt,
+                    "input_image": os.path.abspath(image_path),
+                    "input_image_hash": self.engine.get_prepared_image(image_path)["dhash"],
+                    "source_sha256": content_hash,
+                    "filename": filename,
+                    "created_at": datetime.now().isoformat(),
+                    "routing": routing
+                }
+                
+            with open(f"{filepath}.json", "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False, indent=2)
+                
+            with open(os.path.join(self.session_folder, "session.log"), "a", encoding="utf-8") as f:
+                f.write(f"{datetime.now().isoformat()} - Hot folder ({self.mode}): {os.path.basename(image_path)} -> {filename}\n")
+                
+            with self.lock:
+                self.ledger[key] = {
+                    "input": os.path.abspath(image_path),
+                    "output": os.path.abspath(filepath),
+                    "processed_at": datetime.now().isoformat()
+                }
+                self._save_ledger()
+            self.logger.info(f"[hot-folder] Đã lưu kết quả: {filepath}")
+        except OperationCancelled:
+            self.logger.info(f"[hot-folder] Đã hủy xử lý {image_path}")
+        except Exception as e:
+            self.logger.error(f"[hot-folder] Lỗi khi xử lý {image_path}: {str(e)}")
+            self._record_failure(image_path, key, str(e))
+        finally:
+            with self.lock:
+                self.in_flight.discard(key)
+
+    def _start_observer(self):
+        """Khởi động watchdog observer nếu có, trả về None nếu phải dùng polling"""
+        if Observer is None:
+            self.logger.info("[hot-folder] Không có watchdog, dùng polling")
+            return None
+            
+        watcher = self
+        
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.wakeup.set()
+                
+        observer = Observer()
+        observer.schedule(Handler(), self.input_dir, recursive=False)
+        observer.start()
+        self.logger.info("[hot-folder] Dùng watchdog để nhận sự kiện file")
+        return observer
+
+    def run(self):
+        """Chạy vòng lặp theo dõi cho tới khi stop() được gọi"""
+        self.logger.info(f"[hot-folder] Theo dõi {self.input_dir} -> {self.session_folder} (mode={self.mode}, workers={self.max_workers})")
+        observer = self._start_observer()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                try:
+                    while not self.stop_event.is_set():
+                        self._scan(executor)
+                        # Sự kiện file đánh thức sớm; vẫn quét lại định kỳ để xác nhận file đã ghi xong
+                        self.wakeup.wait(self.poll_interval)
+                        self.wakeup.clear()
+                finally:
+                    # Hủy các job đang chạy trước khi executor chờ chúng kết thúc (vd. Ctrl+C)
+                    self.stop()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+    def stop(self):
+        """Dừng theo dõi và hủy các thao tác đang chạy"""
+        self.stop_event.set()
+        self.wakeup.set()
+        self.cancel_token.cancel()
+
+
+# Gemini TTS trả về PCM 16-bit mono 24 kHz (audio/L16;codec=pcm;rate=24000)
+DEFAULT_TTS_SAMPLE_RATE = 24000
+
+
+def parse_audio_mime(mime_type):
+    """Phân tích mime type audio, trả về (encoding, sample_rate, channels)"""
+    parts = [p.strip() for p in (mime_type or "").split(";")]
+    base = parts[0].lower()
+    params = {}
+    for part in parts[1:]:
+        if "=" in part:
+            key, value = part.split("=", 1)
+            params[key.strip().lower()] = value.strip()
+            
+    if base in ("audio/l16", "audio/pcm") or params.get("codec") == "pcm" or not base:
+        rate = int(params.get("rate", DEFAULT_TTS_SAMPLE_RATE))
+        channels = int(params.get("channels", 1))
+        return "pcm16", rate, channels
+    if base in ("audio/wav", "audio/x-wav", "audio/wave"):
+        return "wav", None, None
+    return base, None, None
+
+
+def write_wav_file(filepath, pcm_data, sample_rate, channels=1, sample_width=2):
+    """Ghi PCM thành file WAV hợp lệ: ghi header RIFF rồi ghi thẳng buffer PCM (không nối thêm bản copy)"""
+    data_size = len(pcm_data)
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate,
+        sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b"data", data_size
+    )
+    with open(filepath, "wb") as f:
+        f.write(header)
+        f.write(pcm_data)
+    return len(header) + data_size
+
+
+def pcm16_stats(pcm_data, sample_rate, channels=1):
+    """Tính thời lượng và mức peak của PCM 16-bit little-endian"""
+    usable = len(pcm_data) - len(pcm_data) % 2
+    samples = memoryview(pcm_data)[:usable].cast("h")
+    if sys.byteorder == "big":
+        samples = array.array("h", samples)
+        samples.byteswap()
+    peak = max(max(samples, default=0), -min(samples, default=0))
+    frames = len(samples) // max(channels, 1)
+    return {
+        "duration_seconds": round(frames / sample_rate, 3) if sample_rate else None,
+        "peak": peak,
+        "peak_dbfs": round(20 * math.log10(peak / 32768), 2) if peak else None
+    }
+
+
+# Giọng dựng sẵn của Gemini TTS dùng trong giao diện
+TTS_VOICES = ["Zephyr", "Puck", "Charon", "Kore"]
+# Giới hạn mỗi request hội thoại: Gemini chỉ nhận tối đa 2 người nói, script dài thì chia nhỏ
+DIALOGUE_MAX_SPEAKERS_PER_REQUEST = 2
+DIALOGUE_MAX_CHUNK_CHARS = 4000
+DIALOGUE_CHUNK_GAP_SECONDS = 0.25
+DIALOGUE_TAG_PATTERN = re.compile(r"^([^:\n]{1,40}):\s*(.*)$")
+# Nhãn người nói mới phải giống tên: bắt đầu bằng chữ, không có chữ số hay "/" (loại "10:30", "https://...")
+DIALOGUE_SPEAKER_PATTERN = re.compile(r"^[^\W\d_][^\d/]*$")
+
+
+def parse_dialogue_script(script, known_speakers=()):
+    """Tách script dạng "Người nói: lời thoại" thành danh sách {"speaker", "text"}.
+    Nhãn được nhận nếu là người nói đã biết (trong voice map hoặc đã gắn nhãn ở dòng trước) hoặc giống tên
+    (DIALOGUE_SPEAKER_PATTERN); "10:30 ..." hay "https://..." vẫn là lời thoại.
+    Dòng không có nhãn được nối vào lời thoại trước đó."""
+    known = set(known_speakers)
+    lines = []
+    for raw_line in script.splitlines():
+        raw_line = raw_line.strip()
+        if not raw_line:
+            continue
+        match = DIALOGUE_TAG_PATTERN.match(raw_line)
+        speaker = match.group(1).strip() if match else None
+        if (match and match.group(2) and not match.group(2).startswith("//")
+                and (speaker in known or DIALOGUE_SPEAKER_PATTERN.match(speaker))):
+            known.add(speaker)
+            lines.append({"speaker": speaker, "text": match.group(2).strip()})
+        elif lines:
+            lines[-1]["text"] += " " + raw_line
+        else:
+            raise ValueError(f"Dòng đầu tiên thiếu tên người nói: {raw_line[:40]}")
+    if not lines:
+        raise ValueError("Script hội thoại rỗng")
+    return lines
+
+
+def parse_voice_map(text):
+    """Đọc "Lan=Kore, Minh=Puck" thành {"Lan": "Kore", "Minh": "Puck"}"""
+    voices = {}
+    for item in text.split(","):
+        if "=" in item:
+            speaker, voice = item.split("=", 1)
+            if speaker.strip() and voice.strip():
+                voices[speaker.strip()] = voice.strip()
+    return voices
+
+
+def assign_speaker_voices(speakers, voice_map=None, available=TTS_VOICES):
+    """Gán giọng cho từng người nói: theo voice_map, người chưa có giọng lấy lần lượt giọng chưa dùng"""
+    voices = {s: v for s, v in (voice_map or {}).items() if s in speakers}
+    unused = [v for v in available if v not in voices.values()] or list(available)
+    for index, speaker in enumerate(s for s in speakers if s not in voices):
+        voices[speaker] = unused[index % len(unused)]
+    return voices
+
+
+def chunk_dialogue(lines, max_chars=DIALOGUE_MAX_CHUNK_CHARS, max_speakers=DIALOGUE_MAX_SPEAKERS_PER_REQUEST):
+    """Chia hội thoại thành các đoạn liên tiếp, mỗi đoạn tối đa max_chars ký tự và max_speakers người nói"""
+    chunks = []
+    current, speakers, size = [], [], 0
+    for index, line in enumerate(lines):
+        length = len(line["speaker"]) + len(line["text"]) + 3
+        new_speaker = line["speaker"] not in speakers
+        if current and (size + length > max_chars or (new_speaker and len(speakers) >= max_speakers)):
+            chunks.append({"lines": current, "speakers": speakers})
+            current, speakers, size = [], [], 0
+            new_speaker = True
+        current.append(dict(line, index=index))
+        if new_speaker:
+            speakers.append(line["speaker"])
+        size += length
+    if current:
+        chunks.append({"lines": current, "speakers": speakers})
+    return chunks
+
+
+def estimate_line_timings(pcm_data, sample_rate, weights, channels=1, window_seconds=0.01, search_seconds=0.5):
+    """Ước lượng (start, end) của từng câu trong một đoạn audio: chia thời lượng theo độ dài câu,
+    rồi dời mỗi ranh giới về khoảng lặng gần nhất (trong ±search_seconds)"""
+    usable = len(pcm_data) - len(pcm_data) % 2
+    samples = memoryview(pcm_data)[:usable].cast("h")
+    if sys.byteorder == "big":
+        samples = array.array("h", samples)
+        samples.byteswap()
+    duration = len(samples) / channels / sample_rate if sample_rate else 0
+    if len(weights) == 1 or duration == 0:
+        return [(0.0, duration)] * len(weights) if len(weights) == 1 else [(0.0, 0.0)] * len(weights)
+        
+    window = max(1, int(sample_rate * channels * window_seconds))
+    energy = [sum(map(abs, samples[i:i + window])) for i in range(0, len(samples), window)]
+    
+    total = sum(weights) or len(weights)
+    boundaries, cumulative = [0.0], 0
+    for weight in weights[:-1]:
+        cumulative += weight
+        estimate = duration * cumulative / total
+        low = max(int((estimate - search_seconds) / window_seconds), int(boundaries[-1] / window_seconds) + 1)
+        high = min(int((estimate + search_seconds) / window_seconds), len(energy) - 1)
+        if low <= high:
+            quietest = min(range(low, high + 1), key=lambda i: (energy[i], abs(i * window_seconds - estimate)))
+            estimate = quietest * window_seconds
+        boundaries.append(max(estimate, boundaries[-1]))
+    boundaries.append(duration)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(weights))]
+
+
+def encode_flac(wav_path, flac_path):
+    """Nén WAV sang FLAC (chạy trong process pool). Dùng soundfile nếu có, nếu không thì flac/ffmpeg CLI"""
+    try:
+        import soundfile
+    except ImportError:
+        soundfile = None
+        
+    if soundfile is not None:
+        data, sample_rate = soundfile.read(wav_path, dtype="int16")
+        soundfile.write(flac_path, data, sample_rate, format="FLAC")
+    elif shutil.which("flac"):
+        subprocess.run(["flac", "--silent", "--best", "-f", "-o", flac_path, wav_path], check=True)
+    elif shutil.which("ffmpeg"):
+        subprocess.run(["ffmpeg", "-loglevel", "error", "-y", "-i", wav_path, "-c:a", "flac", flac_path], check=True)
+    else:
+        raise RuntimeError("Không tìm thấy encoder FLAC (cần soundfile, flac hoặc ffmpeg)")
+    return os.path.getsize(flac_path)
+
+
+class OperationProfiler:
+    """Chụp cProfile và tracemalloc cho từng thao tác tạo nội dung, lưu vào <session>/profiles/.
+
+    cProfile chỉ đo thread gọi run(); công việc chạy trên thread khác (request chat song song, fan-out,
+    các đoạn TTS, thread worker của GUI) phải được bọc bằng OperationProfiler.wrap() để được gộp vào
+    cùng profile. tracemalloc là toàn cục nên đã tính mọi thread."""
+
+    TOP_FUNCTIONS = 20
+    TOP_ALLOCATIONS = 10
+    # Lần profile đang chạy; các thread được bọc bằng wrap() gửi profile của mình vào đây
+    active_run = None
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.output_dir = "profiles"
+        # tracemalloc là toàn cục nên mỗi lúc chỉ profile một thao tác
+        self.lock = threading.Lock()
+
+    def run(self, operation, func, *args, **kwargs):
+        """Chạy func dưới profiler và lưu kết quả"""
+        if not self.lock.acquire(blocking=False):
+            self.logger.info(f"[profile] Đang profile thao tác khác, bỏ qua {operation}")
+            return func(*args, **kwargs)
+        try:
+            was_tracing = tracemalloc.is_tracing()
+            if was_tracing:
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start(10)
+            profile = cProfile.Profile()
+            run = {"children": [], "lock": threading.Lock(), "closed": False}
+            OperationProfiler.active_run = run
+            start_time = time.time()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start_time
+                OperationProfiler.active_run = None
+                with run["lock"]:
+                    # Thread còn chạy sau khi thao tác kết thúc (vd. request bị bỏ khi hủy) không được tính
+                    run["closed"] = True
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                if not was_tracing:
+                    tracemalloc.stop()
+                self._save(operation, profile, snapshot, peak, elapsed, run["children"])
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def wrap(cls, func):
+        """Bọc hàm sẽ chạy trên thread khác để profile của thread đó được gộp vào thao tác đang profile.
+        Không có thao tác nào đang được profile thì trả về func nguyên vẹn"""
+        run = cls.active_run
+        if run is None:
+            return func
+            
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+: cProfile dùng sys.monitoring chung cho mọi thread, thread này đã được đo
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with run["lock"]:
+                    if not run["closed"]:
+                        run["children"].append(profile)
+        return wrapper
+
+    def _save(self, operation, profile, snapshot, peak, elapsed, children=()):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = f"{operation}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        prof_path = os.path.join(self.output_dir, f"{name}.prof")
+        stats = pstats.Stats(profile)
+        if children:
+            stats.add(*children)
+        stats.dump_stats(prof_path)
+        
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ])
+        report = {
+            "operation": operation,
+            "created_at": datetime.now().isoformat(),
+            "elapsed_seconds": round(elapsed, 3),
+            "threads": 1 + len(children),
+            "peak_memory_bytes": peak,
+            "top_functions": self._top_functions(stats, self.TOP_FUNCTIONS),
+            "top_allocations": [
+                {
+                    "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                    "size_bytes": stat.size,
+                    "count": stat.count
+                }
+                for stat in snapshot.statistics("lineno")[:self.TOP_ALLOCATIONS]
+            ]
+        }
+        with open(os.path.join(self.output_dir, f"{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            
+        self.logger.info(f"[profile] {operation}: {elapsed:.2f} giây, {1 + len(children)} thread, "
+                         f"peak {peak / 1024 / 1024:.1f} MB -> {prof_path}")
+
+    @staticmethod
+    def _top_functions(stats, limit):
+        """Xếp hạng hàm theo thời gian tự thân (tottime)"""
+        rows = []
+        for (filename, lineno, funcname), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{filename}:{lineno}({funcname})",
+                "ncalls": ncalls,
+                "tottime": round(tottime, 4),
+                "cumtime": round(cumtime, 4)
+            })
+        rows.sort(key=lambda r: r["tottime"], reverse=True)
+        return rows[:limit]
+
+    @classmethod
+    def summarize(cls, profile_dir, limit=20):
+        """Tổng hợp mọi profile trong thư mục: hàm nóng nhất và vùng cấp phát lớn nhất"""
+        prof_files = sorted(str(p) for p in Path(profile_dir).glob("*.prof"))
+        if not prof_files:
+            return None
+        stats = pstats.Stats(*prof_files)
+        
+        allocations = {}
+        operations = {}
+        for report_path in Path(profile_dir).glob("*.json"):
+            with open(report_path, "r", encoding="utf-8") as f:
+                report = json.load(f)
+            op = operations.setdefault(report["operation"], {"count": 0, "elapsed_seconds": 0.0, "peak_memory_bytes": 0})
+            op["count"] += 1
+            op["elapsed_seconds"] += report["elapsed_seconds"]
+            op["peak_memory_bytes"] = max(op["peak_memory_bytes"], report["peak_memory_bytes"])
+            for alloc in report["top_allocations"]:
+                allocations[alloc["location"]] = max(allocations.get(alloc["location"], 0), alloc["size_bytes"])
+                
+        return {
+            "operations": operations,
+            "top_functions": cls._top_functions(stats, limit),
+            "top_allocations": [
+                {"location": location, "size_bytes": size}
+                for location, size in sorted(allocations.items(), key=lambda item: item[1], reverse=True)[:limit]
+            ]
+        }
+
+
+def profiled(operation):
+    """Decorator: profile method khi profiling được bật, ngược lại gọi thẳng"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.profiling_enabled:
+                return func(self, *args, **kwargs)
+            return self.profiler.run(operation, func, self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_profile_summary(summary):
+    """Định dạng kết quả OperationProfiler.summarize thành văn bản"""
+    lines = ["Thao tác:"]
+    for name, op in sorted(summary["operations"].items()):
+        lines.append(f"  {name}: {op['count']} lần, tổng {op['elapsed_seconds']:.2f} giây, "
+                     f"peak {op['peak_memory_bytes'] / 1024 / 1024:.1f} MB")
+    lines.append("")
+    lines.append("Hàm nóng nhất (tottime):")
+    for row in summary["top_functions"]:
+        lines.append(f"  {row['tottime']:>9.4f}s  {row['cumtime']:>9.4f}s  {row['ncalls']:>8}  {row['function']}")
+    lines.append("")
+    lines.append("Cấp phát lớn nhất:")
+    for row in summary["top_allocations"]:
+        lines.append(f"  {row['size_bytes'] / 1024:>10.1f} KB  {row['location']}")
+    return "\n".join(lines)
+
+
+# Server mode: giới hạn kích thước request và số job đã xong được giữ lại để truy vấn
+SERVICE_MAX_REQUEST_BYTES = 64 * 1024 * 1024
+SERVICE_MAX_FINISHED_JOBS = 500
+
+
+class RateLimiter:
+    """Token bucket dùng chung cho mọi request tạo nội dung (an toàn giữa các thread)"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, token=None):
+        """Chờ tới khi có lượt; rate <= 0 nghĩa là không giới hạn"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if token is not None:
+                if token.wait(wait):
+                    raise OperationCancelled("Đã hủy khi chờ rate limit")
+            else:
+                time.sleep(wait)
+
+
+class GenerationService:
+    """Dịch vụ tạo nội dung dùng chung cho nhiều client: một engine (connection pool, cache ảnh đầu vào,
+    cache Files API, thống kê router), một client OpenAI và một rate limiter chung.
+    Job chạy trong thread pool và được truy vấn qua ServiceHTTPServer."""
+
+    JOB_KINDS = ("text_to_image", "image_edit", "tts", "dialogue", "video")
+    ACTIVE_STATUSES = ("queued", "running", "succeeded")
+
+    def __init__(self, api_key, data_dir="data", max_workers=4, rate=1.0, burst=4, logger=None, capture=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.engine = GenerationEngine(api_key, self.logger, capture=capture, pool_size=max_workers * 2,
+                                       file_refs=FileReferenceCache(os.path.join(data_dir, "file_refs.json")))
+        self.client = OpenAI(api_key=api_key, base_url=API_BASE_URL, timeout=READ_TIMEOUT,
+                             http_client=capture.httpx_client() if capture else None)
+        self.limiter = RateLimiter(rate, burst)
+        self.session_id, self.session_folder = create_session_folder(data_dir)
+        self.input_dir = os.path.join(self.session_folder, "inputs")
+        os.makedirs(self.input_dir, exist_ok=True)
+        self.video_poll_interval = 60
+        
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = OrderedDict()
+        self.job_keys = {}  # Job giống hệt (cùng loại, tham số, ảnh) dùng chung kết quả
+        self.lock = threading.Lock()
+
+    def _log_session(self, message):
+        with open(os.path.join(self.session_folder, "session.log"), "a", encoding="utf-8") as f:
+            f.write(f"{datetime.now().isoformat()} - {message}\n")
+
+    def _limited(self, fn, token=None):
+        """Bọc fn(model) để mỗi lần gọi API đều phải qua rate limiter chung"""
+        def call(model):
+            self.limiter.acquire(token)
+            return fn(model)
+        return call
+
+    # --- Chat ---
+
+    def chat(self, messages, model=None, latency_class="interactive"):
+        """Chat không streaming, trả về (nội dung, quyết định định tuyến)"""
+        def create(model):
+            return self.client.chat.completions.create(model=model, messages=messages)
+            
+        if model:
+            start_time = time.monotonic()
+            try:
+                response = self._limited(create)(model)
+            except Exception as e:
+                self.engine.router.record(model, time.monotonic() - start_time, e)
+                raise
+            self.engine.router.record(model, time.monotonic() - start_time)
+            routing = {"task": "chat", "model": model, "reason": "model do client chỉ định"}
+        else:
+            prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+            response, routing = self.engine.router.call("chat", self._limited(create), latency_class, prompt_chars)
+        self._log_session(f"Server chat ({routing['model']}): {str(messages[-1].get('content', ''))[:30]}...")
+        return response.choices[0].message.content, routing
+
+    def chat_stream(self, messages, model=None, latency_class="interactive"):
+        """Chat streaming: sinh ("delta", text) cho từng đoạn và ("done", routing) ở cuối.
+        Model quá tải trước token đầu tiên thì chuyển sang model dự phòng."""
+        if model:
+            routing = {"task": "chat", "model": model, "reason": "model do client chỉ định", "fallbacks": []}
+        else:
+            prompt_chars = sum(len(str(m.get("content", ""))) for m in messages)
+            routing = self.engine.router.route("chat", latency_class, prompt_chars)
+            
+        for candidate in [routing["model"]] + routing["fallbacks"]:
+            start_time = time.monotonic()
+            started = False
+            try:
+                self.limiter.acquire()
+                stream = self.client.chat.completions.create(model=candidate, messages=messages, stream=True)
+                try:
+                    for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            started = True
+                            yield "delta", delta
+                finally:
+                    stream.close()
+            except Exception as e:
+                self.engine.router.record(candidate, time.monotonic() - start_time, e)
+                if started or not is_overload_error(e):
+                    raise
+                self.logger.warning(f"Model {candidate} quá tải, stream chuyển sang model dự phòng")
+                continue
+            self.engine.router.record(candidate, time.monotonic() - start_time)
+            routing["model"] = candidate
+            yield "done", routing
+            return
+        raise GenerationError("Mọi model chat đều quá tải", status_code=503)
+
+    # --- Jobs ---
+
+    def _store_input_image(self, image_b64):
+        """Lưu ảnh client gửi lên theo sha256 (ảnh trùng chỉ lưu một lần), trả về (path, sha256).
+        Decode và kiểm tra chạy trong process pool hậu kỳ, ghi ra file tạm rồi đổi tên theo hash"""
+        fd, temp_path = tempfile.mkstemp(suffix=".upload", dir=self.input_dir)
+        os.close(fd)
+        try:
+            try:
+                info = self.engine.postprocessor.process_image(image_b64, temp_path, validate=True)
+            except Exception as e:
+                raise ValueError(f"Ảnh đầu vào không hợp lệ: {str(e)}")
+            content_hash = info["sha256"]
+            path = os.path.join(self.input_dir, f"{content_hash[:16]}.{(info['format'] or 'png').lower()}")
+            if not os.path.exists(path):
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return path, content_hash
+
+    def submit(self, kind, params):
+        """Tạo job mới (hoặc trả về job giống hệt đang chạy/đã xong), trả về trạng thái job"""
+        if kind not in self.JOB_KINDS:
+            raise ValueError(f"Loại job không hợp lệ: {kind}")
+        params = dict(params)
+        text_field = {"tts": "text", "dialogue": "script"}.get(kind, "prompt")
+        if kind == "video" and params.get("prompts") is not None:
+            if not isinstance(params["prompts"], list):
+                raise ValueError("'prompts' phải là danh sách")
+            params["prompts"] = [str(p) for p in params["prompts"] if str(p).strip()]
+            if not params["prompts"]:
+                raise ValueError("'prompts' rỗng")
+        elif not str(params.get(text_field, "")).strip():
+            raise ValueError(f"Thiếu '{text_field}'")
+            
+        image_hash = None
+        params.pop("image_path", None)  # Client không được chỉ định đường dẫn trên server
+        if params.get("image_b64"):
+            params["image_path"], image_hash = self._store_input_image(params.pop("image_b64"))
+        elif kind == "image_edit":
+            raise ValueError("image_edit cần 'image_b64'")
+        
+        key_source = {k: v for k, v in params.items() if k != "image_path"}
+        key = hashlib.sha256(json.dumps([kind, key_source, image_hash], sort_keys=True).encode("utf-8")).hexdigest()
+        with self.lock:
+            existing = self.jobs.get(self.job_keys.get(key))
+            if existing and existing["status"] in self.ACTIVE_STATUSES:
+                self.logger.info(f"Job {kind} trùng với {existing['id']}, dùng lại kết quả")
+                return dict(self._view(existing), cache_hit=True)
+                
+            job = {
+                "id": datetime.now().strftime("%Y%m%d%H%M%S") + "_" + hashlib.sha256(os.urandom(8)).hexdigest()[:8],
+                "kind": kind,
+                "status": "queued",
+                "params": params,
+                "created_at": datetime.now().isoformat(),
+                "started_at": None,
+                "finished_at": None,
+                "progress": None,
+                "error": None,
+                "artifacts": [],
+                "routing": None,
+                "token": CancellationToken(),
+                "key": key
+            }
+            self.jobs[job["id"]] = job
+            self.job_keys[key] = job["id"]
+            self._prune_jobs()
+        self.pool.submit(self._run_job, job)
+        return self._view(job)
+
+    def _prune_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job["finished_at"]]
+        for job_id in finished[:max(0, len(finished) - SERVICE_MAX_FINISHED_JOBS)]:
+            job = self.jobs.pop(job_id)
+            # Bỏ luôn khóa dedupe, trừ khi nó đã trỏ sang job mới hơn
+            if self.job_keys.get(job["key"]) == job_id:
+                del self.job_keys[job["key"]]
+
+    @staticmethod
+    def _view(job):
+        """Trạng thái job trả cho client (không lộ đường dẫn nội bộ)"""
+        view = {k: v for k, v in job.items() if k not in ("token", "params", "key")}
+        view["params"] = {k: v for k, v in job["params"].items() if k != "image_path"}
+        view["artifacts"] = [
+            {"name": a["name"], "size": a["size"], "mime_type": a["mime_type"], "metadata": a["metadata"],
+             "url": f"/v1/jobs/{job['id']}/artifacts/{a['name']}"}
+            for a in job["artifacts"]
+        ]
+        return view
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return self._view(job) if job else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [self._view(job) for job in self.jobs.values()]
+
+    def cancel_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if not job:
+            return None
+        if job["status"] in ("queued", "running"):
+            job["token"].cancel()
+        return self._view(job)
+
+    def artifact_path(self, job_id, name):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            for artifact in (job["artifacts"] if job else []):
+                if artifact["name"] == name:
+                    return artifact["path"], artifact["mime_type"]
+        return None, None
+
+    def _run_job(self, job):
+        if job["token"].cancelled:
+            job.update(status="cancelled", finished_at=datetime.now().isoformat())
+            return
+        job.update(status="running", started_at=datetime.now().isoformat())
+        self.logger.info(f"[server] Bắt đầu job {job['id']} ({job['kind']})")
+        try:
+            getattr(self, f"_run_{job['kind']}")(job)
+            job["status"] = "succeeded"
+        except OperationCancelled:
+            job["status"] = "cancelled"
+        except Exception as e:
+            self.logger.error(f"[server] Job {job['id']} lỗi: {str(e)}")
+            job.update(status="failed", error=str(e))
+        job["finished_at"] = datetime.now().isoformat()
+        self._log_session(f"Server job {job['kind']} {job['id']}: {job['status']} ({len(job['artifacts'])} file)")
+
+    def _save_artifact(self, job, folder, filename, mime_type, metadata, data=None):
+        """Lưu file kết quả (nếu có data) cùng metadata .json như GUI, gắn vào job"""
+        path = os.path.join(self.session_folder, folder, filename)
+        if data is not None:
+            with open(path, "wb") as f:
+                f.write(data)
+        metadata = dict(metadata, filename=filename, job_id=job["id"], created_at=datetime.now().isoformat(),
+                        routing=job["routing"])
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        job["artifacts"].append({"name": filename, "path": path, "size": os.path.getsize(path),
+                                 "mime_type": mime_type, "metadata": metadata})
+
+    def _run_text_to_image(self, job):
+        params = job["params"]
+        response, job["routing"] = self.engine.router.call(
+            "text_to_image",
+            self._limited(lambda model: self.client.images.generate(
+                model=model,
+                prompt=params["prompt"],
+                n=1,
+                extra_body={"aspect_ratio": params.get("aspect_ratio", "1:1")},
+                timeout=IMAGE_TOTAL_BUDGET
+            ), job["token"]),
+            latency_class=params.get("latency_class", "interactive"),
+            prompt_chars=len(params["prompt"])
+        )
+        filename = f"image_{job['id']}.png"
+        self.engine.postprocessor.process_image(response.data[0].b64_json,
+                                                os.path.join(self.session_folder, "images", filename))
+        self._save_artifact(job, "images", filename, "image/png",
+                            {"type": "text_to_image", "prompt": params["prompt"]})
+
+    def _run_image_edit(self, job):
+        params = job["params"]
+        deadline = Deadline(total=IMAGE_TOTAL_BUDGET, token=job["token"])
+        filename = f"image_edited_{job['id']}.png"
+        filepath = os.path.join(self.session_folder, "images", filename)
+        _, job["routing"] = self.engine.router.call(
+            "image_edit",
+            self._limited(lambda model: self.engine.edit_image(params["prompt"], params["image_path"], 
+                                                               deadline=deadline, model=model, output_path=filepath),
+                          job["token"]),
+            latency_class=params.get("latency_class", "interactive"),
+            prompt_chars=len(params["prompt"])
+        )
+        self._save_artifact(job, "images", filename, "image/png",
+                            {"type": "image_to_image", "prompt": params["prompt"],
+                             "input_image_hash": self.engine.get_prepared_image(params["image_path"])["dhash"]})
+
+    def _run_tts(self, job):
+        params = job["params"]
+        voice = params.get("voice", "Kore")
+        deadline = Deadline(total=TTS_TOTAL_BUDGET, token=job["token"])
+        (audio_data, mime_type), job["routing"] = self.engine.router.call(
+            "tts",
+            self._limited(lambda model: self.engine.synthesize_speech(params["text"], voice, 
+                                                                      deadline=deadline, model=model), job["token"]),
+            latency_class=params.get("latency_class", "interactive"),
+            prompt_chars=len(params["text"])
+        )
+        encoding, sample_rate, channels = parse_audio_mime(mime_type)
+        metadata = {"text": params["text"], "voice": voice, "mime_type": mime_type}
+        if encoding == "pcm16":
+            filename = f"audio_{job['id']}.wav"
+            write_wav_file(os.path.join(self.session_folder, "audio", filename), audio_data, sample_rate, channels)
+            metadata.update(pcm16_stats(audio_data, sample_rate, channels), sample_rate=sample_rate, channels=channels)
+            self._save_artifact(job, "audio", filename, "audio/wav", metadata)
+        else:
+            extension = {"wav": "wav", "audio/mpeg": "mp3", "audio/ogg": "ogg"}.get(encoding, "bin")
+            self._save_artifact(job, "audio", f"audio_{job['id']}.{extension}", mime_type or "application/octet-stream",
+                                metadata, data=audio_data)
+
+    def _run_dialogue(self, job):
+        params = job["params"]
+        voice_map = params.get("voices") if isinstance(params.get("voices"), dict) else None
+        lines = parse_dialogue_script(params["script"], known_speakers=voice_map or ())
+        speakers = list(dict.fromkeys(line["speaker"] for line in lines))
+        voices = assign_speaker_voices(speakers, voice_map)
+        deadline = Deadline(total=TTS_TOTAL_BUDGET, token=job["token"])
+        result, job["routing"] = self.engine.router.call(
+            "tts",
+            self._limited(lambda model: self.engine.synthesize_dialogue(lines, voices, deadline=deadline, model=model),
+                          job["token"]),
+            latency_class=params.get("latency_class", "interactive"),
+            prompt_chars=len(params["script"])
+        )
+        filename = f"dialogue_{job['id']}.wav"
+        file_size = write_wav_file(os.path.join(self.session_folder, "audio", filename), result["pcm"],
+                                   result["sample_rate"], result["channels"])
+        self._save_artifact(job, "audio", filename, "audio/wav", {
+            "type": "tts_dialogue",
+            "text": params["script"],
+            "voices": voices,
+            "file_size": file_size,
+            "mime_type": "audio/wav",
+            "sample_rate": result["sample_rate"],
+            "channels": result["channels"],
+            "lines": result["lines"],
+            "chunks": result["chunks"],
+            **pcm16_stats(result["pcm"], result["sample_rate"], result["channels"])
+        })
+
+    def _run_video(self, job):
+        params = job["params"]
+        prompts = params.get("prompts") or [params["prompt"]]
+        sample_count = max(1, int(params.get("sample_count", 1)))
+        deadline = Deadline(total=VIDEO_TOTAL_BUDGET, max_poll_duration=VIDEO_MAX_POLL_DURATION, token=job["token"])
+        operation_name, job["routing"] = self.engine.router.call(
+            "video",
+            self._limited(lambda model: self.engine.create_video_batch(
+                [{"prompt": prompt, "image_path": params.get("image_path")} for prompt in prompts],
+                aspect_ratio=params.get("aspect_ratio", "16:9"),
+                resolution=params.get("resolution", "720p"),
+                sample_count=sample_count,
+                deadline=deadline,
+                model=model
+            ), job["token"]),
+            latency_class=params.get("latency_class", "interactive"),
+            prompt_chars=sum(len(prompt) for prompt in prompts)
+        )
+        job["progress"] = 0
+        samples = self.engine.wait_for_videos(
+            operation_name, poll_interval=self.video_poll_interval, deadline=deadline, model=job["routing"]["model"],
+            on_progress=lambda progress: job.update(progress=progress)
+        )
+        job["progress"] = 100
+        mapped = len(samples) == len(prompts) * sample_count
+        for sample in samples:
+            filename = f"video_{job['id']}_{sample['sample_index']}.mp4"
+            file_size = self.engine.download_video(sample["video_id"], os.path.join(self.session_folder, "videos", filename),
+                                                   deadline=deadline)
+            instance_index = sample["sample_index"] // sample_count if mapped else None
+            self._save_artifact(job, "videos", filename, "video/mp4", {
+                "video_id": sample["video_id"],
+                "prompt": prompts[instance_index] if instance_index is not None else "\n".join(prompts),
+                "operation": operation_name,
+                "sample_index": sample["sample_index"],
+                "instance_index": instance_index,
+                "file_size": file_size
+            })
+
+    def shutdown(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job["token"].cancel()
+        self.pool.shutdown(wait=False)
+        self.engine.prefetch_pool.shutdown(wait=False)
+        self.engine.postprocessor.shutdown()
+
+
+class ServiceHTTPServer:
+    """HTTP API (asyncio) cho GenerationService.
+
+    GET  /health                          trạng thái server
+    POST /v1/chat                         {"messages", "model"?, "latency_class"?, "stream"?} (stream: SSE)
+    POST /v1/jobs                         {"kind", ...tham số, "image_b64"?} -> 202 + job
+    GET  /v1/jobs                         danh sách job
+    GET  /v1/jobs/<id>                    trạng thái job
+    DELETE /v1/jobs/<id>                  hủy job
+    GET  /v1/jobs/<id>/artifacts/<name>   tải file kết quả
+    """
+
+    def __init__(self, service, host="127.0.0.1", port=8800, token=None, logger=None):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.token = token
+        self.logger = logger or service.logger
+
+    async def serve_forever(self, ready=None):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.logger.info(f"Server đang chạy tại http://{self.host}:{self.port}")
+        if ready:
+            ready()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+                
+            length = int(headers.get("content-length", 0))
+            if length > SERVICE_MAX_REQUEST_BYTES:
+                await self._send_json(writer, 413, {"error": "Request quá lớn"})
+                return
+            body = await reader.readexactly(length) if length else b""
+            await self._dispatch(method.upper(), urlsplit(target).path, headers, body, writer)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self._send_json(writer, 400, {"error": f"Request không hợp lệ: {str(e)}"})
+        except ConnectionError:
+            pass
+        except Exception as e:
+            self.logger.error(f"[server] Lỗi xử lý request: {str(e)}")
+            await self._send_json(writer, 500, {"error": str(e)})
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status, headers, body=b""):
+        lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"] + [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines + ["Connection: close", "", ""])).encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, payload):
+        try:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            await self._send(writer, status, {"Content-Type": "application/json; charset=utf-8",
+                                              "Content-Length": len(body)}, body)
+        except ConnectionError:
+            pass
+
+    async def _dispatch(self, method, path, headers, body, writer):
+        loop = asyncio.get_running_loop()
+        # So sánh thời gian hằng để không lộ token qua độ trễ phản hồi (header được decode latin-1)
+        authorized = not self.token or hmac.compare_digest(headers.get("authorization", "").encode("latin-1"),
+                                                           f"Bearer {self.token}".encode("utf-8"))
+        if path == "/health":
+            if not authorized:
+                # Không có token chỉ biết server còn sống, không lộ session/số job
+                await self._send_json(writer, 200, {"status": "ok"})
+                return
+            jobs = self.service.list_jobs()
+            await self._send_json(writer, 200, {
+                "status": "ok",
+                "session_id": self.service.session_id,
+                "jobs": {status: sum(1 for j in jobs if j["status"] == status) 
+                         for status in ("queued", "running", "succeeded", "failed", "cancelled")}
+            })
+            return
+        if not authorized:
+            await self._send_json(writer, 401, {"error": "Sai hoặc thiếu token"})
+            return
+            
+        parts = [p for p in path.split("/") if p]
+        payload = json.loads(body or b"{}") if method == "POST" else {}
+        if not isinstance(payload, dict):
+            await self._send_json(writer, 400, {"error": "Body phải là một JSON object"})
+            return
+        
+        if method == "POST" and parts == ["v1", "chat"]:
+            messages = payload.get("messages")
+            if not isinstance(messages, list) or not messages:
+                await self._send_json(writer, 400, {"error": "Thiếu 'messages'"})
+                return
+            model = payload.get("model")
+            latency_class = payload.get("latency_class", "interactive")
+            if payload.get("stream"):
+                await self._stream_chat(writer, messages, model, latency_class)
+                return
+            try:
+                content, routing = await loop.run_in_executor(None, self.service.chat, messages, model, latency_class)
+            except Exception as e:
+                await self._send_json(writer, getattr(e, "status_code", None) or 502, {"error": str(e)})
+                return
+            await self._send_json(writer, 200, {"content": content, "routing": routing})
+            
+        elif method == "POST" and parts == ["v1", "jobs"]:
+            try:
+                job = await loop.run_in_executor(None, self.service.submit, payload.pop("kind", None), payload)
+            except ValueError as e:
+                await self._send_json(writer, 400, {"error": str(e)})
+                return
+            await self._send_json(writer, 202, job)
+            
+        elif method == "GET" and parts == ["v1", "jobs"]:
+            await self._send_json(writer, 200, {"jobs": self.service.list_jobs()})
+            
+        elif method in ("GET", "DELETE") and len(parts) == 3 and parts[:2] == ["v1", "jobs"]:
+            job = self.service.get_job(parts[2]) if method == "GET" else self.service.cancel_job(parts[2])
+            if job is None:
+                await self._send_json(writer, 404, {"error": "Không tìm thấy job"})
+            else:
+                await self._send_json(writer, 200, job)
+                
+        elif method == "GET" and len(parts) == 5 and parts[:2] == ["v1", "jobs"] and parts[3] == "artifacts":
+            path, mime_type = self.service.artifact_path(parts[2], parts[4])
+            if not path or not os.path.exists(path):
+                await self._send_json(writer, 404, {"error": "Không tìm thấy file"})
+                return
+            await self._send(writer, 200, {"Content-Type": mime_type, "Content-Length": os.path.getsize(path)})
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    await writer.drain()
+        else:
+            await self._send_json(writer, 404, {"error": f"Không có endpoint {method} {path}"})
+
+    async def _stream_chat(self, writer, messages, model, latency_class):
+        """Chuyển các đoạn chat từ thread sang client dưới dạng server-sent events"""
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        stopped = threading.Event()
+        
+        def produce():
+            stream = self.service.chat_stream(messages, model, latency_class)
+            try:
+                for event in stream:
+                    if stopped.is_set():
+                        break
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, ("error", str(e)))
+            finally:
+                stream.close()
+                loop.call_soon_threadsafe(events.put_nowait, None)
+                
+        await self._send(writer, 200, {"Content-Type": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache"})
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                kind, data = event
+                writer.write(f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await writer.drain()
+        finally:
+            stopped.set()  # Client ngắt kết nối: dừng stream phía API
+            await producer
+
+
+class ServiceClient:
+    """Client mỏng cho ServiceHTTPServer (GUI dùng khi chạy với --server)"""
+
+    def __init__(self, base_url, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.http = requests.Session()
+        if token:
+            self.http.headers["Authorization"] = f"Bearer {token}"
+
+    def _call(self, method, path, stream=False, **kwargs):
+        try:
+            response = self.http.request(method, self.base_url + path, stream=stream,
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+        except requests.RequestException as e:
+            raise GenerationError(f"Không kết nối được server: {str(e)}")
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error", response.text)
+            except ValueError:
+                message = response.text
+            raise GenerationError(f"Server lỗi {response.status_code}: {message}", status_code=response.status_code)
+        return response
+
+    def health(self):
+        info = self._call("GET", "/health").json()
+        if "session_id" not in info:
+            # Server có token chỉ trả chi tiết khi token đúng
+            raise GenerationError("Server từ chối token (thiếu hoặc sai --server-token)", status_code=401)
+        return info
+
+    def chat(self, messages, model=None, latency_class="interactive"):
+        """Trả về (nội dung, quyết định định tuyến)"""
+        data = self._call("POST", "/v1/chat", json={"messages": messages, "model": model,
+                                                     "latency_class": latency_class}).json()
+        return data["content"], data["routing"]
+
+    def chat_stream(self, messages, model=None, latency_class="interactive"):
+        """Sinh ("delta", text) ... ("done", routing); lỗi phía server thành GenerationError"""
+        response = self._call("POST", "/v1/chat", stream=True, json={
+            "messages": messages, "model": model, "latency_class": latency_class, "stream": True})
+        with response:
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[7:]
+                elif line.startswith("data: "):
+                    data = json.loads(line[6:])
+                    if event == "error":
+                        raise GenerationError(data)
+                    yield event, data
+
+    def submit(self, kind, params, image_path=None):
+        payload = dict(params, kind=kind)
+        if image_path:
+            with open(image_path, "rb") as f:
+                payload["image_b64"] = base64.b64encode(f.read()).decode("ascii")
+        return self._call("POST", "/v1/jobs", json=payload).json()
+
+    def get_job(self, job_id):
+        return self._call("GET", f"/v1/jobs/{job_id}").json()
+
+    def cancel(self, job_id):
+        return self._call("DELETE", f"/v1/jobs/{job_id}").json()
+
+    def wait(self, job_id, poll_interval=2, on_progress=None, token=None):
+        """Chờ job xong, trả về trạng thái cuối; hủy token thì hủy luôn job trên server"""
+        while True:
+            job = self.get_job(job_id)
+            if job["status"] == "succeeded":
+                return job
+            if job["status"] == "failed":
+                raise GenerationError(job["error"] or "Job thất bại")
+            if job["status"] == "cancelled":
+                raise OperationCancelled("Job đã bị hủy")
+            if on_progress and job["progress"] is not None:
+                on_progress(job["progress"])
+            if token is not None:
+                if token.wait(poll_interval):
+                    self.cancel(job_id)
+                    raise OperationCancelled("Đã hủy job")
+            else:
+                time.sleep(poll_interval)
+
+    def run_job(self, kind, params, image_path=None, on_progress=None, token=None):
+        job = self.submit(kind, params, image_path=image_path)
+        return self.wait(job["id"], on_progress=on_progress, token=token)
+
+    def download(self, artifact, filepath=None):
+        """Tải artifact của job; có filepath thì ghi thẳng ra file và trả về kích thước, không thì trả bytes"""
+        response = self._call("GET", artifact["url"], stream=filepath is not None)
+        if filepath is None:
+            return response.content
+        total_size = 0
+        with response, open(filepath, "wb") as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+                total_size += len(chunk)
+        return total_size
+
+
 class AIGenerator:
-    def __init__(self):
+    def __init__(self, profile=False, capture=None, server_url=None, server_token=None):
         self.root = tk.Tk()
         self.root.title("AI Multi-Modal Generator")
         self.root.geometry("1000x700")
@@ -31,31 +3513,57 @@ class AIGenerator:
         self.session_folder = None
         self.api_key = None
         self.client = None
+        self.engine = None
+        self.video_cancel_token = None
+        # Token của thao tác ảnh/TTS/chat đang chạy (nút Cancel trên từng tab)
+        self.operation_token = None
+        self.operation_buttons = []
+        
+        # Ghi/phát lại HTTP (--record / --replay)
+        self.capture = capture
         
-        # Chat history
+        # Chế độ client mỏng: mọi thao tác tạo nội dung chạy trên server (--server)
+        self.server_url = server_url
+        self.server_token = server_token
+        self.service = None
+        self.audio_pool = None
+        
+        # Chat history: chat_history là ngữ cảnh gửi API (từ chat_saved_count trở đi là chưa ghi file),
+        # khung chat chỉ giữ một cửa sổ message của chat_store, nạp thêm theo trang khi cuộn
         self.chat_history = []
+        self.chat_store = None
+        self.chat_saved_count = 0
+        self.chat_entries = deque()
+        self.chat_window_start = 0
+        self.chat_window_end = 0
+        self.chat_at_latest = True
+        self.chat_paging = False
+        self.chat_mark_counter = 0
+        
+        # Thống kê thời gian tới token đầu tiên của chat (dùng cho hedging)
+        self.chat_ttft = LatencyTracker()
+        
+        # Chỉ mục prompt gần giống để dùng lại kết quả cũ
+        self.similarity_index = PromptSimilarityIndex()
         
         # Setup logging
         self.setup_logging()
         
+        # Profiling (tắt mặc định, không tốn chi phí khi tắt)
+        self.profiling_enabled = profile
+        self.profiler = OperationProfiler(self.logger)
+        
+        # Decode/hash/thumbnail ảnh trong process pool, dùng chung với engine
+        self.postprocessor = PostProcessor(logger=self.logger)
+        
         # Setup GUI
         self.setup_gui()
+        if self.server_url:
+            self.status_label.config(text=f"Chế độ client: nhấn Save & Start để kết nối {self.server_url}")
         
     def setup_logging(self):
         """Thiết lập hệ thống logging"""
-        # Tạo folder logs nếu chưa có
-        os.makedirs("logs", exist_ok=True)
-        
-        # Cấu hình logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(f'logs/ai_generator_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log', encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
-        self.logger = logging.getLogger(__name__)
+        self.logger = configure_logging()
         self.logger.info("=== AI Multi-Modal Generator Started ===")
         
     def log_session(self, message):
@@ -64,6 +3572,9 @@ class AIGenerator:
             log_file = os.path.join(self.session_folder, "session.log")
             with open(log_file, "a", encoding="utf-8") as f:
                 f.write(f"{datetime.now().isoformat()} - {message}\n")
+            # Mỗi thao tác tạo nội dung đều ghi log sau khi lưu file: index lại session này trong nền
+            if self.search_index is not None:
+                self.search_queue.put(self.session_folder)
         
     def setup_gui(self):
         """Thiết lập giao diện chính"""
@@ -77,6 +3588,9 @@ class AIGenerator:
         self.create_image_tab()
         self.create_video_tab()
         self.create_tts_tab()
+        self.create_search_tab()
+        self.create_archive_tab()
+        self.create_sessions_tab()
         
         # Disable tất cả tabs trừ Settings
         self.disable_all_tabs_except_settings()
@@ -98,12 +3612,38 @@ class AIGenerator:
         save_btn = ttk.Button(self.settings_frame, text="💾 Save & Start", 
                              command=self.save_api_key)
         save_btn.pack(pady=10)
+        self.operation_buttons.append(save_btn)
         
         # Status label
         self.status_label = ttk.Label(self.settings_frame, text="Chưa có API key", 
                                      foreground="red")
         self.status_label.pack(pady=5)
         
+        # Reuse similar generations
+        self.reuse_similar_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(self.settings_frame, text="Gợi ý dùng lại kết quả có prompt gần giống", 
+                       variable=self.reuse_similar_var).pack(pady=5)
+        
+        # Latency class cho định tuyến model
+        routing_frame = ttk.Frame(self.settings_frame)
+        routing_frame.pack(pady=5)
+        
+        ttk.Label(routing_frame, text="Ưu tiên model:").pack(side=tk.LEFT)
+        self.latency_class_var = tk.StringVar(value="interactive")
+        ttk.Combobox(routing_frame, textvariable=self.latency_class_var, values=["interactive", "batch"],
+                    state="readonly", width=12).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(routing_frame, text="(interactive = nhanh, batch = chất lượng cao nhất)").pack(side=tk.LEFT, padx=(5, 0))
+        
+        # Profiling toggle
+        profile_frame = ttk.Frame(self.settings_frame)
+        profile_frame.pack(pady=5)
+        
+        self.profile_var = tk.BooleanVar(value=self.profiling_enabled)
+        ttk.Checkbutton(profile_frame, text="Profile CPU/bộ nhớ từng thao tác", variable=self.profile_var, 
+                       command=self.toggle_profiling).pack(side=tk.LEFT)
+        ttk.Button(profile_frame, text="📊 Tổng hợp profile", 
+                  command=self.show_profile_summary).pack(side=tk.LEFT, padx=(10, 0))
+        
         # Instructions
         instructions = """
 Hướng dẫn sử dụng:
@@ -123,6 +3663,8 @@ Hướng dẫn sử dụng:
         self.chat_display = scrolledtext.ScrolledText(self.chat_frame, height=20, 
                                                     state=tk.DISABLED, wrap=tk.WORD)
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        # Nạp lịch sử cũ/mới hơn khi cuộn tới mép trên/dưới
+        self.chat_display.config(yscrollcommand=self._on_chat_scroll)
         
         # Input frame
         input_frame = ttk.Frame(self.chat_frame)
@@ -131,12 +3673,43 @@ Hướng dẫn sử dụng:
         self.chat_input = tk.Text(input_frame, height=3, wrap=tk.WORD)
         self.chat_input.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
+        cancel_btn = ttk.Button(input_frame, text="⏹ Cancel", command=self.cancel_operation)
+        cancel_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        
         send_btn = ttk.Button(input_frame, text="📤 Send", command=self.send_chat_message)
         send_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        self.operation_buttons.append(send_btn)
         
         # Bind Enter key
         self.chat_input.bind("<Control-Return>", lambda e: self.send_chat_message())
         
+        # Hedging / fan-out options
+        options_frame = ttk.LabelFrame(self.chat_frame, text="Tùy chọn", padding=5)
+        options_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        self.chat_hedge_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Hedging", 
+                       variable=self.chat_hedge_var).grid(row=0, column=0, sticky=tk.W)
+        
+        ttk.Label(options_frame, text="Ngưỡng (giây, trống = p95):").grid(row=0, column=1, sticky=tk.W, padx=(10, 0))
+        self.chat_hedge_threshold = tk.StringVar(value="")
+        ttk.Entry(options_frame, textvariable=self.chat_hedge_threshold, 
+                 width=6).grid(row=0, column=2, sticky=tk.W, padx=(5, 0))
+        
+        ttk.Label(options_frame, text="Model dự phòng:").grid(row=0, column=3, sticky=tk.W, padx=(10, 0))
+        self.chat_hedge_model = tk.StringVar(value=default_model("chat"))
+        ttk.Combobox(options_frame, textvariable=self.chat_hedge_model, 
+                    values=CHAT_MODEL_CHOICES, width=22).grid(row=0, column=4, sticky=tk.W, padx=(5, 0))
+        
+        ttk.Label(options_frame, text="Fan-out models:").grid(row=1, column=0, columnspan=2, sticky=tk.W)
+        self.chat_fanout_models = tk.StringVar(value=", ".join(CHAT_MODEL_CHOICES[:2]))
+        ttk.Entry(options_frame, textvariable=self.chat_fanout_models, 
+                 width=40).grid(row=1, column=2, columnspan=3, sticky=tk.W, padx=(5, 0))
+        
+        fanout_btn = ttk.Button(options_frame, text="🔀 Fan-out", command=self.send_chat_fanout)
+        fanout_btn.grid(row=1, column=5, padx=(10, 0))
+        self.operation_buttons.append(fanout_btn)
+        
     def create_image_tab(self):
         """Tạo tab Image Generation"""
         self.image_frame = ttk.Frame(self.notebook)
@@ -158,6 +3731,7 @@ Hướng dẫn sử dụng:
         
         self.image_prompt = tk.Text(prompt_frame, height=3, wrap=tk.WORD)
         self.image_prompt.pack(fill=tk.X)
+        self.image_prompt.bind("<KeyRelease>", lambda e: self.prefetch_input())
         
         # Image input (for image-to-image mode)
         self.image_input_frame = ttk.LabelFrame(self.image_frame, text="Ảnh đầu vào", padding=10)
@@ -172,16 +3746,25 @@ Hướng dẫn sử dụng:
                               command=self.browse_image)
         browse_btn.pack(side=tk.RIGHT)
         
-        # Generate button
-        generate_btn = ttk.Button(self.image_frame, text="🎨 Generate Image", 
+        # Generate / cancel buttons
+        button_frame = ttk.Frame(self.image_frame)
+        button_frame.pack(pady=10)
+        
+        generate_btn = ttk.Button(button_frame, text="🎨 Generate Image", 
                                 command=self.generate_image)
-        generate_btn.pack(pady=10)
+        generate_btn.pack(side=tk.LEFT)
+        self.operation_buttons.append(generate_btn)
+        
+        cancel_btn = ttk.Button(button_frame, text="⏹ Cancel", 
+                               command=self.cancel_operation)
+        cancel_btn.pack(side=tk.LEFT, padx=(10, 0))
         
         # Preview frame
         self.preview_frame = ttk.LabelFrame(self.image_frame, text="Preview", padding=10)
         self.preview_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
         self.image_preview = ttk.Label(self.preview_frame, text="Chưa có ảnh")
+        self.image_preview_path = None
         self.image_preview.pack(expand=True)
         
     def create_video_tab(self):
@@ -193,83 +3776,555 @@ Hướng dẫn sử dụng:
         prompt_frame = ttk.LabelFrame(self.video_frame, text="Mô tả video", padding=10)
         prompt_frame.pack(fill=tk.X, padx=10, pady=5)
         
-        self.video_prompt = tk.Text(prompt_frame, height=3, wrap=tk.WORD)
-        self.video_prompt.pack(fill=tk.X)
+        self.video_prompt = tk.Text(prompt_frame, height=3, wrap=tk.WORD)
+        self.video_prompt.pack(fill=tk.X)
+        self.video_prompt.bind("<KeyRelease>", lambda e: self.prefetch_input())
+        
+        # Image input (optional)
+        image_frame = ttk.LabelFrame(self.video_frame, text="Ảnh đầu vào (tùy chọn)", padding=10)
+        image_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        self.video_image_path_var = tk.StringVar()
+        path_entry = ttk.Entry(image_frame, textvariable=self.video_image_path_var, 
+                              state=tk.DISABLED)
+        path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10))
+        
+        browse_btn = ttk.Button(image_frame, text="📁 Browse", 
+                              command=self.browse_video_image)
+        browse_btn.pack(side=tk.RIGHT)
+        
+        # Settings
+        settings_frame = ttk.LabelFrame(self.video_frame, text="Cài đặt", padding=10)
+        settings_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        # Aspect ratio
+        ttk.Label(settings_frame, text="Tỷ lệ khung hình:").grid(row=0, column=0, sticky=tk.W)
+        self.aspect_ratio = tk.StringVar(value="16:9")
+        aspect_combo = ttk.Combobox(settings_frame, textvariable=self.aspect_ratio, 
+                                   values=["16:9", "9:16", "1:1"])
+        aspect_combo.grid(row=0, column=1, sticky=tk.W, padx=(10, 0))
+        
+        # Resolution
+        ttk.Label(settings_frame, text="Độ phân giải:").grid(row=1, column=0, sticky=tk.W)
+        self.resolution = tk.StringVar(value="720p")
+        res_combo = ttk.Combobox(settings_frame, textvariable=self.resolution, 
+                                values=["720p", "1080p"])
+        res_combo.grid(row=1, column=1, sticky=tk.W, padx=(10, 0))
+        
+        # Samples per prompt
+        ttk.Label(settings_frame, text="Số mẫu mỗi prompt:").grid(row=2, column=0, sticky=tk.W)
+        self.video_sample_count = tk.IntVar(value=1)
+        ttk.Spinbox(settings_frame, from_=1, to=4, textvariable=self.video_sample_count, 
+                   width=5).grid(row=2, column=1, sticky=tk.W, padx=(10, 0))
+        
+        # Batch mode
+        self.video_batch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(settings_frame, text="Batch: mỗi dòng là một prompt (gửi chung một request)", 
+                       variable=self.video_batch_var).grid(row=3, column=0, columnspan=2, sticky=tk.W)
+        
+        # Generate / cancel buttons
+        button_frame = ttk.Frame(self.video_frame)
+        button_frame.pack(pady=10)
+        
+        generate_btn = ttk.Button(button_frame, text="🎬 Generate Video", 
+                               command=self.generate_video)
+        generate_btn.pack(side=tk.LEFT)
+        self.operation_buttons.append(generate_btn)
+        
+        cancel_btn = ttk.Button(button_frame, text="⏹ Cancel", 
+                               command=self.cancel_video)
+        cancel_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Progress bar
+        self.progress_var = tk.StringVar(value="Sẵn sàng")
+        self.progress_label = ttk.Label(self.video_frame, textvariable=self.progress_var)
+        self.progress_label.pack(pady=5)
+        
+        self.progress_bar = ttk.Progressbar(self.video_frame, mode='indeterminate')
+        self.progress_bar.pack(fill=tk.X, padx=10, pady=5)
+        
+    def create_tts_tab(self):
+        """Tạo tab Text-to-Speech"""
+        self.tts_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.tts_frame, text="🎤 TTS")
+        
+        # Text input
+        text_frame = ttk.LabelFrame(self.tts_frame, text="Văn bản", padding=10)
+        text_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        self.tts_text = scrolledtext.ScrolledText(text_frame, height=10, wrap=tk.WORD)
+        self.tts_text.pack(fill=tk.BOTH, expand=True)
+        
+        # Voice selection
+        voice_frame = ttk.LabelFrame(self.tts_frame, text="Giọng nói", padding=10)
+        voice_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        ttk.Label(voice_frame, text="Chọn giọng:").pack(side=tk.LEFT)
+        self.voice_var = tk.StringVar(value="Zephyr")
+        voice_combo = ttk.Combobox(voice_frame, textvariable=self.voice_var,
+                                  values=TTS_VOICES)
+        voice_combo.pack(side=tk.LEFT, padx=(10, 0))
+        
+        self.tts_flac_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(voice_frame, text="Nén thêm FLAC (lossless)", 
+                       variable=self.tts_flac_var).pack(side=tk.LEFT, padx=(20, 0))
+        
+        # Dialogue mode
+        dialogue_frame = ttk.LabelFrame(self.tts_frame, text="Hội thoại (mỗi dòng \"Tên: lời thoại\")", padding=10)
+        dialogue_frame.pack(fill=tk.X, padx=10, pady=5)
+        
+        self.tts_dialogue_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(dialogue_frame, text="Nhiều người nói", 
+                       variable=self.tts_dialogue_var).pack(side=tk.LEFT)
+        ttk.Label(dialogue_frame, text="Giọng:").pack(side=tk.LEFT, padx=(20, 0))
+        self.dialogue_voices_var = tk.StringVar(value="")
+        ttk.Entry(dialogue_frame, textvariable=self.dialogue_voices_var, 
+                 width=40).pack(side=tk.LEFT, padx=(5, 0))
+        ttk.Label(dialogue_frame, text="vd. Lan=Kore, Minh=Puck (trống = tự gán)").pack(side=tk.LEFT, padx=(5, 0))
+        
+        # Generate / cancel buttons
+        button_frame = ttk.Frame(self.tts_frame)
+        button_frame.pack(pady=10)
+        
+        generate_btn = ttk.Button(button_frame, text="🎤 Generate Audio", 
+                                command=self.generate_tts)
+        generate_btn.pack(side=tk.LEFT)
+        self.operation_buttons.append(generate_btn)
+        
+        cancel_btn = ttk.Button(button_frame, text="⏹ Cancel", 
+                               command=self.cancel_operation)
+        cancel_btn.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Status
+        self.tts_status = ttk.Label(self.tts_frame, text="Sẵn sàng")
+        self.tts_status.pack(pady=5)
+        
+    def create_search_tab(self):
+        """Tạo tab Search"""
+        self.search_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.search_frame, text="🔍 Search")
+        
+        # Query input
+        query_frame = ttk.Frame(self.search_frame)
+        query_frame.pack(fill=tk.X, padx=10, pady=10)
+        
+        self.search_query_var = tk.StringVar()
+        query_entry = ttk.Entry(query_frame, textvariable=self.search_query_var)
+        query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        query_entry.bind("<Return>", lambda e: self.run_search())
+        
+        search_btn = ttk.Button(query_frame, text="🔍 Tìm", command=self.run_search)
+        search_btn.pack(side=tk.RIGHT, padx=(10, 0))
+        
+        # Results
+        columns = ("kind", "session", "content")
+        self.search_results = ttk.Treeview(self.search_frame, columns=columns, show="headings")
+        self.search_results.heading("kind", text="Loại")
+        self.search_results.heading("session", text="Session")
+        self.search_results.heading("content", text="Nội dung")
+        self.search_results.column("kind", width=110, stretch=False)
+        self.search_results.column("session", width=170, stretch=False)
+        self.search_results.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        self.search_results.bind("<Double-1>", lambda e: self.open_search_hit())
+        
+        self.search_status = ttk.Label(self.search_frame, text="Double-click để mở artifact")
+        self.search_status.pack(pady=5)
+        
+        self.search_hits = {}
+        self.search_index = None
+        
+    def _start_search_indexer(self):
+        """Cập nhật chỉ mục tìm kiếm trong nền: quét toàn bộ data/ một lần, sau đó chỉ quét session vừa ghi"""
+        if self.search_index is not None:
+            return
+        self.search_index = SearchIndex()
+        self.search_queue = queue.Queue()
+        self.search_queue.put(None)
+        threading.Thread(target=self._search_index_worker, daemon=True).start()
+        
+    def _search_index_worker(self):
+        while True:
+            pending = {self.search_queue.get()}
+            # Gộp các yêu cầu đang chờ (mỗi lần ghi log đều xếp hàng một lượt)
+            while True:
+                try:
+                    pending.add(self.search_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for session_folder in ([None] if None in pending else pending):
+                start_time = time.time()
+                try:
+                    changed = self.search_index.update(session_folder)
+                except Exception as e:
+                    self.logger.error(f"Lỗi khi cập nhật chỉ mục tìm kiếm: {str(e)}")
+                    continue
+                if changed:
+                    self.logger.info(f"Đã index lại {changed} file ({session_folder or 'toàn bộ data/'}) "
+                                     f"trong {time.time() - start_time:.3f} giây")
+                    
+    def run_search(self):
+        """Hiển thị kết quả tìm kiếm từ chỉ mục (chỉ mục được cập nhật trong nền khi ghi file)"""
+        query = self.search_query_var.get().strip()
+        if not query:
+            return
+            
+        self.logger.info(f"Tìm kiếm: {query}")
+        start_time = time.time()
+        
+        self._start_search_indexer()
+        hits = self.search_index.search(query)
+        
+        self.search_results.delete(*self.search_results.get_children())
+        self.search_hits = {}
+        for hit in hits:
+            preview = " ".join(hit["content"].split())[:200]
+            item = self.search_results.insert("", tk.END, values=(hit["kind"], hit["session"], preview))
+            self.search_hits[item] = hit
+            
+        elapsed = time.time() - start_time
+        self.logger.info(f"Tìm thấy {len(hits)} kết quả trong {elapsed:.3f} giây")
+        self.search_status.config(text=f"{len(hits)} kết quả ({elapsed:.3f} giây) - double-click để mở artifact")
+        
+    def open_search_hit(self):
+        """Mở artifact của kết quả đang chọn"""
+        selection = self.search_results.selection()
+        if not selection:
+            return
+        hit = self.search_hits.get(selection[0])
+        if hit:
+            self.logger.info(f"Mở artifact: {hit['path']}")
+            open_path(hit["path"])
+            
+    def create_archive_tab(self):
+        """Tạo tab Archive (export/import và xem session đã archive)"""
+        self.archive_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.archive_frame, text="📦 Archive")
+        
+        # Buttons
+        button_frame = ttk.Frame(self.archive_frame)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
+        
+        ttk.Button(button_frame, text="📤 Export session hiện tại", 
+                  command=self.export_current_session).pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="📥 Import archive", 
+                  command=self.import_session_archive).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Button(button_frame, text="📂 Mở archive", 
+                  command=self.open_session_archive).pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Member list + preview
+        content_frame = ttk.Frame(self.archive_frame)
+        content_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        
+        self.archive_members = ttk.Treeview(content_frame, columns=("size",), show="tree headings")
+        self.archive_members.heading("#0", text="Artifact")
+        self.archive_members.heading("size", text="Kích thước")
+        self.archive_members.column("size", width=100, stretch=False)
+        self.archive_members.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.archive_members.bind("<<TreeviewSelect>>", lambda e: self.preview_archive_member())
+        
+        self.archive_preview = ttk.Label(content_frame, text="Chưa mở archive", width=45, 
+                                        wraplength=320, justify=tk.LEFT)
+        self.archive_preview.pack(side=tk.RIGHT, fill=tk.BOTH, padx=(10, 0))
+        
+        self.archive_status = ttk.Label(self.archive_frame, text="")
+        self.archive_status.pack(pady=5)
+        
+        self.open_archive = None
+        
+    def export_current_session(self):
+        """Export session hiện tại thành một file archive"""
+        if not self.session_folder:
+            messagebox.showerror("Lỗi", "Chưa có session để export!")
+            return
+            
+        archive_path = filedialog.asksaveasfilename(
+            title="Lưu archive",
+            initialfile=f"{self.session_id}.zip",
+            defaultextension=".zip",
+            filetypes=[("Session archive", "*.zip")]
+        )
+        if not archive_path:
+            return
+            
+        self.logger.info(f"Đang export session {self.session_id} -> {archive_path}")
+        start_time = time.time()
+        try:
+            manifest = SessionArchive.export(self.session_folder, archive_path)
+        except Exception as e:
+            self.logger.error(f"Lỗi khi export session: {str(e)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi export session: {str(e)}")
+            return
+            
+        self.logger.info(f"Đã export {len(manifest['entries'])} file trong {time.time() - start_time:.2f} giây")
+        self.log_session(f"Export session -> {archive_path}")
+        messagebox.showinfo("Thành công", f"Session đã được export tại: {archive_path}")
+        
+    def import_session_archive(self):
+        """Import một archive thành folder trong data/"""
+        archive_path = filedialog.askopenfilename(
+            title="Chọn archive",
+            filetypes=[("Session archive", "*.zip")]
+        )
+        if not archive_path:
+            return
+            
+        self.logger.info(f"Đang import archive: {archive_path}")
+        try:
+            session_folder = SessionArchive.import_archive(archive_path)
+        except Exception as e:
+            self.logger.error(f"Lỗi khi import archive: {str(e)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi import archive: {str(e)}")
+            return
+            
+        self.logger.info(f"Đã import archive vào: {session_folder}")
+        messagebox.showinfo("Thành công", f"Session đã được import vào: {session_folder}")
+        
+    def open_session_archive(self):
+        """Mở archive để xem trực tiếp, không giải nén"""
+        archive_path = filedialog.askopenfilename(
+            title="Chọn archive",
+            filetypes=[("Session archive", "*.zip")]
+        )
+        if not archive_path:
+            return
+            
+        try:
+            archive = SessionArchive(archive_path)
+        except Exception as e:
+            self.logger.error(f"Lỗi khi mở archive: {str(e)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi mở archive: {str(e)}")
+            return
+            
+        if self.open_archive:
+            self.archive_preview.config(image="")
+            self.archive_preview.image = None
+            self.open_archive.close()
+        self.open_archive = archive
+        
+        self.archive_members.delete(*self.archive_members.get_children())
+        for entry in archive.manifest["entries"]:
+            self.archive_members.insert("", tk.END, iid=entry["name"], text=entry["name"], 
+                                        values=(f"{entry['size']:,}",))
+        
+        self.logger.info(f"Đã mở archive {archive_path}: {len(archive.entries)} artifact")
+        self.archive_status.config(text=f"{archive.session_id} - {len(archive.entries)} artifact")
+        
+    def preview_archive_member(self):
+        """Hiển thị artifact đang chọn trong archive"""
+        selection = self.archive_members.selection()
+        if not selection or not self.open_archive:
+            return
+        name = selection[0]
+        
+        try:
+            if name.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp")):
+                image = Image.open(io.BytesIO(self.open_archive.read(name)))
+                image.thumbnail((300, 300), Image.Resampling.LANCZOS)
+                photo = ImageTk.PhotoImage(image)
+                self.archive_preview.config(image=photo, text="")
+                self.archive_preview.image = photo
+            elif name.endswith(SessionArchive.COMPRESSED_EXTENSIONS):
+                text = bytes(self.open_archive.read(name)).decode("utf-8", errors="replace")
+                self.archive_preview.config(image="", text=text[:1500])
+                self.archive_preview.image = None
+            else:
+                size = self.open_archive.entries[name]["size"]
+                self.archive_preview.config(image="", text=f"{name}\n{size:,} bytes")
+                self.archive_preview.image = None
+        except Exception as e:
+            self.archive_preview.config(image="", text=f"Lỗi hiển thị: {str(e)}")
+            
+    def create_sessions_tab(self):
+        """Tạo tab Sessions (duyệt và mở lại session cũ)"""
+        self.sessions_frame = ttk.Frame(self.notebook)
+        self.notebook.add(self.sessions_frame, text="🗂️ Sessions")
+        
+        # Buttons
+        button_frame = ttk.Frame(self.sessions_frame)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
         
-        # Image input (optional)
-        image_frame = ttk.LabelFrame(self.video_frame, text="Ảnh đầu vào (tùy chọn)", padding=10)
-        image_frame.pack(fill=tk.X, padx=10, pady=5)
+        ttk.Button(button_frame, text="🔄 Làm mới", 
+                  command=self.refresh_sessions).pack(side=tk.LEFT)
+        resume_btn = ttk.Button(button_frame, text="▶️ Tiếp tục session", 
+                                command=self.resume_selected_session)
+        resume_btn.pack(side=tk.LEFT, padx=(10, 0))
+        self.operation_buttons.append(resume_btn)
         
-        self.video_image_path_var = tk.StringVar()
-        path_entry = ttk.Entry(image_frame, textvariable=self.video_image_path_var, 
-                              state=tk.DISABLED)
-        path_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 10))
+        # Session list | artifact list + preview
+        content_frame = ttk.Frame(self.sessions_frame)
+        content_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
         
-        browse_btn = ttk.Button(image_frame, text="📁 Browse", 
-                              command=self.browse_video_image)
-        browse_btn.pack(side=tk.RIGHT)
+        self.session_list = ttk.Treeview(content_frame, columns=("created_at",), show="headings", 
+                                         selectmode="browse")
+        self.session_list.heading("created_at", text="Session")
+        self.session_list.column("created_at", width=200, stretch=False)
+        self.session_list.pack(side=tk.LEFT, fill=tk.Y)
+        self.session_list.bind("<<TreeviewSelect>>", lambda e: self.show_session_artifacts())
+        self.session_list.bind("<Double-1>", lambda e: self.resume_selected_session())
         
-        # Settings
-        settings_frame = ttk.LabelFrame(self.video_frame, text="Cài đặt", padding=10)
-        settings_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.session_artifacts = ttk.Treeview(content_frame, columns=("size",), show="tree headings")
+        self.session_artifacts.heading("#0", text="Artifact (mới nhất trước)")
+        self.session_artifacts.heading("size", text="Kích thước")
+        self.session_artifacts.column("size", width=100, stretch=False)
+        artifact_scroll = ttk.Scrollbar(content_frame, orient=tk.VERTICAL, command=self.session_artifacts.yview)
+        # Nạp trang artifact tiếp theo khi cuộn tới cuối danh sách
+        self.session_artifacts.config(yscrollcommand=lambda first, last: self._on_artifact_scroll(artifact_scroll, first, last))
+        self.session_artifacts.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=(10, 0))
+        artifact_scroll.pack(side=tk.LEFT, fill=tk.Y)
+        self.session_artifacts.bind("<<TreeviewSelect>>", lambda e: self.preview_session_artifact())
+        self.session_artifacts.bind("<Double-1>", lambda e: self.open_session_artifact())
         
-        # Aspect ratio
-        ttk.Label(settings_frame, text="Tỷ lệ khung hình:").grid(row=0, column=0, sticky=tk.W)
-        self.aspect_ratio = tk.StringVar(value="16:9")
-        aspect_combo = ttk.Combobox(settings_frame, textvariable=self.aspect_ratio, 
-                                   values=["16:9", "9:16", "1:1"])
-        aspect_combo.grid(row=0, column=1, sticky=tk.W, padx=(10, 0))
+        self.session_preview = ttk.Label(content_frame, text="Chọn session để xem artifact", width=45, 
+                                        wraplength=320, justify=tk.LEFT)
+        self.session_preview.pack(side=tk.RIGHT, fill=tk.BOTH, padx=(10, 0))
         
-        # Resolution
-        ttk.Label(settings_frame, text="Độ phân giải:").grid(row=1, column=0, sticky=tk.W)
-        self.resolution = tk.StringVar(value="720p")
-        res_combo = ttk.Combobox(settings_frame, textvariable=self.resolution, 
-                                values=["720p", "1080p"])
-        res_combo.grid(row=1, column=1, sticky=tk.W, padx=(10, 0))
+        self.sessions_status = ttk.Label(self.sessions_frame, text="")
+        self.sessions_status.pack(pady=5)
         
-        # Generate button
-        generate_btn = ttk.Button(self.video_frame, text="🎬 Generate Video", 
-                               command=self.generate_video)
-        generate_btn.pack(pady=10)
+        self.session_infos = {}
+        self.session_artifact_list = []
+        self.session_artifact_loaded = 0
         
-        # Progress bar
-        self.progress_var = tk.StringVar(value="Sẵn sàng")
-        self.progress_label = ttk.Label(self.video_frame, textvariable=self.progress_var)
-        self.progress_label.pack(pady=5)
+    def refresh_sessions(self):
+        """Liệt kê các data/session_*"""
+        sessions = list_sessions()
+        self.session_list.delete(*self.session_list.get_children())
+        self.session_infos = {}
+        for info in sessions:
+            label = info["session_id"] + (" (hiện tại)" if info["session_id"] == self.session_id else "")
+            self.session_list.insert("", tk.END, iid=info["path"], values=(label,))
+            self.session_infos[info["path"]] = info
+        self.sessions_status.config(text=f"{len(sessions)} session - double-click để tiếp tục session")
         
-        self.progress_bar = ttk.Progressbar(self.video_frame, mode='indeterminate')
-        self.progress_bar.pack(fill=tk.X, padx=10, pady=5)
+    def show_session_artifacts(self):
+        """Hiển thị trang artifact mới nhất của session đang chọn"""
+        selection = self.session_list.selection()
+        if not selection:
+            return
+        start_time = time.time()
+        self.session_artifact_list = list_session_artifacts(selection[0])
+        self.session_artifact_loaded = 0
+        self.session_artifacts.delete(*self.session_artifacts.get_children())
+        self._load_more_session_artifacts()
+        self.session_preview.config(image="", text="Chọn artifact để xem trước")
+        self.session_preview.image = None
+        self.logger.info(f"Liệt kê {len(self.session_artifact_list)} artifact của {selection[0]} "
+                         f"trong {time.time() - start_time:.3f} giây")
         
-    def create_tts_tab(self):
-        """Tạo tab Text-to-Speech"""
-        self.tts_frame = ttk.Frame(self.notebook)
-        self.notebook.add(self.tts_frame, text="🎤 TTS")
+    def _load_more_session_artifacts(self):
+        start = self.session_artifact_loaded
+        for artifact in self.session_artifact_list[start:start + SESSION_ARTIFACT_PAGE_SIZE]:
+            self.session_artifacts.insert("", tk.END, iid=artifact["path"], 
+                                          text=f"{artifact['folder']}/{artifact['name']}",
+                                          values=(f"{artifact['size']:,}",))
+        self.session_artifact_loaded = min(len(self.session_artifact_list), start + SESSION_ARTIFACT_PAGE_SIZE)
+        self.sessions_status.config(text=f"Đã hiển thị {self.session_artifact_loaded}/"
+                                         f"{len(self.session_artifact_list)} artifact")
         
-        # Text input
-        text_frame = ttk.LabelFrame(self.tts_frame, text="Văn bản", padding=10)
-        text_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+    def _on_artifact_scroll(self, scrollbar, first, last):
+        scrollbar.set(first, last)
+        if float(last) >= 1.0 and self.session_artifact_loaded < len(self.session_artifact_list):
+            self.root.after_idle(self._load_more_session_artifacts)
+            
+    def preview_session_artifact(self):
+        """Xem trước artifact đang chọn: thumbnail cho ảnh, prompt từ metadata cho video/audio"""
+        selection = self.session_artifacts.selection()
+        if not selection:
+            return
+        path = selection[0]
+        try:
+            if path.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp")):
+                # Thumbnail tạo trong process pool; thread Tk chỉ kiểm tra future bằng after()
+                self.session_preview.config(image="", text="Đang tạo thumbnail...")
+                self.session_preview.image = None
+                self._show_session_thumbnail(path, self.postprocessor.thumbnail_async(path))
+            else:
+                text = os.path.basename(path)
+                if os.path.exists(f"{path}.json"):
+                    with open(f"{path}.json", "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                    text += "\n\n" + (metadata.get("prompt") or metadata.get("text") or "")[:1500]
+                self.session_preview.config(image="", text=text)
+                self.session_preview.image = None
+        except Exception as e:
+            self.session_preview.config(image="", text=f"Lỗi hiển thị: {str(e)}")
+            
+    def _show_session_thumbnail(self, path, future):
+        if not future.done():
+            self.root.after(30, self._show_session_thumbnail, path, future)
+            return
+        selection = self.session_artifacts.selection()
+        if not selection or selection[0] != path:
+            return  # Người dùng đã chọn artifact khác
+        try:
+            with Image.open(future.result()) as image:
+                image.load()
+                photo = ImageTk.PhotoImage(image)
+            self.session_preview.config(image=photo, text="")
+            self.session_preview.image = photo
+        except Exception as e:
+            self.session_preview.config(image="", text=f"Lỗi hiển thị: {str(e)}")
+            
+    def open_session_artifact(self):
+        selection = self.session_artifacts.selection()
+        if selection:
+            self.logger.info(f"Mở artifact: {selection[0]}")
+            open_path(selection[0])
+            
+    def resume_selected_session(self):
+        """Tiếp tục session đang chọn thay cho session hiện tại"""
+        if self.operation_token is not None:
+            return  # Double-click trong lúc thao tác đang ghi vào session hiện tại
+        selection = self.session_list.selection()
+        if not selection:
+            messagebox.showerror("Lỗi", "Vui lòng chọn session!")
+            return
+        if not self.client and not self.service:
+            messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
+            return
+        self.resume_session(selection[0])
+        self.refresh_sessions()
         
-        self.tts_text = scrolledtext.ScrolledText(text_frame, height=10, wrap=tk.WORD)
-        self.tts_text.pack(fill=tk.BOTH, expand=True)
+    def resume_session(self, session_folder):
+        """Mở lại session cũ: chỉ nạp trang chat mới nhất làm ngữ cảnh và hiển thị, phần cũ hơn nạp khi cuộn"""
+        start_time = time.time()
+        self.logger.info(f"=== Tiếp tục session: {session_folder} ===")
         
-        # Voice selection
-        voice_frame = ttk.LabelFrame(self.tts_frame, text="Giọng nói", padding=10)
-        voice_frame.pack(fill=tk.X, padx=10, pady=5)
+        self.session_folder = session_folder
+        self.session_id = os.path.basename(os.path.normpath(session_folder))
+        for folder in ("images", "videos", "audio"):
+            os.makedirs(os.path.join(session_folder, folder), exist_ok=True)
+        self.profiler.output_dir = os.path.join(session_folder, "profiles")
         
-        ttk.Label(voice_frame, text="Chọn giọng:").pack(side=tk.LEFT)
-        self.voice_var = tk.StringVar(value="Zephyr")
-        voice_combo = ttk.Combobox(voice_frame, textvariable=self.voice_var,
-                                  values=["Zephyr", "Puck", "Charon", "Kore"])
-        voice_combo.pack(side=tk.LEFT, padx=(10, 0))
+        self.chat_store = ChatHistoryStore(session_folder)
+        recent = self.chat_store.read(len(self.chat_store) - CHAT_HISTORY_PAGE_SIZE, len(self.chat_store))
+        self.chat_history = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        self.chat_history.extend(m for m in recent if m.get("role") != "system")
+        self.chat_saved_count = len(self.chat_history)
+        self._show_latest_chat_page()
         
-        # Generate button
-        generate_btn = ttk.Button(self.tts_frame, text="🎤 Generate Audio", 
-                                command=self.generate_tts)
-        generate_btn.pack(pady=10)
+        self.logger.info(f"Đã mở lại session {self.session_id} ({len(self.chat_store)} message chat) "
+                         f"trong {time.time() - start_time:.3f} giây")
+        self.log_session("Session được mở lại")
+        self.status_label.config(text=f"✅ Đang dùng session {self.session_id}", foreground="green")
+            
+    def toggle_profiling(self):
+        """Bật/tắt profiling khi đang chạy"""
+        self.profiling_enabled = self.profile_var.get()
+        self.logger.info(f"Profiling: {'bật' if self.profiling_enabled else 'tắt'}")
         
-        # Status
-        self.tts_status = ttk.Label(self.tts_frame, text="Sẵn sàng")
-        self.tts_status.pack(pady=5)
+    def show_profile_summary(self):
+        """Tổng hợp các profile của session và mở file kết quả"""
+        summary = OperationProfiler.summarize(self.profiler.output_dir)
+        if not summary:
+            messagebox.showinfo("Profile", "Chưa có profile nào trong session này")
+            return
+            
+        summary_path = os.path.join(self.profiler.output_dir, "summary.txt")
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write(format_profile_summary(summary))
+        self.logger.info(f"Đã ghi tổng hợp profile: {summary_path}")
+        open_path(summary_path)
         
     def disable_all_tabs_except_settings(self):
         """Disable tất cả tabs trừ Settings"""
@@ -285,6 +4340,10 @@ Hướng dẫn sử dụng:
         """Lưu API key và khởi tạo session"""
         self.logger.info("=== Bắt đầu quá trình lưu API key ===")
         
+        if self.server_url:
+            self._connect_service()
+            return
+            
         api_key = self.api_key_var.get().strip()
         if not api_key:
             self.logger.warning("Người dùng chưa nhập API key")
@@ -295,7 +4354,11 @@ Hướng dẫn sử dụng:
         
         try:
             self.api_key = api_key
-            self.client = OpenAI(api_key=api_key, base_url="https://api.thucchien.ai")
+            self.client = OpenAI(api_key=api_key, base_url=API_BASE_URL, timeout=READ_TIMEOUT,
+                                 http_client=self.capture.httpx_client() if self.capture else None)
+            self.engine = GenerationEngine(api_key, self.logger, capture=self.capture,
+                                           file_refs=FileReferenceCache(os.path.join("data", "file_refs.json")),
+                                           postprocessor=self.postprocessor)
             self.logger.info("OpenAI client đã được khởi tạo thành công")
             
             # Test API key trước khi tiếp tục
@@ -321,6 +4384,22 @@ Hướng dẫn sử dụng:
             self.logger.error(f"Lỗi khi lưu API key: {str(e)}")
             messagebox.showerror("Lỗi", f"Lỗi khi lưu API key: {str(e)}")
     
+    def _connect_service(self):
+        """Kết nối tới server dùng chung thay vì gọi API trực tiếp (không cần API key ở client)"""
+        try:
+            service = ServiceClient(self.server_url, token=self.server_token)
+            info = service.health()
+        except GenerationError as e:
+            self.logger.error(f"Không kết nối được server: {str(e)}")
+            messagebox.showerror("Lỗi", f"Không kết nối được server {self.server_url}:\n{str(e)}")
+            return
+            
+        self.service = service
+        self.create_new_session()
+        self.enable_all_tabs()
+        self.status_label.config(text=f"✅ Đã kết nối server {self.server_url} ({info['session_id']})", foreground="green")
+        self.logger.info(f"Đã kết nối server {self.server_url}, session server: {info['session_id']}")
+        
     def _test_api_key(self):
         """Test API key với một request đơn giản"""
         try:
@@ -331,12 +4410,12 @@ Hướng dẫn sử dụng:
                 "Authorization": f"Bearer {self.api_key}"
             }
             payload = {
-                "model": "gemini-2.5-flash",
+                "model": default_model("chat"),
                 "messages": [{"role": "user", "content": "Hi"}],
                 "max_tokens": 10
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
+            response = self.engine.http.post(url, headers=headers, json=payload, timeout=10)
             if response.status_code == 200:
                 self.logger.info("API key hợp lệ")
                 return True
@@ -352,44 +4431,36 @@ Hướng dẫn sử dụng:
         """Tạo session mới với timestamp"""
         self.logger.info("=== Tạo session mới ===")
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.session_id = f"session_{timestamp}"
-        self.session_folder = os.path.join("data", self.session_id)
+        self.session_id, self.session_folder = create_session_folder()
         
         self.logger.info(f"Session ID: {self.session_id}")
         self.logger.info(f"Session folder: {self.session_folder}")
-        
-        # Tạo folder structure
-        os.makedirs(self.session_folder, exist_ok=True)
-        os.makedirs(os.path.join(self.session_folder, "images"), exist_ok=True)
-        os.makedirs(os.path.join(self.session_folder, "videos"), exist_ok=True)
-        os.makedirs(os.path.join(self.session_folder, "audio"), exist_ok=True)
-        
         self.logger.info("Đã tạo cấu trúc folder cho session")
-        
-        # Tạo session info
-        session_info = {
-            "session_id": self.session_id,
-            "created_at": datetime.now().isoformat(),
-            "api_calls": 0
-        }
-        
-        with open(os.path.join(self.session_folder, "session_info.json"), "w", encoding="utf-8") as f:
-            json.dump(session_info, f, ensure_ascii=False, indent=2)
-            
         self.logger.info("Đã tạo session_info.json")
         
+        self.profiler.output_dir = os.path.join(self.session_folder, "profiles")
+        
         # Initialize chat history
-        self.chat_history = [{"role": "system", "content": "Bạn là một trợ lý ảo thân thiện, chuyên nghiệp, nói tiếng Việt tự nhiên."}]
+        self.chat_store = ChatHistoryStore(self.session_folder)
+        self.chat_history = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        self.chat_saved_count = 0
+        self._show_latest_chat_page()
+        self.refresh_sessions()
+        self._start_search_indexer()
         
         self.logger.info("Session mới đã được tạo thành công")
         self.log_session("Session mới được tạo")
         
+        # Nạp chỉ mục prompt gần giống trong nền
+        threading.Thread(target=self.similarity_index.load_from_data_dir, daemon=True).start()
+        
     def send_chat_message(self):
-        """Gửi tin nhắn chat"""
+        """Gửi tin nhắn chat (request chạy trong thread nền, xem _start_operation)"""
+        if self.operation_token is not None:
+            return  # Ctrl+Enter trong lúc đang chờ: nút Send đang bị khóa
         self.logger.info("=== Bắt đầu quá trình chat ===")
         
-        if not self.client:
+        if not self.client and not self.service:
             self.logger.warning("Client chưa được khởi tạo, yêu cầu nhập API key")
             messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
             return
@@ -412,19 +4483,36 @@ Hướng dẫn sử dụng:
         self.display_chat_message("👤 Bạn", message)
         
         # Get AI response
-        try:
-            self.logger.info("Đang gọi API chat completions...")
-            start_time = time.time()
-            
-            response = self.client.chat.completions.create(
-                model="gemini-2.5-flash",
-                messages=self.chat_history
+        self.logger.info("Đang gọi API chat completions...")
+        start_time = time.time()
+        
+        prompt_chars = sum(len(m["content"]) for m in self.chat_history)
+        messages = list(self.chat_history)
+        latency_class = self.latency_class_var.get()
+        hedge = self.chat_hedge_var.get()
+        
+        def request(token):
+            if self.service:
+                return self.service.chat(messages, latency_class=latency_class)
+            if hedge:
+                ai_message, routing = self._hedged_chat_completion(messages, prompt_chars, token=token)
+                self.logger.info(f"Hedging: phản hồi thắng từ model {routing['model']}")
+                return ai_message, routing
+            response, routing = self.engine.router.call(
+                "chat",
+                lambda model: self.client.chat.completions.create(model=model, messages=messages),
+                latency_class=latency_class,
+                prompt_chars=prompt_chars
             )
+            return response.choices[0].message.content, routing
+            
+        def on_success(result):
+            ai_message, routing = result
+            self.save_chat_routing(routing)
             
             end_time = time.time()
             self.logger.info(f"API chat hoàn thành trong {end_time - start_time:.2f} giây")
             
-            ai_message = response.choices[0].message.content
             self.logger.info(f"Phản hồi AI: {ai_message[:50]}...")
             
             self.chat_history.append({"role": "assistant", "content": ai_message})
@@ -438,21 +4526,374 @@ Hướng dẫn sử dụng:
             
             self.log_session(f"Chat: User: {message[:30]}... | AI: {ai_message[:30]}...")
             
-        except Exception as e:
-            self.logger.error(f"Lỗi khi gọi API chat: {str(e)}")
-            messagebox.showerror("Lỗi", f"Lỗi khi gọi API: {str(e)}")
+        def on_error(error):
+            # Lượt người dùng chưa có trả lời không được ở lại lịch sử (tránh hai message user liên tiếp)
+            self._discard_last_user_turn()
+            if isinstance(error, OperationCancelled):
+                self.display_chat_message("⏹ Hệ thống", "Đã hủy yêu cầu", stored=False)
+                return
+            self.logger.error(f"Lỗi khi gọi API chat: {str(error)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi gọi API: {str(error)}")
+            
+        self._start_operation("chat", "chat", request, on_success, on_error)
+        
+    def _discard_last_user_turn(self):
+        """Bỏ lượt người dùng chưa có trả lời khỏi lịch sử; dòng đã hiển thị giữ lại như dòng không lưu"""
+        self.chat_history.pop()
+        if self.chat_entries and self.chat_entries[-1][0] == self._next_chat_index():
+            self.chat_display.mark_unset(self.chat_entries.pop()[1])
+            
+    def _get_hedge_threshold(self):
+        """Ngưỡng chờ token đầu tiên trước khi bắn request dự phòng"""
+        value = self.chat_hedge_threshold.get().strip()
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                self.logger.warning(f"Ngưỡng hedging không hợp lệ: {value}, dùng p95")
+        return self.chat_ttft.percentile(95, default=DEFAULT_HEDGE_THRESHOLD)
+        
+    def _start_chat_attempt(self, label, model, messages, results):
+        """Chạy một request chat streaming trong thread riêng"""
+        attempt = {
+            "label": label,
+            "model": model,
+            "settled": threading.Event(),  # set khi có token đầu tiên hoặc khi kết thúc
+            "cancelled": threading.Event(),
+            "stream": None,
+            "ttft": None
+        }
+        
+        def worker():
+            start_time = time.time()
+            chunks = []
+            try:
+                stream = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True
+                )
+                attempt["stream"] = stream
+                for chunk in stream:
+                    if attempt["cancelled"].is_set():
+                        break
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        if not chunks:
+                            ttft = time.time() - start_time
+                            self.chat_ttft.record(ttft)
+                            attempt["ttft"] = ttft
+                            self.logger.info(f"[{label}] {model}: token đầu tiên sau {ttft:.2f} giây")
+                            attempt["settled"].set()
+                        chunks.append(delta)
+                if attempt["cancelled"].is_set():
+                    return
+                self.engine.router.record(model, time.time() - start_time)
+                results.put((attempt, "".join(chunks), time.time() - start_time, None))
+            except Exception as e:
+                if not attempt["cancelled"].is_set():
+                    self.engine.router.record(model, time.time() - start_time, e)
+                    results.put((attempt, None, time.time() - start_time, e))
+            finally:
+                attempt["settled"].set()
+                
+        thread = threading.Thread(target=OperationProfiler.wrap(worker), daemon=True)
+        thread.start()
+        return attempt
+        
+    def _cancel_chat_attempt(self, attempt):
+        """Hủy request thua cuộc và đóng kết nối của nó"""
+        attempt["cancelled"].set()
+        stream = attempt["stream"]
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        self.logger.info(f"Đã hủy request [{attempt['label']}] {attempt['model']}")
+        
+    def _hedged_chat_completion(self, messages, prompt_chars=0, token=None):
+        """Gửi chat với hedging: nếu quá ngưỡng chưa có token đầu tiên thì bắn thêm một request dự phòng.
+        Request hoàn thành trước thắng, request còn lại bị hủy. Trả về (nội dung, quyết định định tuyến).
+        Hủy token thì đóng mọi request đang chạy và raise OperationCancelled"""
+        routing = self.engine.router.route("chat", self.latency_class_var.get(), prompt_chars)
+        primary_model = routing["model"]
+        hedge_model = self.chat_hedge_model.get().strip() or primary_model
+        threshold = self._get_hedge_threshold()
+        
+        results = queue.Queue()
+        if token is not None:
+            token.add_callback(lambda: results.put(None))
+        attempts = [self._start_chat_attempt("primary", primary_model, list(messages), results)]
+        
+        if not attempts[0]["settled"].wait(threshold) and not (token and token.cancelled):
+            self.logger.info(f"Chưa có token đầu tiên sau {threshold:.2f} giây, gửi request dự phòng tới {hedge_model}")
+            attempts.append(self._start_chat_attempt("hedge", hedge_model, list(messages), results))
+            
+        errors = []
+        while len(errors) < len(attempts):
+            item = results.get()
+            if item is None:
+                for attempt in attempts:
+                    self._cancel_chat_attempt(attempt)
+                raise OperationCancelled("Đã hủy chat")
+            attempt, content, elapsed, error = item
+            if error is not None:
+                self.logger.warning(f"[{attempt['label']}] {attempt['model']} lỗi: {error}")
+                errors.append(error)
+                if len(attempts) == 1:
+                    # Request chính lỗi trước ngưỡng: vẫn thử request dự phòng
+                    self.logger.info(f"Gửi request dự phòng tới {hedge_model}")
+                    attempts.append(self._start_chat_attempt("hedge", hedge_model, list(messages), results))
+                continue
+                
+            self.logger.info(f"[{attempt['label']}] {attempt['model']} hoàn thành trong {elapsed:.2f} giây")
+            for other in attempts:
+                if other is not attempt:
+                    self._cancel_chat_attempt(other)
+            self.log_session(f"Chat hedging: thắng [{attempt['label']}] {attempt['model']} ({elapsed:.2f}s, {len(attempts)} request)")
+            routing["model"] = attempt["model"]
+            routing["attempts"] = [{"model": a["model"], "label": a["label"], "ttft": a["ttft"]} for a in attempts]
+            return content, routing
+            
+        raise errors[0]
+        
+    def send_chat_fanout(self):
+        """Gửi cùng một tin nhắn tới nhiều model song song để so sánh"""
+        self.logger.info("=== Bắt đầu chat fan-out ===")
+        
+        if not self.client and not self.service:
+            self.logger.warning("Client chưa được khởi tạo, yêu cầu nhập API key")
+            messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
+            return
+            
+        message = self.chat_input.get("1.0", tk.END).strip()
+        if not message:
+            self.logger.warning("Tin nhắn rỗng, bỏ qua")
+            return
             
-    def display_chat_message(self, sender, message):
-        """Hiển thị tin nhắn trong chat"""
+        models = [m.strip() for m in self.chat_fanout_models.get().split(",") if m.strip()]
+        if not models:
+            messagebox.showerror("Lỗi", "Vui lòng nhập ít nhất một model cho fan-out!")
+            return
+            
+        self.logger.info(f"Fan-out tới {len(models)} model: {', '.join(models)}")
+        self.chat_input.delete("1.0", tk.END)
+        
+        self.chat_history.append({"role": "user", "content": message})
+        self.display_chat_message("👤 Bạn", message)
+        messages = list(self.chat_history)
+        
+        def call_model(model):
+            start_time = time.time()
+            try:
+                if self.service:
+                    content = self.service.chat(messages, model=model)[0]
+                    return model, content, time.time() - start_time, None
+                response = self.client.chat.completions.create(model=model, messages=messages)
+                self.engine.router.record(model, time.time() - start_time)
+                return model, response.choices[0].message.content, time.time() - start_time, None
+            except Exception as e:
+                if not self.service:
+                    self.engine.router.record(model, time.time() - start_time, e)
+                return model, None, time.time() - start_time, str(e)
+                
+        def request(token):
+            with ThreadPoolExecutor(max_workers=len(models)) as executor:
+                return list(executor.map(OperationProfiler.wrap(call_model), models))
+                
+        def on_error(error):
+            self._discard_last_user_turn()
+            if isinstance(error, OperationCancelled):
+                self.display_chat_message("⏹ Hệ thống", "Đã hủy fan-out", stored=False)
+                return
+            self.logger.error(f"Lỗi khi chat fan-out: {str(error)}")
+            messagebox.showerror("Lỗi", str(error))
+            
+        self._start_operation("chat fan-out", "chat_fanout", request, self._finish_chat_fanout, on_error)
+        
+    def _finish_chat_fanout(self, results):
+        message = self.chat_history[-1]["content"]
+        record = {
+            "prompt": message,
+            "created_at": datetime.now().isoformat(),
+            "results": []
+        }
+        first_answer = None
+        for model, content, elapsed, error in results:
+            self.logger.info(f"Fan-out {model}: {elapsed:.2f} giây" + (f" - lỗi: {error}" if error else ""))
+            record["results"].append({
+                "model": model,
+                "latency_seconds": round(elapsed, 3),
+                "content": content,
+                "error": error
+            })
+            if error:
+                self.display_chat_message(f"⚠️ {model} ({elapsed:.2f}s)", f"Lỗi: {error}", stored=False)
+            else:
+                self.display_chat_message(f"🤖 {model} ({elapsed:.2f}s)", content, stored=False)
+                if first_answer is None:
+                    first_answer = content
+                    
+        # Giữ lịch sử liền mạch: dùng câu trả lời của model đầu tiên thành công
+        if first_answer is not None:
+            self.chat_history.append({"role": "assistant", "content": first_answer})
+        else:
+            self._discard_last_user_turn()
+        self.save_chat_history()
+        
+        fanout_file = os.path.join(self.session_folder, "chat_fanout.json")
+        records = []
+        if os.path.exists(fanout_file):
+            with open(fanout_file, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        records.append(record)
+        with open(fanout_file, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+            
+        latencies = ", ".join(f"{r['model']}={r['latency_seconds']}s" for r in record["results"])
+        self.log_session(f"Chat fan-out: {message[:30]}... | {latencies}")
+        
+    def display_chat_message(self, sender, message, stored=True):
+        """Hiển thị tin nhắn trong chat. stored=False cho dòng chỉ để hiển thị (kết quả fan-out, lỗi),
+        không tương ứng với message nào trong lịch sử"""
+        if not self.chat_at_latest:
+            self._show_latest_chat_page()
         self.chat_display.config(state=tk.NORMAL)
+        start = self.chat_display.index("end-1c")
         self.chat_display.insert(tk.END, f"{sender}: {message}\n\n")
+        if stored:
+            # Message vừa thêm vào chat_history sẽ có chỉ số này trong chat_store khi được lưu
+            self.chat_entries.append((self._next_chat_index() - 1, self._new_chat_mark(start)))
+            if len(self.chat_entries) > CHAT_DISPLAY_MAX_MESSAGES:
+                self._trim_chat_window(from_top=True)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+        
+    def _next_chat_index(self):
+        """Chỉ số (trong chat_store) mà message tiếp theo của chat_history sẽ nhận"""
+        return len(self.chat_store) + len(self.chat_history) - self.chat_saved_count
+        
+    def _chat_sender(self, message):
+        return "👤 Bạn" if message.get("role") == "user" else "🤖 AI"
+        
+    def _new_chat_mark(self, index):
+        """Đặt mark đầu một message trong khung chat (gravity phải: chèn trang cũ ở 1.0 đẩy mark xuống)"""
+        self.chat_mark_counter += 1
+        mark = f"chat_{self.chat_mark_counter}"
+        self.chat_display.mark_set(mark, index)
+        return mark
+        
+    def _show_latest_chat_page(self):
+        """Vẽ lại khung chat với trang message mới nhất của chat_store"""
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.delete("1.0", tk.END)
+        for _, mark in self.chat_entries:
+            self.chat_display.mark_unset(mark)
+        self.chat_entries.clear()
+        
+        end = len(self.chat_store) if self.chat_store else 0
+        start = max(0, end - CHAT_HISTORY_PAGE_SIZE)
+        for offset, message in enumerate(self.chat_store.read(start, end) if self.chat_store else []):
+            if message.get("role") == "system":
+                continue
+            position = self.chat_display.index("end-1c")
+            self.chat_display.insert(tk.END, f"{self._chat_sender(message)}: {message.get('content') or ''}\n\n")
+            self.chat_entries.append((start + offset, self._new_chat_mark(position)))
+        self.chat_window_start, self.chat_window_end = start, end
+        self.chat_at_latest = True
         self.chat_display.config(state=tk.DISABLED)
         self.chat_display.see(tk.END)
         
+    def _trim_chat_window(self, from_top):
+        """Giữ khung chat trong giới hạn CHAT_DISPLAY_MAX_MESSAGES, bỏ message ở phía xa vị trí đang xem"""
+        excess = len(self.chat_entries) - CHAT_DISPLAY_MAX_MESSAGES
+        if excess <= 0:
+            return
+        if from_top:
+            for _ in range(excess):
+                self.chat_display.mark_unset(self.chat_entries.popleft()[1])
+            self.chat_display.delete("1.0", self.chat_entries[0][1])
+            self.chat_window_start = self.chat_entries[0][0]
+        else:
+            trimmed = [self.chat_entries.pop() for _ in range(excess)]
+            self.chat_display.delete(trimmed[-1][1], tk.END)
+            for _, mark in trimmed:
+                self.chat_display.mark_unset(mark)
+            self.chat_window_end = trimmed[-1][0]
+            self.chat_at_latest = False
+            
+    def _on_chat_scroll(self, first, last):
+        """yscrollcommand của khung chat: cập nhật scrollbar, nạp trang khi chạm mép"""
+        self.chat_display.vbar.set(first, last)
+        if self.chat_paging or not self.chat_store:
+            return
+        if float(first) <= 0.0 and self.chat_window_start > 0:
+            self.chat_paging = True
+            self.root.after_idle(self._load_older_chat_page)
+        elif float(last) >= 1.0 and not self.chat_at_latest:
+            self.chat_paging = True
+            self.root.after_idle(self._load_newer_chat_page)
+            
+    def _load_older_chat_page(self):
+        """Chèn trang message cũ hơn lên đầu khung chat, giữ nguyên vị trí đang xem"""
+        try:
+            start = max(0, self.chat_window_start - CHAT_HISTORY_PAGE_SIZE)
+            messages = self.chat_store.read(start, self.chat_window_start)
+            anchor = self.chat_entries[0][1] if self.chat_entries else None
+            self.chat_display.config(state=tk.NORMAL)
+            for offset in range(len(messages) - 1, -1, -1):
+                message = messages[offset]
+                if message.get("role") == "system":
+                    continue
+                self.chat_display.insert("1.0", f"{self._chat_sender(message)}: {message.get('content') or ''}\n\n")
+                self.chat_entries.appendleft((start + offset, self._new_chat_mark("1.0")))
+            self.chat_window_start = start
+            self._trim_chat_window(from_top=False)
+            self.chat_display.config(state=tk.DISABLED)
+            if anchor:
+                self.chat_display.yview(anchor)
+            self.logger.info(f"Đã nạp {len(messages)} message cũ hơn (từ #{start})")
+        finally:
+            self.chat_paging = False
+            
+    def _load_newer_chat_page(self):
+        """Nối trang message tiếp theo vào cuối khung chat (sau khi đã cuộn lên và bỏ bớt phần cuối)"""
+        try:
+            end = min(len(self.chat_store), self.chat_window_end + CHAT_HISTORY_PAGE_SIZE)
+            messages = self.chat_store.read(self.chat_window_end, end)
+            anchor = self.chat_entries[-1][1] if self.chat_entries else None
+            self.chat_display.config(state=tk.NORMAL)
+            for offset, message in enumerate(messages):
+                if message.get("role") == "system":
+                    continue
+                position = self.chat_display.index("end-1c")
+                self.chat_display.insert(tk.END, f"{self._chat_sender(message)}: {message.get('content') or ''}\n\n")
+                self.chat_entries.append((self.chat_window_end + offset, self._new_chat_mark(position)))
+            self.chat_window_end = end
+            self.chat_at_latest = end >= len(self.chat_store)
+            self._trim_chat_window(from_top=True)
+            self.chat_display.config(state=tk.DISABLED)
+            if anchor:
+                self.chat_display.see(anchor)
+        finally:
+            self.chat_paging = False
+        
     def save_chat_history(self):
-        """Lưu lịch sử chat"""
-        with open(os.path.join(self.session_folder, "chat_history.json"), "w", encoding="utf-8") as f:
-            json.dump(self.chat_history, f, ensure_ascii=False, indent=2)
+        """Lưu lịch sử chat: chỉ append các message chưa ghi vào chat_history.jsonl"""
+        self.chat_store.append(self.chat_history[self.chat_saved_count:])
+        self.chat_saved_count = len(self.chat_history)
+            
+    def save_chat_routing(self, routing):
+        """Ghi quyết định định tuyến model cho từng lượt chat"""
+        routing_file = os.path.join(self.session_folder, "chat_routing.json")
+        records = []
+        if os.path.exists(routing_file):
+            with open(routing_file, "r", encoding="utf-8") as f:
+                records = json.load(f)
+        records.append(dict(routing, turn=self._next_chat_index(), created_at=datetime.now().isoformat()))
+        with open(routing_file, "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
             
     def browse_image(self):
         """Chọn ảnh cho image-to-image mode"""
@@ -462,6 +4903,7 @@ Hướng dẫn sử dụng:
         )
         if file_path:
             self.image_path_var.set(file_path)
+            self.prefetch_input(file_path)
             
     def browse_video_image(self):
         """Chọn ảnh cho video generation"""
@@ -471,12 +4913,102 @@ Hướng dẫn sử dụng:
         )
         if file_path:
             self.video_image_path_var.set(file_path)
+            self.prefetch_input(file_path)
+            
+    def prefetch_input(self, file_path=None):
+        """Chuẩn bị trước ảnh đầu vào và kết nối API trong nền"""
+        if not self.engine:
+            return
+        if file_path:
+            self.logger.info(f"Prefetch ảnh đầu vào: {file_path}")
+            self.engine.prefetch_image(file_path)
+        self.engine.warm_up()
+            
+    def _start_operation(self, what, operation, func, on_success, on_error=None, partial_path=None):
+        """Chạy func(token) trong thread nền và trả về ngay; thread Tk kiểm tra kết quả bằng root.after rồi
+        gọi on_success(kết quả) hoặc on_error(lỗi) trên thread Tk (lỗi là OperationCancelled khi bị hủy).
+        Trong lúc chạy, các nút gửi/tạo/mở session bị khóa để không chen thao tác khác vào giữa.
+        Khi hủy: bỏ kết quả và xóa partial_path nếu đã được ghi. Request đi qua engine/server đóng kết nối
+        ngay; request của OpenAI client chạy nốt trong nền. operation là tên thao tác khi profile"""
+        if self.operation_token is not None:
+            self.logger.warning(f"Đang có thao tác khác chạy, bỏ qua {what}")
+            return False
+        state = {
+            "what": what,
+            "token": CancellationToken(),
+            "on_success": on_success,
+            "on_error": on_error,
+            "partial_path": partial_path
+        }
+        self.operation_token = state["token"]
+        self._set_operation_controls(tk.DISABLED)
+        
+        def worker():
+            try:
+                if self.profiling_enabled:
+                    state["result"] = self.profiler.run(operation, func, state["token"])
+                else:
+                    state["result"] = func(state["token"])
+            except Exception as e:
+                state["error"] = e
+            finally:
+                if state["token"].cancelled:
+                    self._remove_partial(partial_path)
+                    
+        state["thread"] = threading.Thread(target=worker, daemon=True)
+        state["thread"].start()
+        self.root.after(20, self._poll_operation, state)
+        return True
+        
+    def _poll_operation(self, state):
+        token, thread = state["token"], state["thread"]
+        if thread.is_alive() and not token.cancelled:
+            self.root.after(20, self._poll_operation, state)
+            return
+        self.operation_token = None
+        self._set_operation_controls(tk.NORMAL)
+        what = state["what"]
+        if token.cancelled:
+            if not thread.is_alive():
+                self._remove_partial(state["partial_path"])
+            self.logger.info(f"Đã hủy {what}")
+            error = OperationCancelled(f"Đã hủy {what}")
+        else:
+            error = state.get("error")
+        try:
+            if error is None:
+                state["on_success"](state["result"])
+            elif state["on_error"]:
+                state["on_error"](error)
+            elif not isinstance(error, OperationCancelled):
+                raise error
+        except Exception as e:
+            self.logger.error(f"Lỗi khi {what}: {str(e)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi {what}: {str(e)}")
+            
+    def _remove_partial(self, path):
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.logger.warning(f"Không xóa được file dở dang {path}: {str(e)}")
+                
+    def _set_operation_controls(self, state):
+        """Khóa/mở các nút bắt đầu thao tác mới hoặc đổi session"""
+        for button in self.operation_buttons:
+            button.config(state=state)
+            
+    def cancel_operation(self):
+        """Hủy thao tác ảnh/TTS/chat đang chạy"""
+        if self.operation_token and not self.operation_token.cancelled:
+            self.logger.info("Người dùng hủy thao tác đang chạy")
+            self.operation_token.cancel()
             
     def generate_image(self):
         """Tạo ảnh"""
         self.logger.info("=== Bắt đầu quá trình tạo ảnh ===")
         
-        if not self.client:
+        if not self.client and not self.service:
             self.logger.warning("Client chưa được khởi tạo, yêu cầu nhập API key")
             messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
             return
@@ -493,55 +5025,77 @@ Hướng dẫn sử dụng:
         
         try:
             if mode == "text_to_image":
+                reused_path = self._offer_similar_generation("text_to_image", prompt, "images")
+                if reused_path:
+                    self.update_image_preview(reused_path)
+                    return
+                    
                 self.logger.info("Bắt đầu tạo ảnh từ text...")
                 start_time = time.time()
                 
-                # Text to image - Y CHANG NOTEBOOK - dùng client.images.generate()
-                response = self.client.images.generate(
-                    model="gemini-2.5-flash-image-preview",
-                    prompt=prompt,
-                    n=1,
-                    extra_body={
-                        "aspect_ratio": "1:1"
-                    }
-                )
-                
-                end_time = time.time()
-                self.logger.info(f"API tạo ảnh hoàn thành trong {end_time - start_time:.2f} giây")
-                
-                # Save image - Y CHANG NOTEBOOK
-                b64_data = response.data[0].b64_json
-                image_data = base64.b64decode(b64_data)
-                self.logger.info(f"Đã decode ảnh, kích thước: {len(image_data)} bytes")
-                
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 filename = f"image_{timestamp}.png"
                 filepath = os.path.join(self.session_folder, "images", filename)
+                latency_class = self.latency_class_var.get()
                 
-                with open(filepath, "wb") as f:
-                    f.write(image_data)
-                    
-                self.logger.info(f"Đã lưu ảnh tại: {filepath}")
-                
-                # Update preview
-                self.update_image_preview(filepath)
-                self.logger.info("Đã cập nhật preview ảnh")
-                
-                # Save metadata
-                metadata = {
-                    "type": "text_to_image",
-                    "prompt": prompt,
-                    "filename": filename,
-                    "created_at": datetime.now().isoformat()
-                }
+                if self.service:
+                    def request(token):
+                        job = self.service.run_job("text_to_image", {"prompt": prompt, "latency_class": latency_class},
+                                                   token=token)
+                        self.service.download(job["artifacts"][0], filepath)
+                        return job["routing"], self.postprocessor.thumbnail(filepath)
+                else:
+                    def request(token):
+                        # Text to image - Y CHANG NOTEBOOK - dùng client.images.generate()
+                        response, routing = self.engine.router.call(
+                            "text_to_image",
+                            lambda model: self.client.images.generate(
+                                model=model,
+                                prompt=prompt,
+                                n=1,
+                                extra_body={
+                                    "aspect_ratio": "1:1"
+                                },
+                                timeout=IMAGE_TOTAL_BUDGET
+                            ),
+                            latency_class=latency_class,
+                            prompt_chars=len(prompt)
+                        )
+                        
+                        # Save image - Y CHANG NOTEBOOK (decode + thumbnail ngoài thread Tk)
+                        b64_data = response.data[0].b64_json
+                        return routing, self.postprocessor.process_image(b64_data, filepath, thumbnail=True)["thumbnail"]
                 
-                with open(os.path.join(self.session_folder, "images", f"{filename}.json"), "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+                def on_success(result):
+                    routing, thumbnail_path = result
                     
-                self.logger.info("Đã lưu metadata cho ảnh")
-                self.log_session(f"Image Generation (Text): {prompt[:30]}... -> {filename}")
+                    end_time = time.time()
+                    self.logger.info(f"API tạo ảnh hoàn thành trong {end_time - start_time:.2f} giây")
+                    self.logger.info(f"Đã lưu ảnh tại: {filepath} ({os.path.getsize(filepath)} bytes)")
+                    
+                    # Update preview
+                    self.update_image_preview(filepath, thumbnail_path)
+                    self.logger.info("Đã cập nhật preview ảnh")
+                    
+                    # Save metadata
+                    metadata = {
+                        "type": "text_to_image",
+                        "prompt": prompt,
+                        "filename": filename,
+                        "created_at": datetime.now().isoformat(),
+                        "routing": routing
+                    }
+                    
+                    with open(os.path.join(self.session_folder, "images", f"{filename}.json"), "w", encoding="utf-8") as f:
+                        json.dump(metadata, f, ensure_ascii=False, indent=2)
+                    
+                    self.logger.info("Đã lưu metadata cho ảnh")
+                    self.similarity_index.add("text_to_image", prompt, filepath, metadata=metadata)
+                    self.log_session(f"Image Generation (Text): {prompt[:30]}... -> {filename}")
+                    
+                    messagebox.showinfo("Thành công", f"Ảnh đã được tạo và lưu tại: {filepath}")
                 
-                messagebox.showinfo("Thành công", f"Ảnh đã được tạo và lưu tại: {filepath}")
+                self._start_operation("tạo ảnh", "image", request, on_success, partial_path=filepath)
                 
             else:  # image_to_image
                 self.logger.info("Bắt đầu tạo ảnh từ ảnh có sẵn...")
@@ -554,132 +5108,137 @@ Hướng dẫn sử dụng:
                     
                 self.logger.info(f"Ảnh đầu vào: {image_path}")
                 
-                # Read and encode image
-                with open(image_path, "rb") as f:
-                    image_b64 = base64.b64encode(f.read()).decode("utf-8")
-                    
-                self.logger.info(f"Đã encode ảnh, kích thước base64: {len(image_b64)} characters")
-                    
-                # Call Gemini API for image-to-image
-                self.logger.info("Đang gọi Gemini API cho image-to-image...")
-                start_time = time.time()
-                
-                headers = {
-                    "x-goog-api-key": self.api_key,
-                    "Content-Type": "application/json"
-                }
-                
-                payload = {
-                    "contents": [{
-                        "parts": [
-                            {
-                                "text": (
-                                    f"Here is an image. Please generate a new version "
-                                    f"based on this image with the following modification: {prompt}. "
-                                    f"The new image should reflect this change realistically."
-                                )
-                            },
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/png",
-                                    "data": image_b64
-                                }
-                            }
-                        ]
-                    }],
-                    "generationConfig": {
-                        "imageConfig": {
-                            "aspectRatio": "1:1"
-                        }
-                    }
-                }
-                
-                self.logger.info("Đang gửi request đến Gemini API...")
-                response = requests.post(
-                    "https://api.thucchien.ai/gemini/v1beta/models/gemini-2.5-flash-image-preview:generateContent",
-                    headers=headers,
-                    json=payload
-                )
-                
-                end_time = time.time()
-                self.logger.info(f"Gemini API hoàn thành trong {end_time - start_time:.2f} giây")
-                
-                if response.status_code != 200:
-                    self.logger.error(f"API error: {response.status_code} - {response.text}")
-                    messagebox.showerror("Lỗi", f"API error: {response.status_code} - {response.text}")
-                    return
-                    
-                data = response.json()
-                self.logger.info("Đã nhận được phản hồi từ Gemini API")
-                
-                # Extract image data - xử lý như trong notebook
-                try:
-                    parts = data["candidates"][0]["content"]["parts"]
-                    img_b64 = None
-                    for p in parts:
-                        if "inline_data" in p:
-                            img_b64 = p["inline_data"]["data"]
-                        elif "inlineData" in p:
-                            img_b64 = p["inlineData"]["data"]
-                            
-                    if not img_b64:
-                        self.logger.error("Gemini không trả về dữ liệu ảnh")
-                        messagebox.showerror("Lỗi", f"Gemini không trả về dữ liệu ảnh. Phản hồi API:\n{json.dumps(data, indent=2)}")
-                        return
-                        
-                    self.logger.info(f"Đã trích xuất dữ liệu ảnh, kích thước: {len(img_b64)} characters")
-                except Exception as e:
-                    self.logger.error(f"Lỗi khi xử lý phản hồi API: {str(e)}")
-                    messagebox.showerror("Lỗi", f"Lỗi khi xử lý phản hồi API: {str(e)}\n{json.dumps(data, indent=2)}")
+                if self.service:
+                    input_image_hash = image_dhash(image_path)
+                else:
+                    input_image_hash = self.engine.get_prepared_image(image_path)["dhash"]
+                reused_path = self._offer_similar_generation("image_to_image", prompt, "images", 
+                                                             image_hash=input_image_hash)
+                if reused_path:
+                    self.update_image_preview(reused_path)
                     return
-                    
-                # Save image
-                img_data = base64.b64decode(img_b64)
-                self.logger.info(f"Đã decode ảnh, kích thước: {len(img_data)} bytes")
                 
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 filename = f"image_edited_{timestamp}.png"
                 filepath = os.path.join(self.session_folder, "images", filename)
                 
-                with open(filepath, "wb") as f:
-                    f.write(img_data)
-                    
-                self.logger.info(f"Đã lưu ảnh chỉnh sửa tại: {filepath}")
-                
-                # Update preview
-                self.update_image_preview(filepath)
-                self.logger.info("Đã cập nhật preview ảnh")
+                latency_class = self.latency_class_var.get()
                 
-                # Save metadata
-                metadata = {
-                    "type": "image_to_image",
-                    "prompt": prompt,
-                    "input_image": image_path,
-                    "filename": filename,
-                    "created_at": datetime.now().isoformat()
-                }
+                def request(token):
+                    if self.service:
+                        job = self.service.run_job("image_edit", {"prompt": prompt, "latency_class": latency_class},
+                                                   image_path=image_path, token=token)
+                        self.service.download(job["artifacts"][0], filepath)
+                        return job["routing"], self.postprocessor.thumbnail(filepath)
+                    deadline = Deadline(total=IMAGE_TOTAL_BUDGET, token=token)
+                    info, routing = self.engine.router.call(
+                        "image_edit",
+                        lambda model: self.engine.edit_image(prompt, image_path, deadline=deadline, model=model,
+                                                             output_path=filepath, thumbnail=True),
+                        latency_class=latency_class,
+                        prompt_chars=len(prompt)
+                    )
+                    return routing, info["thumbnail"]
                 
-                with open(os.path.join(self.session_folder, "images", f"{filename}.json"), "w", encoding="utf-8") as f:
-                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+                def on_success(result):
+                    routing, thumbnail_path = result
+                    
+                    self.logger.info(f"Đã lưu ảnh chỉnh sửa tại: {filepath}")
+                    
+                    # Update preview
+                    self.update_image_preview(filepath, thumbnail_path)
+                    self.logger.info("Đã cập nhật preview ảnh")
+                    
+                    # Save metadata
+                    metadata = {
+                        "type": "image_to_image",
+                        "prompt": prompt,
+                        "input_image": image_path,
+                        "input_image_hash": input_image_hash,
+                        "filename": filename,
+                        "created_at": datetime.now().isoformat(),
+                        "routing": routing
+                    }
+                    
+                    with open(os.path.join(self.session_folder, "images", f"{filename}.json"), "w", encoding="utf-8") as f:
+                        json.dump(metadata, f, ensure_ascii=False, indent=2)
                     
-                self.logger.info("Đã lưu metadata cho ảnh chỉnh sửa")
-                self.log_session(f"Image Generation (Edit): {prompt[:30]}... -> {filename}")
+                    self.logger.info("Đã lưu metadata cho ảnh chỉnh sửa")
+                    self.similarity_index.add("image_to_image", prompt, filepath, 
+                                              image_hash=input_image_hash, metadata=metadata)
+                    self.log_session(f"Image Generation (Edit): {prompt[:30]}... -> {filename}")
+                    
+                    messagebox.showinfo("Thành công", f"Ảnh đã được chỉnh sửa và lưu tại: {filepath}")
                 
-                messagebox.showinfo("Thành công", f"Ảnh đã được chỉnh sửa và lưu tại: {filepath}")
+                self._start_operation("chỉnh sửa ảnh", "image", request, on_success, partial_path=filepath)
                 
         except Exception as e:
             self.logger.error(f"Lỗi khi tạo ảnh: {str(e)}")
             messagebox.showerror("Lỗi", f"Lỗi khi tạo ảnh: {str(e)}")
             
-    def update_image_preview(self, image_path):
-        """Cập nhật preview ảnh"""
+    def _offer_similar_generation(self, kind, prompt, folder, key="", image_hash=None):
+        """Tìm lần tạo gần giống trước đó và hỏi người dùng có muốn dùng lại không.
+        Trả về đường dẫn bản sao trong session hiện tại nếu dùng lại, ngược lại None"""
+        if not self.reuse_similar_var.get():
+            return None
+            
+        start_time = time.time()
+        matches = self.similarity_index.find_similar(kind, prompt, key=key, image_hash=image_hash)
+        self.logger.info(f"Tra cứu prompt gần giống: {len(matches)} kết quả trong {(time.time() - start_time) * 1000:.2f} ms")
+        if not matches:
+            return None
+            
+        similarity, entry = matches[0]
+        self.logger.info(f"Kết quả gần giống nhất ({similarity:.0%}): {entry['path']}")
+        if not messagebox.askyesno(
+            "Kết quả tương tự",
+            f"Đã có kết quả với prompt gần giống ({similarity:.0%}):\n\n{entry['prompt'][:300]}\n\n"
+            f"→ {entry['path']}\n\nDùng lại kết quả này thay vì tạo mới?"
+        ):
+            self.logger.info("Người dùng chọn tạo mới")
+            return None
+            
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        prefix = "audio" if folder == "audio" else "image"
+        filename = f"{prefix}_reused_{timestamp}{os.path.splitext(entry['path'])[1]}"
+        filepath = os.path.join(self.session_folder, folder, filename)
+        shutil.copy2(entry["path"], filepath)
+        
+        metadata = dict(entry["metadata"])
+        metadata.update({
+            "filename": filename,
+            "created_at": datetime.now().isoformat(),
+            "requested_prompt": prompt,
+            "reused_from": entry["path"],
+            "similarity": round(similarity, 3)
+        })
+        with open(os.path.join(self.session_folder, folder, f"{filename}.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+            
+        self.logger.info(f"Đã dùng lại kết quả cũ, lưu tại: {filepath}")
+        self.log_session(f"Reuse ({kind}): {prompt[:30]}... -> {filename} (từ {entry['path']})")
+        return filepath
+        
+    def update_image_preview(self, image_path, thumbnail_path=None):
+        """Cập nhật preview ảnh. Thumbnail được tạo ngoài thread Tk (thread worker hoặc process pool),
+        GUI chỉ đọc file nhỏ; chưa có thumbnail thì tạo trong pool và kiểm tra future bằng after()"""
+        self.image_preview_path = image_path
+        if thumbnail_path is None:
+            self.image_preview.config(image="", text="Đang tạo thumbnail...")
+            self.image_preview.image = None
+            try:
+                future = self.postprocessor.thumbnail_async(image_path)
+            except OSError as e:
+                self.image_preview.config(text=f"Lỗi hiển thị ảnh: {str(e)}")
+                return
+            self._poll_image_preview(image_path, future)
+            return
         try:
-            # Load and resize image for preview
-            image = Image.open(image_path)
-            image.thumbnail((300, 300), Image.Resampling.LANCZOS)
-            
-            # Convert to PhotoImage
-            photo = ImageTk.PhotoImage(image)
+            # Load thumbnail đã resize sẵn
+            with Image.open(thumbnail_path) as image:
+                image.load()
+                # Convert to PhotoImage
+                photo = ImageTk.PhotoImage(image)
             
             # Update label
             self.image_preview.config(image=photo, text="")
@@ -688,11 +5247,24 @@ Hướng dẫn sử dụng:
         except Exception as e:
             self.image_preview.config(text=f"Lỗi hiển thị ảnh: {str(e)}")
             
+    def _poll_image_preview(self, image_path, future):
+        if not future.done():
+            self.root.after(30, self._poll_image_preview, image_path, future)
+            return
+        if self.image_preview_path != image_path:
+            return  # Đã có preview mới hơn
+        try:
+            thumbnail_path = future.result()
+        except Exception as e:
+            self.image_preview.config(text=f"Lỗi hiển thị ảnh: {str(e)}")
+            return
+        self.update_image_preview(image_path, thumbnail_path)
+        
     def generate_video(self):
         """Tạo video (chạy trong thread riêng)"""
         self.logger.info("=== Bắt đầu quá trình tạo video ===")
         
-        if not self.client:
+        if not self.client and not self.service:
             self.logger.warning("Client chưa được khởi tạo, yêu cầu nhập API key")
             messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
             return
@@ -703,23 +5275,51 @@ Hướng dẫn sử dụng:
             messagebox.showerror("Lỗi", "Vui lòng nhập mô tả video!")
             return
             
-        self.logger.info(f"Prompt video: {prompt[:50]}...")
+        if self.video_batch_var.get():
+            prompts = [line.strip() for line in prompt.splitlines() if line.strip()]
+        else:
+            prompts = [prompt]
+        try:
+            sample_count = max(1, int(self.video_sample_count.get()))
+        except (tk.TclError, ValueError):
+            sample_count = 1
+            
+        self.logger.info(f"Prompt video: {prompt[:50]}... ({len(prompts)} prompt, {sample_count} mẫu/prompt)")
         self.logger.info("Bắt đầu tạo video trong thread riêng...")
         
         # Start video generation in separate thread
-        thread = threading.Thread(target=self._generate_video_thread, args=(prompt,))
+        self.video_cancel_token = CancellationToken()
+        deadline = Deadline(total=VIDEO_TOTAL_BUDGET, max_poll_duration=VIDEO_MAX_POLL_DURATION, 
+                            token=self.video_cancel_token)
+        thread = threading.Thread(target=self._generate_video_thread, args=(prompts, deadline, sample_count))
         thread.daemon = True
         thread.start()
         
-    def _generate_video_thread(self, prompt):
+    def cancel_video(self):
+        """Hủy video đang tạo"""
+        if self.video_cancel_token and not self.video_cancel_token.cancelled:
+            self.logger.info("Người dùng hủy tạo video")
+            self.progress_var.set("Đang hủy...")
+            self.video_cancel_token.cancel()
+            
+    @profiled("video")
+    def _generate_video_thread(self, prompts, deadline, sample_count=1):
         """Thread function để tạo video"""
+        summary = prompts[0] if len(prompts) == 1 else f"{len(prompts)} prompt"
         try:
+            if self.service:
+                saved = self._generate_video_remote(prompts, deadline, sample_count)
+                self.progress_var.set("Video đã hoàn thành!")
+                self.progress_bar.stop()
+                self.log_session(f"Video Generation (server): {summary[:30]}... -> completed ({len(saved)} video)")
+                return
+                
             self.logger.info("=== Bước 1: Tạo request video ===")
             # Step 1: Create video
             self.progress_var.set("Đang tạo video...")
             self.progress_bar.start()
             
-            operation_name = self._create_video_request(prompt)
+            operation_name, routing = self._create_video_request(prompts, deadline, sample_count)
             if not operation_name:
                 self.logger.error("Không thể tạo request video")
                 return
@@ -729,231 +5329,173 @@ Hướng dẫn sử dụng:
             # Step 2: Check progress
             self.logger.info("=== Bước 2: Kiểm tra tiến độ video ===")
             self.progress_var.set("Đang chờ video hoàn thành... (có thể mất vài phút)")
-            video_id = self._check_video_progress(operation_name)
-            if not video_id:
+            samples = self._check_video_progress(operation_name, deadline, model=routing["model"])
+            if not samples:
                 self.logger.error("Không thể lấy video ID")
                 self.progress_var.set("Lỗi: Không thể lấy video ID")
                 return
                 
-            self.logger.info(f"Video đã hoàn thành, video ID: {video_id}")
+            self.logger.info(f"Video đã hoàn thành, {len(samples)} mẫu")
                 
             # Step 3: Download video
             self.logger.info("=== Bước 3: Tải video ===")
-            self.progress_var.set("Đang tải video...")
-            self._download_video(video_id)
+            # generatedSamples xếp theo instance, mỗi instance sample_count mẫu
+            mapped = len(samples) == len(prompts) * sample_count
+            saved = []
+            for sample in samples:
+                self.progress_var.set(f"Đang tải video {len(saved) + 1}/{len(samples)}...")
+                instance_index = sample["sample_index"] // sample_count if mapped else None
+                sample_info = {
+                    "operation": operation_name,
+                    "sample_index": sample["sample_index"],
+                    "instance_index": instance_index,
+                    "sample_count": sample_count,
+                    "batch_size": len(prompts)
+                }
+                prompt = prompts[instance_index] if instance_index is not None else "\n".join(prompts)
+                filepath = self._download_video(sample["video_id"], prompt, deadline, 
+                                                sample_info if len(samples) > 1 else None, routing=routing)
+                if filepath:
+                    saved.append(filepath)
+            
+            if len(samples) > 1 and saved:
+                messagebox.showinfo("Thành công", f"Đã tải {len(saved)}/{len(samples)} video vào: "
+                                                  f"{os.path.join(self.session_folder, 'videos')}")
             
             self.progress_var.set("Video đã hoàn thành!")
             self.progress_bar.stop()
             self.logger.info("Quá trình tạo video hoàn thành thành công")
-            self.log_session(f"Video Generation: {prompt[:30]}... -> completed")
+            self.log_session(f"Video Generation: {summary[:30]}... -> completed ({len(saved)} video)")
             
+        except OperationCancelled:
+            self.logger.info("Đã hủy tạo video")
+            self.progress_var.set("Đã hủy")
+            self.progress_bar.stop()
+            self.log_session(f"Video Generation: {summary[:30]}... -> cancelled")
         except Exception as e:
             self.logger.error(f"Lỗi khi tạo video: {str(e)}")
             self.progress_var.set(f"Lỗi: {str(e)}")
             self.progress_bar.stop()
             messagebox.showerror("Lỗi", f"Lỗi khi tạo video: {str(e)}")
             
-    def _create_video_request(self, prompt):
-        """Tạo request video - theo đúng notebook"""
-        self.logger.info("Đang tạo request video...")
-        url = "https://api.thucchien.ai/gemini/v1beta/models/veo-3.0-generate-001:predictLongRunning"
-        
-        # Check if image is provided - theo đúng logic notebook
+    def _generate_video_remote(self, prompts, deadline, sample_count=1):
+        """Tạo video qua server dùng chung, tải các video về session hiện tại"""
+        self.progress_var.set("Đang gửi job video tới server...")
+        self.progress_bar.start()
         image_path = self.video_image_path_var.get()
-        image_obj = None
-        if image_path and os.path.exists(image_path):
-            self.logger.info(f"Sử dụng ảnh đầu vào: {image_path}")
-            with open(image_path, "rb") as f:
-                img_b64 = base64.b64encode(f.read()).decode("utf-8")
-            
-            # Sử dụng mimetypes như trong notebook
-            import mimetypes
-            mime_type, _ = mimetypes.guess_type(image_path)
-            if not mime_type:
-                mime_type = "image/png"
-                
-            image_obj = {
-                "bytesBase64Encoded": img_b64,
-                "mimeType": mime_type
-            }
-            self.logger.info(f"Đã encode ảnh, kích thước: {len(img_b64)} characters, mime_type: {mime_type}")
-        else:
-            self.logger.info("Không có ảnh đầu vào, tạo video từ text")
-            
-        instance = {"prompt": prompt}
-        if image_obj:
-            instance["image"] = image_obj
-            
-        payload = {
-            "instances": [instance],
-            "parameters": {
-                "negativePrompt": "blurry, low quality",
-                "aspectRatio": self.aspect_ratio.get(),
+        job = self.service.run_job(
+            "video",
+            {
+                "prompts": prompts,
+                "sample_count": sample_count,
+                "aspect_ratio": self.aspect_ratio.get(),
                 "resolution": self.resolution.get(),
-                "personGeneration": "allow_all" if not image_obj else "allow_adult"
-            }
-        }
-        
-        self.logger.info(f"Tạo video với prompt: {prompt}")
-        print(f"\nTao video voi prompt: {prompt}")
-        if image_obj:
-            self.logger.info(f"Sử dụng ảnh làm đầu vào: {image_path}")
-            print(f"Su dung anh lam dau vao: {image_path}")
-        self.logger.info(f"Payload video: aspect_ratio={self.aspect_ratio.get()}, resolution={self.resolution.get()}")
-        
-        headers = {
-            "Content-Type": "application/json",
-            "x-goog-api-key": self.api_key
-        }
-        
-        self.logger.info("Đang gửi request tạo video...")
-        start_time = time.time()
-        response = requests.post(url, headers=headers, json=payload)
-        end_time = time.time()
-        
-        self.logger.info(f"Request video hoàn thành trong {end_time - start_time:.2f} giây")
-        
-        if response.status_code != 200:
-            self.logger.error(f"Lỗi tạo video: {response.status_code} - {response.text}")
-            messagebox.showerror("Lỗi", f"Lỗi tạo video: {response.status_code}")
-            return None
-            
-        data = response.json()
-        operation_name = data.get("name")
-        if not operation_name:
-            self.logger.error("Không tìm thấy operation_name trong phản hồi")
-            self.logger.error(f"Phản hồi API: {json.dumps(data, indent=2)}")
-            messagebox.showerror("Lỗi", "Không tìm thấy operation_name trong phản hồi")
-            return None
-            
-            self.logger.info("Đã gửi yêu cầu tạo video thành công")
-        self.logger.info(f"Mã tiến trình (operation): {operation_name}")
-        print(f"Da gui yeu cau tao video thanh cong.")
-        print(f"Ma tien trinh (operation): {operation_name}")
-        return operation_name
-        
-    def _check_video_progress(self, operation_name):
-        """Kiểm tra tiến độ video - theo đúng notebook"""
-        self.logger.info(f"Bắt đầu kiểm tra tiến độ video: {operation_name}")
+                "latency_class": self.latency_class_var.get()
+            },
+            image_path=image_path if image_path and os.path.exists(image_path) else None,
+            on_progress=lambda progress: self.progress_var.set(f"Đang xử lý video trên server... {progress}%"),
+            token=deadline.token
+        )
         
-        # Xử lý URL như trong notebook
-        if operation_name.startswith("models/"):
-            url = f"https://api.thucchien.ai/gemini/v1beta/{operation_name}"
-        else:
-            url = f"https://api.thucchien.ai/gemini/v1beta/models/veo-3.0-generate-001/operations/{operation_name}"
+        saved = []
+        for artifact in job["artifacts"]:
+            self.progress_var.set(f"Đang tải video {len(saved) + 1}/{len(job['artifacts'])}...")
+            filepath = os.path.join(self.session_folder, "videos", artifact["name"])
+            self.service.download(artifact, filepath)
+            with open(f"{filepath}.json", "w", encoding="utf-8") as f:
+                json.dump(dict(artifact["metadata"], server_job=job["id"]), f, ensure_ascii=False, indent=2)
+            saved.append(filepath)
             
-        headers = {"x-goog-api-key": self.api_key}
+        if len(saved) == 1:
+            messagebox.showinfo("Thành công", f"Video đã được tải và lưu tại: {saved[0]}")
+        elif saved:
+            messagebox.showinfo("Thành công", f"Đã tải {len(saved)} video vào: {os.path.join(self.session_folder, 'videos')}")
+        return saved
         
-        self.logger.info("Đang kiểm tra tiến độ video...")
-        print("\nDang kiem tra tien do video...")
-        check_count = 0
+    def _create_video_request(self, prompts, deadline=None, sample_count=1):
+        """Tạo request video - theo đúng notebook"""
+        image_path = self.video_image_path_var.get()
+        try:
+            return self.engine.router.call(
+                "video",
+                lambda model: self.engine.create_video_batch(
+                    [{"prompt": prompt, "image_path": image_path} for prompt in prompts],
+                    aspect_ratio=self.aspect_ratio.get(),
+                    resolution=self.resolution.get(),
+                    sample_count=sample_count,
+                    deadline=deadline,
+                    model=model
+                ),
+                latency_class=self.latency_class_var.get(),
+                prompt_chars=sum(len(prompt) for prompt in prompts)
+            )
+        except OperationCancelled:
+            raise
+        except GenerationError as e:
+            messagebox.showerror("Lỗi", str(e))
+            return None, None
         
-        while True:
-            check_count += 1
-            self.logger.info(f"Kiểm tra tiến độ lần {check_count}...")
-            
-            response = requests.get(url, headers=headers)
-            if response.status_code != 200:
-                self.logger.error(f"Lỗi khi kiểm tra tiến độ: {response.status_code} - {response.text}")
-                messagebox.showerror("Lỗi", f"Lỗi khi kiểm tra tiến độ: {response.status_code}")
-                return None
-                
-            data = response.json()
-            done = data.get("done", False)
+    def _check_video_progress(self, operation_name, deadline=None, model=None):
+        """Kiểm tra tiến độ video - theo đúng notebook"""
+        def on_progress(progress):
+            self.progress_var.set(f"Đang xử lý video... {progress}% - chờ 60 giây...")
             
-            if done:
-                self.logger.info("Video đã hoàn thành!")
-                
-                # Extract video ID - theo đúng logic notebook
-                video_id = None
-                try:
-                    uri = (
-                        data["response"]["generateVideoResponse"]
-                        ["generatedSamples"][0]["video"]["uri"]
-                    )
-                    # Rút ID từ URI
-                    if ":download" in uri:
-                        video_id = uri.split("/")[-1].split(":")[0]
-                except Exception:
-                    # fallback cho cấu trúc cũ
-                    try:
-                        video_id = data["response"]["video"]["name"]
-                    except:
-                        pass
-                        
-                if not video_id:
-                    self.logger.error("Không tìm thấy video_id trong phản hồi")
-                    self.logger.error(f"Phản hồi API: {json.dumps(data, indent=2)}")
-                    messagebox.showerror("Lỗi", "Không thể trích xuất video ID")
-                    return None
-                    
-                self.logger.info(f"Video ID: {video_id}")
-                print(f"Video da hoan tat!")
-                print(f"Video ID: {video_id}")
-                return video_id
-            else:
-                progress = data.get("metadata", {}).get("progressPercent", "Đang xử lý")
-                self.logger.info(f"Tiến độ: {progress}% - chờ 60 giây trước khi kiểm tra lại...")
-                print(f"Tien do: {progress}% - cho 60 giay truoc khi kiem tra lai...")
-                self.progress_var.set(f"Đang xử lý video... {progress}% - chờ 60 giây...")
-                time.sleep(60)  # Chờ 60 giây như trong notebook
+        try:
+            return self.engine.wait_for_videos(operation_name, on_progress=on_progress, deadline=deadline, model=model)
+        except OperationCancelled:
+            raise
+        except GenerationError as e:
+            messagebox.showerror("Lỗi", str(e))
+            return None
                 
-    def _download_video(self, video_id):
-        """Tải video - theo đúng notebook"""
+    def _download_video(self, video_id, prompt=None, deadline=None, sample_info=None, routing=None):
+        """Tải video - theo đúng notebook. Với batch, sample_info được ghi vào metadata"""
         if not video_id:
             self.logger.error("Không có video_id để tải")
             messagebox.showerror("Lỗi", "Không có video_id để tải")
-            return
+            return None
             
-        self.logger.info(f"Bắt đầu tải video: {video_id}")
-        url = f"https://api.thucchien.ai/gemini/download/v1beta/files/{video_id}:download?alt=media"
-        headers = {"x-goog-api-key": self.api_key}
-        
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"video_{timestamp}.mp4"
+        if sample_info:
+            filename = f"video_{timestamp}_{sample_info['sample_index']}.mp4"
+        else:
+            filename = f"video_{timestamp}.mp4"
         filepath = os.path.join(self.session_folder, "videos", filename)
         
-        self.logger.info(f"Đang tải video về: {filepath}")
-        print(f"\nDang tai video ve: {filepath}")
-        start_time = time.time()
-        
-        response = requests.get(url, headers=headers, stream=True)
-        if response.status_code != 200:
-            self.logger.error(f"Lỗi khi tải video: {response.status_code} - {response.text}")
-            messagebox.showerror("Lỗi", f"Lỗi khi tải video: {response.status_code}")
-            return
-            
-        total_size = 0
-        with open(filepath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    total_size += len(chunk)
-                    
-        end_time = time.time()
-        self.logger.info(f"Video đã được tải thành công: {filepath}")
-        self.logger.info(f"Đã tải video hoàn thành trong {end_time - start_time:.2f} giây, kích thước: {total_size} bytes")
-        print(f"Video da duoc tai thanh cong: {filepath}")
+        try:
+            total_size = self.engine.download_video(video_id, filepath, deadline=deadline)
+        except OperationCancelled:
+            raise
+        except GenerationError as e:
+            messagebox.showerror("Lỗi", str(e))
+            return None
         
         # Save metadata
         metadata = {
             "video_id": video_id,
+            "prompt": prompt,
             "filename": filename,
             "created_at": datetime.now().isoformat(),
             "file_size": total_size
         }
+        if sample_info:
+            metadata.update(sample_info)
+        if routing:
+            metadata["routing"] = routing
         
         with open(os.path.join(self.session_folder, "videos", f"{filename}.json"), "w", encoding="utf-8") as f:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
             
         self.logger.info("Đã lưu metadata cho video")
-        messagebox.showinfo("Thành công", f"Video đã được tải và lưu tại: {filepath}")
+        if not sample_info:
+            messagebox.showinfo("Thành công", f"Video đã được tải và lưu tại: {filepath}")
+        return filepath
         
     def generate_tts(self):
         """Tạo text-to-speech với Gemini API"""
         self.logger.info("=== Bắt đầu quá trình tạo TTS ===")
         
-        if not self.api_key:
+        if not self.api_key and not self.service:
             self.logger.warning("API key chưa được khởi tạo, yêu cầu nhập API key")
             messagebox.showerror("Lỗi", "Vui lòng nhập API key trước!")
             return
@@ -964,95 +5506,535 @@ Hướng dẫn sử dụng:
             messagebox.showerror("Lỗi", "Vui lòng nhập văn bản!")
             return
             
+        if self.tts_dialogue_var.get():
+            self._generate_tts_dialogue(text)
+            return
+            
         voice = self.voice_var.get()
         self.logger.info(f"Tạo TTS với giọng: {voice}")
         self.logger.info(f"Văn bản: {text[:50]}...")
         
         try:
-            self.logger.info("Đang gọi Gemini API TTS...")
-            start_time = time.time()
-            
-            # Gọi Gemini API theo đúng tài liệu
-            url = "https://api.thucchien.ai/gemini/v1beta/models/gemini-2.5-flash-preview-tts:generateContent"
-            
-            headers = {
-                "x-goog-api-key": self.api_key,
-                "Content-Type": "application/json"
-            }
+            reused_path = self._offer_similar_generation("tts", text, "audio", key=voice)
+            if reused_path:
+                self.tts_status.config(text=f"♻️ Dùng lại audio: {os.path.basename(reused_path)}")
+                return
+                
+            latency_class = self.latency_class_var.get()
             
-            payload = {
-                "contents": [{
-                    "parts": [
-                        {"text": text}
-                    ]
-                }],
-                "generationConfig": {
-                    "responseModalities": ["AUDIO"],
-                    "speechConfig": {
-                        "voiceConfig": {
-                            "prebuiltVoiceConfig": {
-                                "voiceName": voice
-                            }
-                        }
-                    }
+            def request(token):
+                if self.service:
+                    job = self.service.run_job("tts", {"text": text, "voice": voice, "latency_class": latency_class},
+                                               token=token)
+                    return self.service.download(job["artifacts"][0]), job["artifacts"][0]["mime_type"], job["routing"]
+                deadline = Deadline(total=TTS_TOTAL_BUDGET, token=token)
+                (audio_data, mime_type), routing = self.engine.router.call(
+                    "tts",
+                    lambda model: self.engine.synthesize_speech(text, voice, deadline=deadline, model=model),
+                    latency_class=latency_class,
+                    prompt_chars=len(text)
+                )
+                return audio_data, mime_type, routing
+                
+            def on_success(result):
+                audio_data, mime_type, routing = result
+                # Save audio
+                encoding, sample_rate, channels = parse_audio_mime(mime_type)
+                self.logger.info(f"Audio mime type: {mime_type or 'không có'} -> {encoding}, rate={sample_rate}")
+                
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                extension = {"pcm16": "wav", "wav": "wav", "audio/mpeg": "mp3", "audio/ogg": "ogg"}.get(encoding, "bin")
+                filename = f"audio_{timestamp}.{extension}"
+                filepath = os.path.join(self.session_folder, "audio", filename)
+                
+                self.logger.info(f"Đang lưu audio tại: {filepath}")
+                
+                audio_info = {}
+                if encoding == "pcm16":
+                    file_size = write_wav_file(filepath, audio_data, sample_rate, channels)
+                    audio_info = pcm16_stats(audio_data, sample_rate, channels)
+                    audio_info["sample_rate"] = sample_rate
+                    audio_info["channels"] = channels
+                else:
+                    with open(filepath, "wb") as f:
+                        f.write(audio_data)
+                    file_size = len(audio_data)
+                            
+                self.logger.info(f"Đã lưu audio, kích thước: {file_size} bytes")
+                            
+                # Save metadata
+                metadata = {
+                    "text": text,
+                    "voice": voice,
+                    "filename": filename,
+                    "created_at": datetime.now().isoformat(),
+                    "file_size": file_size,
+                    "mime_type": mime_type,
+                    "routing": routing,
+                    **audio_info
                 }
-            }
+                
+                with open(os.path.join(self.session_folder, "audio", f"{filename}.json"), "w", encoding="utf-8") as f:
+                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+                    
+                if self.tts_flac_var.get() and extension == "wav":
+                    self._compress_audio_async(filepath)
+                    
+                self.logger.info("Đã lưu metadata cho audio")
+                self.similarity_index.add("tts", text, filepath, key=voice, metadata=metadata)
+                self.log_session(f"TTS: {text[:30]}... (voice: {voice}) -> {filename}")
+                
+                self.tts_status.config(text=f"✅ Audio đã được tạo: {filename}")
+                messagebox.showinfo("Thành công", f"Audio đã được tạo và lưu tại: {filepath}")
+                
+            def on_error(error):
+                if isinstance(error, OperationCancelled):
+                    self.tts_status.config(text="Đã hủy")
+                    return
+                self.logger.error(f"Lỗi khi tạo audio: {str(error)}")
+                self.tts_status.config(text="Lỗi")
+                messagebox.showerror("Lỗi", str(error))
+                
+            self.tts_status.config(text="Đang tạo audio...")
+            self._start_operation("tạo audio", "tts", request, on_success, on_error)
             
-            response = requests.post(url, headers=headers, json=payload)
+        except Exception as e:
+            self.logger.error(f"Lỗi khi tạo audio: {str(e)}")
+            messagebox.showerror("Lỗi", f"Lỗi khi tạo audio: {str(e)}")
             
-            end_time = time.time()
-            self.logger.info(f"API TTS hoàn thành trong {end_time - start_time:.2f} giây")
+    def _generate_tts_dialogue(self, script):
+        """Đọc hội thoại nhiều người nói thành một file WAV, metadata có mốc thời gian từng câu"""
+        voice_map = parse_voice_map(self.dialogue_voices_var.get())
+        try:
+            lines = parse_dialogue_script(script, known_speakers=voice_map)
+        except ValueError as e:
+            messagebox.showerror("Lỗi", str(e))
+            return
+        speakers = list(dict.fromkeys(line["speaker"] for line in lines))
+        voices = assign_speaker_voices(speakers, voice_map)
+        self.logger.info(f"TTS hội thoại: {len(lines)} câu, giọng: {voices}")
+        self.tts_status.config(text=f"Đang tạo hội thoại ({len(lines)} câu, {len(speakers)} người nói)...")
+        self.root.update_idletasks()
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"dialogue_{timestamp}.wav"
+        filepath = os.path.join(self.session_folder, "audio", filename)
+        latency_class = self.latency_class_var.get()
+        
+        def request(token):
+            if self.service:
+                job = self.service.run_job("dialogue", {"script": script, "voices": voices,
+                                                        "latency_class": latency_class}, token=token)
+                artifact = job["artifacts"][0]
+                file_size = self.service.download(artifact, filepath)
+                return dict(artifact["metadata"], filename=filename, server_job=job["id"]), file_size
+            deadline = Deadline(total=TTS_TOTAL_BUDGET, token=token)
+            return self.engine.router.call(
+                "tts",
+                lambda model: self.engine.synthesize_dialogue(lines, voices, deadline=deadline, model=model),
+                latency_class=latency_class,
+                prompt_chars=len(script)
+            )
             
-            if response.status_code != 200:
-                self.logger.error(f"API error: {response.status_code} - {response.text}")
-                messagebox.showerror("Lỗi", f"API error: {response.status_code}")
+        def on_success(result):
+            try:
+                if self.service:
+                    metadata, file_size = result
+                else:
+                    result, routing = result
+                    file_size = write_wav_file(filepath, result["pcm"], result["sample_rate"], result["channels"])
+                    metadata = {
+                        "type": "tts_dialogue",
+                        "text": script,
+                        "voices": voices,
+                        "filename": filename,
+                        "created_at": datetime.now().isoformat(),
+                        "file_size": file_size,
+                        "mime_type": "audio/wav",
+                        "routing": routing,
+                        "sample_rate": result["sample_rate"],
+                        "channels": result["channels"],
+                        "lines": result["lines"],
+                        "chunks": result["chunks"],
+                        **pcm16_stats(result["pcm"], result["sample_rate"], result["channels"])
+                    }
+                with open(f"{filepath}.json", "w", encoding="utf-8") as f:
+                    json.dump(metadata, f, ensure_ascii=False, indent=2)
+            except OSError as e:
+                # Không ghi được WAV/metadata (đầy đĩa, session bị xóa...)
+                on_error(e)
                 return
+                
+            if self.tts_flac_var.get():
+                self._compress_audio_async(filepath)
+                
+            self.similarity_index.add("tts", script, filepath, key=",".join(f"{s}={v}" for s, v in voices.items()),
+                                      metadata=metadata)
+            self.tts_status.config(text=f"✅ Hội thoại đã lưu: {filename} ({metadata.get('duration_seconds')} giây)")
+            self.log_session(f"TTS Dialogue: {len(lines)} câu, {len(speakers)} người nói -> {filename}")
+            self.logger.info(f"Đã lưu hội thoại: {filepath} ({file_size} bytes)")
             
-            # Lấy audio data từ response theo cấu trúc Gemini
-            data = response.json()
-            audio_b64 = data["candidates"][0]["content"]["parts"][0]["inlineData"]["data"]
-            audio_data = base64.b64decode(audio_b64)
-            
-            self.logger.info(f"Đã decode audio, kích thước: {len(audio_data)} bytes")
-            
-            # Save audio
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"audio_{timestamp}.wav"
-            filepath = os.path.join(self.session_folder, "audio", filename)
-            
-            self.logger.info(f"Đang lưu audio tại: {filepath}")
+        def on_error(error):
+            if isinstance(error, OperationCancelled):
+                self.tts_status.config(text="Đã hủy")
+                return
+            self.logger.error(f"Lỗi khi tạo hội thoại: {str(error)}")
+            self.tts_status.config(text="Lỗi")
+            messagebox.showerror("Lỗi", str(error))
             
-            with open(filepath, "wb") as f:
-                f.write(audio_data)
-                        
-            self.logger.info(f"Đã lưu audio, kích thước: {len(audio_data)} bytes")
-                        
-            # Save metadata
-            metadata = {
-                "text": text,
-                "voice": voice,
-                "filename": filename,
-                "created_at": datetime.now().isoformat(),
-                "file_size": len(audio_data)
-            }
+        self._start_operation("tạo hội thoại", "tts", request, on_success, on_error,
+                              partial_path=filepath if self.service else None)
+        
+    def _compress_audio_async(self, wav_path):
+        """Nén WAV sang FLAC trong process pool, cập nhật metadata khi xong"""
+        if self.audio_pool is None:
+            self.audio_pool = ProcessPoolExecutor(max_workers=2, mp_context=process_pool_context())
             
-            with open(os.path.join(self.session_folder, "audio", f"{filename}.json"), "w", encoding="utf-8") as f:
-                json.dump(metadata, f, ensure_ascii=False, indent=2)
+        flac_path = os.path.splitext(wav_path)[0] + ".flac"
+        self.logger.info(f"Đang nén FLAC trong nền: {flac_path}")
+        future = self.audio_pool.submit(encode_flac, wav_path, flac_path)
+        
+        def on_done(future):
+            try:
+                flac_size = future.result()
+            except Exception as e:
+                self.logger.error(f"Lỗi khi nén FLAC: {str(e)}")
+                return
                 
-            self.logger.info("Đã lưu metadata cho audio")
-            self.log_session(f"TTS: {text[:30]}... (voice: {voice}) -> {filename}")
-            
-            self.tts_status.config(text=f"✅ Audio đã được tạo: {filename}")
-            messagebox.showinfo("Thành công", f"Audio đã được tạo và lưu tại: {filepath}")
-            
-        except Exception as e:
-            self.logger.error(f"Lỗi khi tạo audio: {str(e)}")
-            messagebox.showerror("Lỗi", f"Lỗi khi tạo audio: {str(e)}")
+            metadata_path = f"{wav_path}.json"
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            metadata["flac_filename"] = os.path.basename(flac_path)
+            metadata["flac_size"] = flac_size
+            with open(metadata_path, "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            self.logger.info(f"Đã nén FLAC: {flac_path} ({flac_size} bytes, WAV {metadata['file_size']} bytes)")
             
+        future.add_done_callback(on_done)
+        
     def run(self):
         """Chạy ứng dụng"""
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self.postprocessor.shutdown()
 
-if __name__ == "__main__":
-    app = AIGenerator()
+def run_search_command(args):
+    """CLI: tìm kiếm trong chỉ mục full-text"""
+    index = SearchIndex(data_dir=args.data_dir)
+    try:
+        # Chỉ quét data/ khi được yêu cầu hoặc chỉ mục chưa từng được tạo; GUI cập nhật chỉ mục khi ghi
+        if args.refresh or index.is_empty():
+            index.update()
+        hits = index.search(args.query, limit=args.limit)
+    finally:
+        index.close()
+    for rank, hit in enumerate(hits, 1):
+        preview = " ".join(hit["content"].split())[:120]
+        print(f"{rank:3d}. [{hit['kind']}] {hit['session']}  {preview}")
+        print(f"     {hit['uri']}")
+    if not hits:
+        print("Không tìm thấy kết quả")
+
+
+def run_export_command(args):
+    """CLI: export một session folder thành archive"""
+    session_id = os.path.basename(os.path.normpath(args.session_folder))
+    output = args.output or f"{session_id}.zip"
+    manifest = SessionArchive.export(args.session_folder, output)
+    print(f"Đã export {len(manifest['entries'])} file -> {output}")
+
+
+def run_import_command(args):
+    """CLI: import archive vào data/"""
+    session_folder = SessionArchive.import_archive(args.archive, data_dir=args.data_dir)
+    print(f"Đã import vào: {session_folder}")
+
+
+def run_list_command(args):
+    """CLI: liệt kê artifact trong archive mà không giải nén"""
+    with SessionArchive(args.archive) as archive:
+        print(f"{archive.session_id} (export lúc {archive.manifest['exported_at']})")
+        for entry in archive.manifest["entries"]:
+            mode = "deflate" if entry["compressed"] else "stored"
+            print(f"{entry['size']:>12,}  {mode:<8} {entry['name']}")
+
+
+def cancel_on_sigint(callback):
+    """CLI: Ctrl+C lần đầu gọi callback (hủy token để thao tác đang chạy dừng và dọn file dở dang),
+    lần thứ hai thoát ngay bằng KeyboardInterrupt"""
+    def handler(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        callback()
+        
+    signal.signal(signal.SIGINT, handler)
+
+
+def run_watch_command(args):
+    """CLI: theo dõi hot folder và xử lý ảnh mới"""
+    api_key = args.api_key or os.environ.get("THUCCHIEN_API_KEY")
+    if not api_key and args.replay:
+        api_key = "replay"
+    if not api_key:
+        print("Thiếu API key: dùng --api-key hoặc biến môi trường THUCCHIEN_API_KEY")
+        sys.exit(1)
+        
+    logger = configure_logging()
+    session_id, session_folder = create_session_folder(args.data_dir)
+    logger.info(f"Hot folder session: {session_id}")
+    
+    watcher = HotFolderWatcher(
+        GenerationEngine(api_key, logger, capture=create_capture(args),
+                         file_refs=FileReferenceCache(os.path.join(args.data_dir, "file_refs.json"))),
+        args.input_dir,
+        session_folder,
+        mode=args.mode,
+        default_prompt=args.prompt,
+        max_workers=args.workers,
+        poll_interval=args.poll_interval,
+        video_options={"aspect_ratio": args.aspect_ratio, "resolution": args.resolution},
+        logger=logger
+    )
+    
+    def stop():
+        logger.info("Đang hủy các job đang chạy (Ctrl+C lần nữa để thoát ngay)")
+        watcher.stop()
+        
+    cancel_on_sigint(stop)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    logger.info("Đã dừng hot folder")
+
+
+def run_profile_summary_command(args):
+    """CLI: tổng hợp profile của một session"""
+    summary = OperationProfiler.summarize(os.path.join(args.session_folder, "profiles"), limit=args.limit)
+    if not summary:
+        print("Không có profile nào")
+        return
+    print(format_profile_summary(summary))
+
+
+def run_serve_command(args):
+    """CLI: chạy server tạo nội dung dùng chung cho nhiều client"""
+    api_key = args.api_key or os.environ.get("THUCCHIEN_API_KEY")
+    if not api_key and args.replay:
+        api_key = "replay"
+    if not api_key:
+        print("Thiếu API key: dùng --api-key hoặc biến môi trường THUCCHIEN_API_KEY")
+        sys.exit(1)
+    if args.host not in ("127.0.0.1", "localhost") and not args.token:
+        print("Cảnh báo: server mở ra mạng LAN mà không có --token, ai cũng dùng được quota của bạn")
+        
+    logger = configure_logging()
+    service = GenerationService(api_key, data_dir=args.data_dir, max_workers=args.workers, rate=args.rate, 
+                                burst=args.burst, logger=logger, capture=create_capture(args))
+    logger.info(f"Server session: {service.session_id}")
+    server = ServiceHTTPServer(service, host=args.host, port=args.port, token=args.token, logger=logger)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        logger.info("Đã dừng server")
+    finally:
+        service.shutdown()
+
+
+def create_capture(args):
+    """Tạo HttpCapture từ cờ --record / --replay (None nếu không dùng)"""
+    if args.record:
+        return HttpCapture(args.record, mode="record")
+    if args.replay:
+        return HttpCapture(args.replay, mode="replay", time_scale=args.replay_speed)
+    return None
+
+
+def _recorded_request_json(capture, path_suffix):
+    """Body JSON của request đầu tiên đã ghi có path kết thúc bằng path_suffix"""
+    for exchange in capture.exchanges:
+        if urlsplit(exchange["url"]).path.endswith(path_suffix):
+            try:
+                return json.loads(capture.load_body(exchange["request_body"]) or b"{}")
+            except ValueError:
+                return {}
+    return None
+
+
+def _bench_operations(capture, engine, workdir):
+    """Các thao tác có trong recording, mỗi thao tác là một hàm chạy lại toàn bộ luồng"""
+    operations = {}
+    
+    if _recorded_request_json(capture, f"{default_model('image_edit')}:generateContent") is not None:
+        image_path = os.path.join(workdir, "bench_input.png")
+        Image.new("RGB", (64, 64), (128, 128, 128)).save(image_path)
+        operations["image"] = lambda: engine.edit_image("bench", image_path)
+        
+    tts_request = _recorded_request_json(capture, f"{default_model('tts')}:generateContent")
+    if tts_request is not None:
+        try:
+            tts_text = tts_request["contents"][0]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            tts_text = "bench"
+        operations["tts"] = lambda: engine.synthesize_speech(tts_text, "Kore")
+        
+    if _recorded_request_json(capture, ":predictLongRunning") is not None:
+        def run_video():
+            operation_name = engine.create_video("bench")
+            for sample in engine.wait_for_videos(operation_name, poll_interval=0):
+                engine.download_video(sample["video_id"], os.path.join(workdir, f"bench_{sample['sample_index']}.mp4"))
+        operations["video"] = run_video
+        
+    chat_request = _recorded_request_json(capture, "/chat/completions")
+    image_gen_request = _recorded_request_json(capture, "/images/generations")
+    if (chat_request is not None or image_gen_request is not None) and httpx is not None:
+        client = OpenAI(api_key="replay", base_url=API_BASE_URL, http_client=capture.httpx_client())
+        if chat_request is not None:
+            operations["chat"] = lambda: client.chat.completions.create(
+                model=chat_request.get("model", default_model("chat")),
+                messages=chat_request.get("messages", [{"role": "user", "content": "bench"}])
+            )
+        if image_gen_request is not None:
+            operations["text_to_image"] = lambda: client.images.generate(
+                model=image_gen_request.get("model", default_model("text_to_image")),
+                prompt=image_gen_request.get("prompt", "bench")
+            )
+    return operations
+
+
+def run_bench_command(args):
+    """CLI: phát lại recording nhiều lần, báo p50/p95/throughput và so với baseline"""
+    capture = HttpCapture(args.replay_dir, mode="replay", time_scale=args.speed)
+    logger = logging.getLogger("bench")
+    logger.setLevel(logging.WARNING)
+    engine = GenerationEngine("replay", logger, capture=capture)
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        operations = _bench_operations(capture, engine, workdir)
+        if not operations:
+            print("Recording không chứa thao tác nào có thể benchmark")
+            sys.exit(1)
+            
+        with contextlib.redirect_stdout(io.StringIO()):  # Engine in tiến độ ra stdout
+            for name, operation in operations.items():
+                latencies = LatencyTracker(window=args.iterations, min_samples=1)
+                started = time.perf_counter()
+                for _ in range(args.iterations):
+                    capture.rewind()
+                    op_started = time.perf_counter()
+                    operation()
+                    latencies.record(time.perf_counter() - op_started)
+                total = time.perf_counter() - started
+                results[name] = {
+                    "iterations": args.iterations,
+                    "p50_ms": round(latencies.percentile(50) * 1000, 3),
+                    "p95_ms": round(latencies.percentile(95) * 1000, 3),
+                    "mean_ms": round(total / args.iterations * 1000, 3),
+                    "throughput_per_s": round(args.iterations / total, 2) if total else None
+                }
+    engine.prefetch_pool.shutdown(wait=False)
+    
+    if args.output == "json":
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'Thao tác':<14} {'p50 (ms)':>10} {'p95 (ms)':>10} {'mean (ms)':>10} {'ops/s':>8}")
+        for name, stats in results.items():
+            print(f"{name:<14} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} "
+                  f"{stats['mean_ms']:>10.2f} {stats['throughput_per_s'] or 0:>8.2f}")
+            
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, stats in results.items():
+            if name in baseline and stats["p95_ms"] > baseline[name]["p95_ms"] * (1 + args.tolerance):
+                regressions.append(f"{name}: p95 {stats['p95_ms']:.2f}ms > baseline {baseline[name]['p95_ms']:.2f}ms")
+        if regressions:
+            print("Hồi quy hiệu năng:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AI Multi-Modal Generator")
+    parser.add_argument("--profile", action="store_true", help="Profile CPU/bộ nhớ từng thao tác tạo nội dung")
+    capture_group = parser.add_mutually_exclusive_group()
+    capture_group.add_argument("--record", metavar="DIR", help="Ghi lại mọi request/response HTTP vào DIR")
+    capture_group.add_argument("--replay", metavar="DIR", help="Phát lại response đã ghi trong DIR thay vì gọi API")
+    parser.add_argument("--server", metavar="URL", help="Chạy GUI như client mỏng của server (xem lệnh serve)")
+    parser.add_argument("--server-token", help="Token của server (nếu server chạy với --token)")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="Hệ số độ trễ khi phát lại (0 = không chờ, 1 = như lúc ghi)")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    search_parser = subparsers.add_parser("search", help="Tìm kiếm prompt, chat và log trong mọi session")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--limit", type=int, default=20)
+    search_parser.add_argument("--data-dir", default="data")
+    search_parser.add_argument("--refresh", action="store_true",
+                               help="Quét lại data/ trước khi tìm (file do watch/serve hoặc công cụ khác ghi)")
+    search_parser.set_defaults(func=run_search_command)
+    
+    export_parser = subparsers.add_parser("export", help="Export session folder thành archive")
+    export_parser.add_argument("session_folder")
+    export_parser.add_argument("-o", "--output")
+    export_parser.set_defaults(func=run_export_command)
+    
+    import_parser = subparsers.add_parser("import", help="Import archive vào data/")
+    import_parser.add_argument("archive")
+    import_parser.add_argument("--data-dir", default="data")
+    import_parser.set_defaults(func=run_import_command)
+    
+    list_parser = subparsers.add_parser("ls", help="Liệt kê artifact trong archive")
+    list_parser.add_argument("archive")
+    list_parser.set_defaults(func=run_list_command)
+    
+    watch_parser = subparsers.add_parser("watch", help="Theo dõi thư mục và xử lý ảnh mới hàng loạt")
+    watch_parser.add_argument("input_dir")
+    watch_parser.add_argument("--mode", choices=["image", "video"], default="image")
+    watch_parser.add_argument("--prompt", help="Prompt mặc định khi ảnh không có file .txt đi kèm")
+    watch_parser.add_argument("--workers", type=int, default=2)
+    watch_parser.add_argument("--poll-interval", type=float, default=2.0)
+    watch_parser.add_argument("--aspect-ratio", default="16:9")
+    watch_parser.add_argument("--resolution", default="720p")
+    watch_parser.add_argument("--api-key")
+    watch_parser.add_argument("--data-dir", default="data")
+    watch_parser.set_defaults(func=run_watch_command)
+    
+    profile_parser = subparsers.add_parser("profile-summary", help="Tổng hợp profile của một session")
+    profile_parser.add_argument("session_folder")
+    profile_parser.add_argument("--limit", type=int, default=20)
+    profile_parser.set_defaults(func=run_profile_summary_command)
+    
+    serve_parser = subparsers.add_parser("serve", help="Chạy server HTTP dùng chung engine cho nhiều client")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8800)
+    serve_parser.add_argument("--token", help="Token client phải gửi (Authorization: Bearer ...)")
+    serve_parser.add_argument("--workers", type=int, default=4, help="Số job chạy song song")
+    serve_parser.add_argument("--rate", type=float, default=1.0, help="Số request/giây tối đa lên API (0 = không giới hạn)")
+    serve_parser.add_argument("--burst", type=int, default=4)
+    serve_parser.add_argument("--api-key")
+    serve_parser.add_argument("--data-dir", default="data")
+    serve_parser.set_defaults(func=run_serve_command)
+    
+    bench_parser = subparsers.add_parser("bench", help="Benchmark bằng cách phát lại một recording")
+    bench_parser.add_argument("replay_dir")
+    bench_parser.add_argument("--iterations", type=int, default=20)
+    bench_parser.add_argument("--speed", type=float, default=0.0, help="Hệ số độ trễ đã ghi (mặc định 0: chỉ đo phía client)")
+    bench_parser.add_argument("--output", choices=["table", "json"], default="table")
+    bench_parser.add_argument("--baseline", help="File JSON kết quả bench trước đó để so sánh")
+    bench_parser.add_argument("--tolerance", type=float, default=0.2, help="Mức chậm hơn baseline cho phép (0.2 = 20%%)")
+    bench_parser.set_defaults(func=run_bench_command)
+    
+    args = parser.parse_args()
+    if args.command:
+        args.func(args)
+        return
+        
+    app = AIGenerator(profile=args.profile, capture=create_capture(args), 
+                      server_url=args.server, server_token=args.server_token)
     app.run()
+
+
+if __name__ == "__main__":
+    main()
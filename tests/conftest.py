@@ -0,0 +1,5 @@
+import os
+import sys
+
+# ai_generator.py là một file đơn ở gốc repo, không phải package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
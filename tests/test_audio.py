@@ -0,0 +1,70 @@
+import shutil
+import struct
+import sys
+import wave
+
+import pytest
+
+from ai_generator import DEFAULT_TTS_SAMPLE_RATE, encode_flac, parse_audio_mime, pcm16_stats, write_wav_file
+
+
+def pcm(samples):
+    return struct.pack(f"<{len(samples)}h", *samples)
+
+
+def test_wav_file_is_readable(tmp_path):
+    data = pcm([0, 1000, -1000, 32767, -32768, 0])
+    path = str(tmp_path / "a.wav")
+
+    size = write_wav_file(path, data, 16000, channels=2)
+
+    assert size == 44 + len(data)
+    with wave.open(path, "rb") as wav:
+        assert (wav.getnchannels(), wav.getsampwidth(), wav.getframerate(), wav.getnframes()) == (2, 2, 16000, 3)
+        assert wav.readframes(3) == data
+
+
+def test_pcm16_stats():
+    stats = pcm16_stats(pcm([0, 100, -16384, 50] * 6000), 24000)
+
+    assert stats["duration_seconds"] == 1.0
+    assert stats["peak"] == 16384
+    assert stats["peak_dbfs"] == pytest.approx(-6.02, abs=0.01)
+
+
+def test_pcm16_stats_silence_and_odd_length():
+    stats = pcm16_stats(pcm([0, 0]) + b"\x01", 24000, channels=2)
+
+    assert stats == {"duration_seconds": 0.0, "peak": 0, "peak_dbfs": None}
+    assert pcm16_stats(b"", 24000)["duration_seconds"] == 0.0
+
+
+@pytest.mark.parametrize("mime_type, expected", [
+    ("audio/L16;codec=pcm;rate=24000", ("pcm16", 24000, 1)),
+    ("audio/pcm; rate=16000; channels=2", ("pcm16", 16000, 2)),
+    (None, ("pcm16", DEFAULT_TTS_SAMPLE_RATE, 1)),
+    ("audio/wav", ("wav", None, None)),
+    ("audio/MPEG", ("audio/mpeg", None, None)),
+])
+def test_parse_audio_mime(mime_type, expected):
+    assert parse_audio_mime(mime_type) == expected
+
+
+def test_encode_flac_without_encoder(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "soundfile", None)
+    monkeypatch.setattr(shutil, "which", lambda name: None)
+
+    with pytest.raises(RuntimeError):
+        encode_flac(str(tmp_path / "a.wav"), str(tmp_path / "a.flac"))
+
+
+@pytest.mark.skipif(not (shutil.which("flac") or shutil.which("ffmpeg")), reason="cần flac hoặc ffmpeg")
+def test_encode_flac(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "soundfile", None)
+    wav_path = str(tmp_path / "a.wav")
+    write_wav_file(wav_path, pcm([i % 200 - 100 for i in range(24000)]), 24000)
+
+    size = encode_flac(wav_path, str(tmp_path / "a.flac"))
+
+    assert size > 0
+    assert (tmp_path / "a.flac").read_bytes()[:4] == b"fLaC"
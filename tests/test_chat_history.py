@@ -0,0 +1,63 @@
+import json
+
+from ai_generator import ChatHistoryStore
+
+
+def messages(count):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"tin nhắn {i}"} for i in range(count)]
+
+
+def test_append_and_read_pages(tmp_path):
+    store = ChatHistoryStore(str(tmp_path))
+    store.append(messages(10))
+
+    assert len(store) == 10
+    assert store.read(0, 3) == messages(10)[:3]
+    assert store.read(7, 20) == messages(10)[7:]
+    assert store.read(5, 5) == []
+
+
+def test_offsets_survive_reopen(tmp_path):
+    ChatHistoryStore(str(tmp_path)).append(messages(4))
+    store = ChatHistoryStore(str(tmp_path))
+    store.append(messages(6)[4:])
+
+    assert len(store) == 6
+    assert store.read(3, 6) == messages(6)[3:]
+    assert list(store.offsets) == list(ChatHistoryStore(str(tmp_path)).offsets)
+
+
+def test_truncated_last_line_is_dropped(tmp_path):
+    ChatHistoryStore(str(tmp_path)).append(messages(3))
+    path = tmp_path / ChatHistoryStore.FILENAME
+    with open(path, "ab") as f:
+        f.write(b'{"role": "user", "content": "ghi d')
+
+    store = ChatHistoryStore(str(tmp_path))
+
+    assert len(store) == 3
+    assert path.read_bytes().endswith(b"\n")
+    store.append([{"role": "user", "content": "tiếp"}])
+    assert store.read(3, 4) == [{"role": "user", "content": "tiếp"}]
+
+
+def test_migrates_legacy_json_and_keeps_backup(tmp_path):
+    legacy = tmp_path / ChatHistoryStore.LEGACY_FILENAME
+    legacy.write_text(json.dumps(messages(3), ensure_ascii=False), encoding="utf-8")
+
+    store = ChatHistoryStore(str(tmp_path))
+
+    assert store.read(0, len(store)) == messages(3)
+    assert not legacy.exists()
+    assert json.loads((tmp_path / f"{ChatHistoryStore.LEGACY_FILENAME}.bak").read_text(encoding="utf-8")) == messages(3)
+
+
+def test_existing_jsonl_wins_over_legacy(tmp_path):
+    ChatHistoryStore(str(tmp_path)).append(messages(2))
+    legacy = tmp_path / ChatHistoryStore.LEGACY_FILENAME
+    legacy.write_text(json.dumps(messages(5)), encoding="utf-8")
+
+    store = ChatHistoryStore(str(tmp_path))
+
+    assert len(store) == 2
+    assert legacy.exists()
@@ -0,0 +1,34 @@
+import pytest
+
+from ai_generator import parse_dialogue_script
+
+
+def test_splits_speakers_and_joins_continuation_lines():
+    script = "An: Chào Bình.\nBình: Chào An,\ndạo này thế nào?\n\nAn: Khỏe."
+
+    assert parse_dialogue_script(script) == [
+        {"speaker": "An", "text": "Chào Bình."},
+        {"speaker": "Bình", "text": "Chào An, dạo này thế nào?"},
+        {"speaker": "An", "text": "Khỏe."},
+    ]
+
+
+def test_times_and_urls_are_not_speakers():
+    script = "An: Hẹn gặp lúc\n10:30 sáng mai nhé\nBình: Xem link\nhttps://example.com/a"
+
+    assert parse_dialogue_script(script) == [
+        {"speaker": "An", "text": "Hẹn gặp lúc 10:30 sáng mai nhé"},
+        {"speaker": "Bình", "text": "Xem link https://example.com/a"},
+    ]
+
+
+def test_known_speakers_may_break_the_name_pattern():
+    lines = parse_dialogue_script("R2D2: bíp\nLuke: chào", known_speakers={"R2D2": "Puck"})
+
+    assert [line["speaker"] for line in lines] == ["R2D2", "Luke"]
+
+
+@pytest.mark.parametrize("script", ["", "   \n\n", "10:30 không có người nói"])
+def test_rejects_scripts_without_speaker(script):
+    with pytest.raises(ValueError):
+        parse_dialogue_script(script)
@@ -0,0 +1,76 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from ai_generator import GenerationError, HttpCapture
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    calls = 0
+
+    def do_GET(self):
+        CountingHandler.calls += 1
+        body = b"z" * 10000 if self.path.startswith("/big") else f"lần {CountingHandler.calls}".encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    CountingHandler.calls = 0
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def recorded_session(directory, mode, time_scale=0):
+    capture = HttpCapture(str(directory), mode=mode, time_scale=time_scale)
+    session = requests.Session()
+    capture.install(session)
+    return capture, session
+
+
+def test_record_then_replay(tmp_path, server):
+    capture, session = recorded_session(tmp_path, "record")
+    recorded = [session.get(f"{server}/status?key=bí-mật").text for _ in range(2)]
+    big = session.get(f"{server}/big").content
+    assert CountingHandler.calls == 3
+
+    capture, session = recorded_session(tmp_path, "replay")
+    replayed = [session.get(f"{server}/status").text for _ in range(3)]
+
+    assert CountingHandler.calls == 3
+    # Theo đúng thứ tự đã ghi, hết hàng đợi thì lặp lại response cuối
+    assert replayed == recorded + recorded[-1:]
+    assert session.get(f"{server}/big").content == big
+    assert len(list((tmp_path / "blobs").iterdir())) == 1
+
+    capture.rewind()
+    assert session.get(f"{server}/status").text == recorded[0]
+
+
+def test_secrets_are_redacted(tmp_path, server):
+    capture, session = recorded_session(tmp_path, "record")
+    session.get(f"{server}/status?key=bí-mật", headers={"Authorization": "Bearer sk-123"})
+
+    log = (tmp_path / "exchanges.jsonl").read_text(encoding="utf-8")
+    assert "sk-123" not in log
+    assert "bí-mật" not in log and "b%C3%AD" not in log
+
+
+def test_replay_unknown_route_fails(tmp_path, server):
+    recorded_session(tmp_path, "record")[1].get(f"{server}/status")
+    capture, session = recorded_session(tmp_path, "replay")
+
+    with pytest.raises(GenerationError):
+        session.get(f"{server}/other")
@@ -0,0 +1,39 @@
+import threading
+import time
+
+import pytest
+
+from ai_generator import CancellationToken, OperationCancelled, RateLimiter
+
+
+def test_unlimited_never_waits():
+    limiter = RateLimiter(0)
+    start = time.monotonic()
+    for _ in range(1000):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_burst_then_rate():
+    limiter = RateLimiter(20, burst=3)
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.03
+
+    for _ in range(2):
+        limiter.acquire()
+    # 2 lượt thêm ở 20 lượt/giây cần khoảng 0.1 giây
+    assert time.monotonic() - start >= 0.09
+
+
+def test_cancel_while_waiting():
+    limiter = RateLimiter(0.1)
+    limiter.acquire()
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+
+    start = time.monotonic()
+    with pytest.raises(OperationCancelled):
+        limiter.acquire(token)
+    assert time.monotonic() - start < 2
@@ -0,0 +1,78 @@
+import json
+import zipfile
+
+import pytest
+
+from ai_generator import SessionArchive
+
+
+@pytest.fixture
+def session_folder(tmp_path):
+    folder = tmp_path / "src" / "session_20240101_120000"
+    (folder / "images").mkdir(parents=True)
+    (folder / "audio").mkdir()
+    (folder / "session_info.json").write_text(json.dumps({"session_id": folder.name}), encoding="utf-8")
+    (folder / "images" / "image_1.png").write_bytes(bytes(range(256)) * 8)
+    (folder / "images" / "image_1.png.json").write_text('{"prompt": "mèo"}', encoding="utf-8")
+    (folder / "audio" / "audio_1.wav").write_bytes(b"RIFF" + b"\x00" * 100)
+    return folder
+
+
+def test_round_trip(tmp_path, session_folder):
+    archive_path = str(tmp_path / "session.zip")
+    manifest = SessionArchive.export(str(session_folder), archive_path)
+
+    assert manifest["session_id"] == session_folder.name
+    with SessionArchive(archive_path) as archive:
+        assert sorted(archive.names("images/")) == ["images/image_1.png", "images/image_1.png.json"]
+        # Media lưu không nén, đọc thẳng từ mmap
+        assert bytes(archive.read("images/image_1.png")) == (session_folder / "images" / "image_1.png").read_bytes()
+        assert archive.read_json("images/image_1.png.json") == {"prompt": "mèo"}
+
+    data_dir = tmp_path / "data"
+    imported = SessionArchive.import_archive(archive_path, data_dir=str(data_dir))
+
+    assert imported == str(data_dir / session_folder.name)
+    for path in session_folder.rglob("*"):
+        if path.is_file():
+            copy = data_dir / session_folder.name / path.relative_to(session_folder)
+            assert copy.read_bytes() == path.read_bytes()
+
+
+def test_import_refuses_existing_session(tmp_path, session_folder):
+    archive_path = str(tmp_path / "session.zip")
+    SessionArchive.export(str(session_folder), archive_path)
+    SessionArchive.import_archive(archive_path, data_dir=str(tmp_path / "data"))
+
+    with pytest.raises(FileExistsError):
+        SessionArchive.import_archive(archive_path, data_dir=str(tmp_path / "data"))
+
+
+def write_archive(path, session_id, names):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name in names:
+            zf.writestr(name, b"x")
+        zf.writestr(SessionArchive.MANIFEST_NAME, json.dumps({
+            "format": 1,
+            "session_id": session_id,
+            "entries": [{"name": name, "size": 1, "compressed": False} for name in names]
+        }))
+
+
+@pytest.mark.parametrize("session_id", ["../session_x", "session_x/../../etc", "not_a_session", None])
+def test_import_rejects_bad_session_id(tmp_path, session_id):
+    archive_path = str(tmp_path / "bad.zip")
+    write_archive(archive_path, session_id, ["images/a.png"])
+
+    with pytest.raises(ValueError):
+        SessionArchive.import_archive(archive_path, data_dir=str(tmp_path / "data"))
+
+
+def test_import_rejects_member_traversal(tmp_path):
+    archive_path = str(tmp_path / "bad.zip")
+    write_archive(archive_path, "session_x", ["images/a.png", "../../escape.txt"])
+
+    with pytest.raises(ValueError):
+        SessionArchive.import_archive(archive_path, data_dir=str(tmp_path / "data"))
+    assert not (tmp_path / "escape.txt").exists()
+    assert not (tmp_path / "data" / "session_x" / "images" / "a.png").exists()
@@ -0,0 +1,81 @@
+import os
+
+from ai_generator import PromptSimilarityIndex
+
+
+def make_artifact(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(b"x")
+    return str(path)
+
+
+def test_finds_reworded_edit_prompt(tmp_path):
+    index = PromptSimilarityIndex()
+    path = make_artifact(tmp_path, "a.png")
+    index.add("image_edit", "Make this look animated", path, image_hash="00ff00ff00ff00ff")
+
+    matches = index.find_similar("image_edit", "make it look more animated", image_hash="00ff00ff00ff00ff")
+
+    assert [entry["path"] for _, entry in matches] == [path]
+    assert matches[0][0] >= index.threshold
+
+
+def test_ignores_unrelated_prompts(tmp_path):
+    index = PromptSimilarityIndex()
+    index.add("image_edit", "Make this look animated", make_artifact(tmp_path, "a.png"), image_hash="00ff00ff00ff00ff")
+    index.add("text_to_image", "make it brighter", make_artifact(tmp_path, "b.png"))
+
+    assert index.find_similar("image_edit", "remove the background", image_hash="00ff00ff00ff00ff") == []
+    assert index.find_similar("text_to_image", "make it darker") == []
+
+
+def test_requires_close_input_image(tmp_path):
+    index = PromptSimilarityIndex()
+    index.add("image_edit", "Make this look animated", make_artifact(tmp_path, "a.png"), image_hash="00ff00ff00ff00ff")
+
+    assert index.find_similar("image_edit", "Make this look animated", image_hash="ff00ff00ff00ff00") == []
+    assert index.find_similar("image_edit", "Make this look animated") == []
+
+
+def test_kind_and_key_are_separate(tmp_path):
+    index = PromptSimilarityIndex()
+    index.add("tts", "Xin chào các bạn", make_artifact(tmp_path, "a.wav"), key="Kore")
+
+    assert len(index.find_similar("tts", "Xin chào các bạn", key="Kore")) == 1
+    assert index.find_similar("tts", "Xin chào các bạn", key="Puck") == []
+    assert index.find_similar("text_to_image", "Xin chào các bạn") == []
+
+
+def test_drops_entries_whose_file_is_gone(tmp_path):
+    index = PromptSimilarityIndex()
+    gone = make_artifact(tmp_path, "gone.png")
+    kept = make_artifact(tmp_path, "kept.png")
+    index.add("text_to_image", "a red sports car on a mountain road at sunset", gone)
+    index.add("text_to_image", "a red sports car on a mountain road at dusk", kept)
+    os.remove(gone)
+
+    matches = index.find_similar("text_to_image", "a red sports car on a mountain road at sunset")
+
+    assert [entry["path"] for _, entry in matches] == [kept]
+    assert gone not in index.known_paths
+
+
+def test_limit_and_order(tmp_path):
+    index = PromptSimilarityIndex()
+    for i in range(5):
+        index.add("text_to_image", f"a watercolor lighthouse on a cliff, variant {i}", make_artifact(tmp_path, f"{i}.png"))
+
+    matches = index.find_similar("text_to_image", "a watercolor lighthouse on a cliff, variant 3", limit=2)
+
+    assert len(matches) == 2
+    assert matches[0][1]["prompt"].endswith("variant 3")
+    assert matches[0][0] >= matches[1][0]
+
+
+def test_add_is_idempotent_per_path(tmp_path):
+    index = PromptSimilarityIndex()
+    path = make_artifact(tmp_path, "a.png")
+    index.add("text_to_image", "a cat on a sofa", path)
+    index.add("text_to_image", "a cat on a sofa", path)
+
+    assert len(index.find_similar("text_to_image", "a cat on a sofa")) == 1